@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+""" Compares upstream balancing policies against local TLS stand-in
+servers with different handshake delays.
+
+One of the servers is down during the first half of each run and comes
+up afterwards, exercising draining and gradual readmission. """
+
+import argparse
+import asyncio
+import collections
+import logging
+import multiprocessing
+import tempfile
+import time
+
+from common import (HOST, make_cert, server_context, client_context,
+                    start_tls_server)
+from ptw.balancer import Balancer
+from ptw.connpool import ConnPool
+from ptw.constants import BalancePolicy
+
+
+def _serve(ports, delays, certfile, keyfile, ctl):
+    async def run():
+        context = server_context(certfile, keyfile)
+        servers = {}
+        for port, delay in zip(ports, delays):
+            servers[port] = await start_tls_server(port, context, delay)
+        ctl.send('ready')
+        loop = asyncio.get_event_loop()
+        while True:
+            cmd = await loop.run_in_executor(None, ctl.recv)
+            if cmd[0] == 'stop':
+                servers.pop(cmd[1]).close()
+            elif cmd[0] == 'start':
+                port = cmd[1]
+                servers[port] = await start_tls_server(
+                    port, context, delays[ports.index(port)])
+            else:
+                break
+            ctl.send('ok')
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+async def bench(policy, args, ports, context, ctl):
+    loop = asyncio.get_event_loop()
+    pools = {}
+    for port in ports:
+        pools[port] = ConnPool(dst_address=HOST,
+                               dst_port=port,
+                               ssl_context=context,
+                               size=args.pool_size,
+                               backoff=.5,
+                               ttl=30,
+                               name=str(port),
+                               loop=loop)
+    balancer = Balancer([(pool, 1) for pool in pools.values()],
+                        policy=policy,
+                        slow_start=args.duration / 4,
+                        loop=loop)
+    flapping = ports[-1]
+    ctl.send(('stop', flapping))
+    ctl.recv()
+    await balancer.start()
+    await asyncio.sleep(1)
+
+    waits = []
+    used = collections.Counter()
+    started = loop.time()
+    restarted = False
+    while loop.time() - started < args.duration:
+        if not restarted and loop.time() - started > args.duration / 2:
+            ctl.send(('start', flapping))
+            ctl.recv()
+            restarted = True
+        t0 = time.perf_counter()
+        _, writer = await balancer.get()
+        waits.append(time.perf_counter() - t0)
+        used[writer.get_extra_info('peername')[1]] += 1
+        writer.close()
+        await asyncio.sleep(1 / args.rate)
+    await balancer.stop()
+    waits.sort()
+    return {
+        'p50': waits[len(waits) // 2],
+        'p99': waits[int(len(waits) * .99)],
+        'share': [used[port] / len(waits) for port in ports],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--delays", default="0,0.02,0.1,0",
+                        help="comma separated handshake delays of servers. "
+                        "Last one is restarted during run")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="connection requests per second")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--pool-size", type=int, default=3,
+                        help="pool size per upstream")
+    parser.add_argument("--base-port", type=int, default=58810)
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="show balancer log")
+    args = parser.parse_args()
+    if args.verbose:
+        logging.basicConfig(level=logging.WARNING)
+        logging.getLogger('ConnPool').setLevel(logging.CRITICAL)
+
+    delays = [float(d) for d in args.delays.split(',')]
+    ports = [args.base_port + i for i in range(len(delays))]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        certfile, keyfile = make_cert(tmpdir)
+        ctl, child_ctl = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=_serve,
+                                        args=(ports, delays, certfile,
+                                              keyfile, child_ctl),
+                                        daemon=True)
+        child.start()
+        ctl.recv()
+        logging.getLogger('ConnPool').setLevel(logging.CRITICAL)
+        loop = asyncio.get_event_loop()
+        print("%-8s %10s %10s  %s" % ("policy", "p50 ms", "p99 ms",
+                                      "share per upstream (delay)"))
+        for policy in BalancePolicy:
+            res = loop.run_until_complete(
+                bench(policy, args, ports, client_context(certfile), ctl))
+            print("%-8s %10.2f %10.2f  %s" % (
+                policy, res['p50'] * 1e3, res['p99'] * 1e3,
+                " ".join("%.2f(%g)" % pair
+                         for pair in zip(res['share'], delays))))
+        ctl.send(('exit',))
+        child.join()
+
+
+if __name__ == '__main__':
+    main()
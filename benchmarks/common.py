@@ -0,0 +1,109 @@
+""" Shared helpers of benchmark scripts """
+
+import asyncio
+import os
+import ssl
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+HOST = '127.0.0.1'
+
+
+def make_cert(directory):
+    """ Generates self-signed certificate for HOST with openssl CLI and
+    returns pair of certificate and key file paths. """
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=IP:%s' % (HOST,),
+                    '-keyout', keyfile, '-out', certfile],
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def server_context(certfile, keyfile):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    return context
+
+
+def client_context(certfile):
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.load_verify_locations(cafile=certfile)
+    return context
+
+
+async def echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class _EchoProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.transport = None
+        self._early = []
+
+    def connection_made(self, transport):
+        # start_tls() reports transport only after data may have arrived
+        self.transport = transport
+        for data in self._early:
+            transport.write(data)
+        self._early = None
+
+    def data_received(self, data):
+        if self.transport is None:
+            self._early.append(data)
+        else:
+            self.transport.write(data)
+
+
+class _DelayedTLSProtocol(asyncio.Protocol):
+    def __init__(self, context, delay):
+        self._context = context
+        self._delay = delay
+
+    def connection_made(self, transport):
+        transport.pause_reading()
+        loop = asyncio.get_event_loop()
+        loop.call_later(self._delay,
+                        lambda: asyncio.ensure_future(self._upgrade(transport)))
+
+    async def _upgrade(self, transport):
+        loop = asyncio.get_event_loop()
+        app = _EchoProtocol()
+        transport.resume_reading()
+        try:
+            tls_transport = await loop.start_tls(transport, app,
+                                                 self._context,
+                                                 server_side=True)
+        except (ConnectionError, ssl.SSLError, asyncio.CancelledError):
+            transport.close()
+            return
+        app.connection_made(tls_transport)
+
+    def connection_lost(self, exc):
+        pass
+
+
+async def start_tls_server(port, context, handshake_delay=0.):
+    """ Starts TLS echo server which delays every handshake by given
+    number of seconds, standing in for a slow TLS terminator. """
+    loop = asyncio.get_event_loop()
+    return await loop.create_server(
+        lambda: _DelayedTLSProtocol(context, handshake_delay), HOST, port)
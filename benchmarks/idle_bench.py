@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+""" Measures event loop overhead of idle pooled connections.
+
+Fills ConnPool with idle connections to a plain TCP server running in a
+child process and measures CPU time, loop iterations and Python heap
+spent per idle connection while pool just holds them. """
+
+import argparse
+import asyncio
+import gc
+import multiprocessing
+import resource
+import time
+import tracemalloc
+
+from common import HOST
+from ptw.connpool import ConnPool
+
+
+def _raise_nofile():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def _hold(reader, writer):
+    try:
+        await reader.read()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def _serve(port, ctl):
+    _raise_nofile()
+
+    async def run():
+        server = await asyncio.start_server(_hold, HOST, port, backlog=4096)
+        ctl.send('ready')
+        await asyncio.get_event_loop().run_in_executor(None, ctl.recv)
+        server.close()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+class IterationCounter:
+    def __init__(self, loop):
+        self.count = 0
+        self._loop = loop
+        self._orig = loop._run_once
+
+    def __enter__(self):
+        def run_once():
+            self.count += 1
+            self._orig()
+        self._loop._run_once = run_once
+        return self
+
+    def __exit__(self, *exc):
+        self._loop._run_once = self._orig
+
+
+async def bench(size, args):
+    loop = asyncio.get_event_loop()
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    pool = ConnPool(dst_address=HOST,
+                    dst_port=args.port,
+                    ssl_context=None,
+                    size=size,
+                    ttl=args.ttl,
+                    timeout=30,
+                    loop=loop)
+    fill_start = time.monotonic()
+    await pool.start()
+    while len(pool._reserve) < size:
+        await asyncio.sleep(.05)
+    fill = time.monotonic() - fill_start
+    gc.collect()
+    heap = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+
+    with IterationCounter(loop) as counter:
+        cpu_start = time.process_time()
+        await asyncio.sleep(args.duration)
+        cpu = time.process_time() - cpu_start
+
+    get_start = time.perf_counter()
+    for _ in range(min(size, 100)):
+        _, writer = await pool.get()
+        writer.close()
+    get_time = (time.perf_counter() - get_start) / min(size, 100)
+    await pool.stop()
+    return {
+        'fill': fill,
+        'cpu_per_sec': cpu / args.duration,
+        'wakeups_per_sec': counter.count / args.duration,
+        'heap_per_conn': heap / size,
+        'get': get_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000,10000",
+                        help="comma separated pool sizes")
+    parser.add_argument("--duration", type=float, default=5,
+                        help="idle measurement duration")
+    parser.add_argument("--ttl", type=float, default=3600)
+    parser.add_argument("--port", type=int, default=58820)
+    args = parser.parse_args()
+    _raise_nofile()
+
+    ctl, child_ctl = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=_serve,
+                                    args=(args.port, child_ctl),
+                                    daemon=True)
+    child.start()
+    ctl.recv()
+    loop = asyncio.get_event_loop()
+    print("%8s %10s %14s %16s %14s %12s" % ("size", "fill s", "idle CPU %",
+                                            "loop iter/s", "heap B/conn",
+                                            "get() us"))
+    for size in (int(s) for s in args.sizes.split(',')):
+        res = loop.run_until_complete(bench(size, args))
+        print("%8d %10.2f %14.2f %16.0f %14.0f %12.1f" % (
+            size, res['fill'], res['cpu_per_sec'] * 100,
+            res['wakeups_per_sec'], res['heap_per_conn'], res['get'] * 1e6))
+    ctl.send('exit')
+    child.join()
+
+
+if __name__ == '__main__':
+    main()
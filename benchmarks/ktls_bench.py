@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+""" Compares user space TLS relay with kernel TLS and splice relay.
+
+Runs Listener and ConnPool in the current process, TLS echo upstream and
+load generating clients in a child process, so CPU time spent in this
+process is attributable to relaying and upstream side encryption. Kernel
+TLS rows are skipped with explanation where it is not available. """
+
+import argparse
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+from common import HOST, make_cert, server_context, client_context, echo
+from relay_bench import _client
+from ptw import ktls
+from ptw.connpool import ConnPool
+from ptw.constants import RelayEngine
+from ptw.listener import Listener
+
+
+CASES = (
+    ("stream", RelayEngine.stream, False),
+    ("protocol", RelayEngine.protocol, False),
+    ("ktls+stream", RelayEngine.stream, True),
+    ("ktls+splice", RelayEngine.splice, True),
+)
+
+
+def _load(upstream_port, listen_port, certfile, keyfile, ctl):
+    async def run():
+        server = await asyncio.start_server(
+            echo, HOST, upstream_port,
+            ssl=server_context(certfile, keyfile))
+        ctl.send('ready')
+        while True:
+            cmd = await asyncio.get_event_loop().run_in_executor(None,
+                                                                 ctl.recv)
+            if cmd[0] != 'bulk':
+                break
+            _, conns, size, chunk = cmd
+            await asyncio.gather(*(_client(listen_port, size, chunk, None)
+                                   for _ in range(conns)))
+            ctl.send('done')
+        server.close()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+async def bench(engine, use_ktls, args, ctl):
+    loop = asyncio.get_event_loop()
+    pool = ConnPool(dst_address=HOST,
+                    dst_port=args.upstream_port,
+                    ssl_context=client_context(args.certfile),
+                    size=args.conns,
+                    ttl=600,
+                    ktls=use_ktls,
+                    loop=loop)
+    await pool.start()
+    listener = Listener(listen_address=HOST,
+                        listen_port=args.listen_port,
+                        pool=pool,
+                        relay_engine=engine,
+                        loop=loop)
+    await listener.start()
+    while len(pool._reserve) < args.conns:
+        await asyncio.sleep(.1)
+
+    total = args.conns * args.size * 2
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    ctl.send(('bulk', args.conns, args.size, args.chunk))
+    await loop.run_in_executor(None, ctl.recv)
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    await listener.stop()
+    await pool.stop()
+    return total / cpu, total / wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conns", type=int, default=20,
+                        help="concurrent client connections")
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024,
+                        help="bytes sent by each client")
+    parser.add_argument("--chunk", type=int, default=64 * 1024,
+                        help="client write size")
+    parser.add_argument("--upstream-port", type=int, default=58810)
+    parser.add_argument("--listen-port", type=int, default=58811)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.certfile, keyfile = make_cert(tmpdir)
+        ctl, child_ctl = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=_load,
+                                        args=(args.upstream_port,
+                                              args.listen_port,
+                                              args.certfile,
+                                              keyfile,
+                                              child_ctl),
+                                        daemon=True)
+        child.start()
+        ctl.recv()
+        loop = asyncio.get_event_loop()
+        reason = ktls.unavailable_reason()
+        print("%-12s %16s %16s" % ("case", "MB/s per core", "MB/s"))
+        for name, engine, use_ktls in CASES:
+            if use_ktls and reason is not None:
+                print("%-12s %33s" % (name, "skipped"))
+                continue
+            per_cpu, per_wall = loop.run_until_complete(
+                bench(engine, use_ktls, args, ctl))
+            print("%-12s %16.1f %16.1f" % (name, per_cpu / 2**20,
+                                           per_wall / 2**20))
+        if reason is not None:
+            print("Kernel TLS is not available: %s" % (reason,))
+        ctl.send(('exit',))
+        child.join()
+
+
+if __name__ == '__main__':
+    main()
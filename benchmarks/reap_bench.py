@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+""" Measures resources held by ptw after clients are done with it.
+
+Local TLS echo server in a child process closes connection when it gets
+end of stream. Finishing clients exchange data with it through ptw and
+close their socket. Idle clients connect, exchange data once and stay
+silent with socket open. After settle period open descriptors, active
+client handlers and RSS of ptw are reported. Other ptw checkout may be
+given for comparison. Linux only: descriptors and memory are read from
+/proc. """
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+
+from common import HOST, make_cert
+from suite import REPO, LAUNCHER, _serve, rss_bytes
+
+
+def _launch(args, repo, extra):
+    cmd = [sys.executable, '-c', LAUNCHER, '-v', 'error',
+           '-a', HOST, '-p', str(args.listen_port),
+           '-n', str(args.pool_size), '-C', args.certfile,
+           '--metrics-port', str(args.metrics_port)] + extra
+    cmd.extend((HOST, str(args.upstream_port)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = repo + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.Popen(cmd, env=env)
+
+
+async def _exchange(args):
+    reader, writer = await asyncio.open_connection(HOST, args.listen_port)
+    writer.write(b'x' * args.size)
+    await reader.readexactly(args.size)
+    return writer
+
+
+async def _active(args):
+    reader, writer = await asyncio.open_connection(HOST, args.metrics_port)
+    try:
+        writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+        body = await reader.read()
+    finally:
+        writer.close()
+    for line in body.decode('utf-8').splitlines():
+        if line.startswith('ptw_listener_active_handlers'):
+            return int(float(line.rsplit(' ', 1)[1]))
+    return None
+
+
+async def bench(proc, args):
+    await asyncio.sleep(args.startup)
+    finishing = await asyncio.gather(*(_exchange(args)
+                                       for _ in range(args.finishing)))
+    for writer in finishing:
+        writer.close()
+    idle = await asyncio.gather(*(_exchange(args)
+                                  for _ in range(args.idle)))
+    await asyncio.sleep(args.settle)
+    fds = len(os.listdir('/proc/%d/fd' % (proc.pid,)))
+    result = fds, await _active(args), rss_bytes(proc.pid)
+    for writer in idle:
+        writer.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--finishing", type=int, default=500,
+                        help="number of clients which close connection")
+    parser.add_argument("--idle", type=int, default=200,
+                        help="number of clients which stay silent")
+    parser.add_argument("--size", type=int, default=16384,
+                        help="bytes exchanged by every client")
+    parser.add_argument("--pool-size", type=int, default=50,
+                        help="pool size")
+    parser.add_argument("--idle-timeout", type=float, default=2.,
+                        help="relay idle timeout")
+    parser.add_argument("--startup", type=float, default=2.,
+                        help="time given to ptw to fill pool")
+    parser.add_argument("--settle", type=float, default=6.,
+                        help="time between clients are done and measurement")
+    parser.add_argument("--compare", metavar="REPO",
+                        help="other ptw checkout to measure first")
+    parser.add_argument("--upstream-port", type=int, default=58890)
+    parser.add_argument("--listen-port", type=int, default=58891)
+    parser.add_argument("--metrics-port", type=int, default=58892)
+    args = parser.parse_args()
+
+    cases = [("current", REPO, []),
+             ("current+idle", REPO,
+              ['--idle-timeout', str(args.idle_timeout)])]
+    if args.compare is not None:
+        cases.insert(0, ("compared", args.compare, []))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.certfile, keyfile = make_cert(tmpdir)
+        ctl, child_ctl = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(args.upstream_port,
+                                               args.certfile,
+                                               keyfile,
+                                               0.,
+                                               child_ctl),
+                                         daemon=True)
+        server.start()
+        ctl.recv()
+        loop = asyncio.get_event_loop()
+        print("%-14s %10s %10s %10s" % ("case", "fds", "handlers",
+                                        "RSS MB"))
+        for name, repo, extra in cases:
+            proc = _launch(args, repo, extra)
+            try:
+                fds, active, rss = loop.run_until_complete(bench(proc,
+                                                                 args))
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            print("%-14s %10d %10d %10.1f" % (name, fds, active,
+                                              rss / 2**20))
+        ctl.send('exit')
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+""" Compares fixed and adaptive relay record sizing.
+
+Runs Listener and ConnPool in the current process, TLS echo upstream and
+clients in a child process. Interactive case measures round trip of small
+messages, burst case measures time to first and last echoed byte of large
+write made after idle period, bulk case measures relay throughput per CPU
+second of this process. """
+
+import argparse
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+from common import HOST, make_cert, server_context, client_context, echo
+from relay_bench import _client
+from ptw.connpool import ConnPool
+from ptw.constants import BUFSIZE, SMALL_RECORD, RelayEngine
+from ptw.listener import Listener
+
+
+CASES = (
+    ("stream", "fixed", RelayEngine.stream, BUFSIZE, 0.),
+    ("stream", "adaptive", RelayEngine.stream, SMALL_RECORD, 0.),
+    ("protocol", "fixed", RelayEngine.protocol, BUFSIZE, 0.),
+    ("protocol", "adaptive", RelayEngine.protocol, SMALL_RECORD, 0.),
+    ("protocol", "adaptive+coalesce", RelayEngine.protocol, SMALL_RECORD,
+     .001),
+)
+
+
+def _percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+async def _interactive(port, rounds, size):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    payload = b'x' * size
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        writer.write(payload)
+        await reader.readexactly(size)
+        samples.append(time.perf_counter() - start)
+    writer.close()
+    return samples
+
+
+async def _burst(port, bursts, size, idle):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    payload = b'x' * size
+    first, last = [], []
+    for _ in range(bursts):
+        await asyncio.sleep(idle)
+        start = time.perf_counter()
+        writer.write(payload)
+        received = len(await reader.read(65536))
+        first.append(time.perf_counter() - start)
+        while received < size:
+            received += len(await reader.read(65536))
+        last.append(time.perf_counter() - start)
+    writer.close()
+    return first, last
+
+
+def _load(upstream_port, listen_port, certfile, keyfile, ctl):
+    async def run():
+        server = await asyncio.start_server(
+            echo, HOST, upstream_port,
+            ssl=server_context(certfile, keyfile))
+        ctl.send('ready')
+        while True:
+            cmd = await asyncio.get_event_loop().run_in_executor(None,
+                                                                 ctl.recv)
+            if cmd[0] == 'interactive':
+                ctl.send(await _interactive(listen_port, *cmd[1:]))
+            elif cmd[0] == 'burst':
+                ctl.send(await _burst(listen_port, *cmd[1:]))
+            elif cmd[0] == 'bulk':
+                _, conns, size, chunk = cmd
+                await asyncio.gather(*(_client(listen_port, size, chunk, None)
+                                       for _ in range(conns)))
+                ctl.send('done')
+            else:
+                break
+        server.close()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+async def bench(engine, record_min, coalesce_delay, args, ctl):
+    loop = asyncio.get_event_loop()
+
+    async def call(*cmd):
+        ctl.send(cmd)
+        return await loop.run_in_executor(None, ctl.recv)
+
+    pool = ConnPool(dst_address=HOST,
+                    dst_port=args.upstream_port,
+                    ssl_context=client_context(args.certfile),
+                    size=args.conns,
+                    ttl=600,
+                    loop=loop)
+    await pool.start()
+    listener = Listener(listen_address=HOST,
+                        listen_port=args.listen_port,
+                        pool=pool,
+                        relay_engine=engine,
+                        record_min=record_min,
+                        coalesce_delay=coalesce_delay,
+                        loop=loop)
+    await listener.start()
+    while len(pool._reserve) < args.conns:
+        await asyncio.sleep(.1)
+
+    rtt = await call('interactive', args.rounds, args.message)
+    first, last = await call('burst', args.bursts, args.burst, args.idle)
+    while len(pool._reserve) < args.conns:
+        await asyncio.sleep(.1)
+    cpu_start = time.process_time()
+    await call('bulk', args.conns, args.size, args.chunk)
+    cpu = time.process_time() - cpu_start
+
+    await listener.stop()
+    await pool.stop()
+    return (_percentile(rtt, .5), _percentile(rtt, .99),
+            _percentile(first, .5), _percentile(last, .5),
+            args.conns * args.size * 2 / cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=2000,
+                        help="interactive round trips")
+    parser.add_argument("--message", type=int, default=64,
+                        help="interactive message size")
+    parser.add_argument("--bursts", type=int, default=5,
+                        help="number of bursts after idle period")
+    parser.add_argument("--burst", type=int, default=256 * 1024,
+                        help="burst size")
+    parser.add_argument("--idle", type=float, default=1.2,
+                        help="idle period before every burst")
+    parser.add_argument("--conns", type=int, default=10,
+                        help="concurrent bulk client connections")
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024,
+                        help="bytes sent by each bulk client")
+    parser.add_argument("--chunk", type=int, default=64 * 1024,
+                        help="bulk client write size")
+    parser.add_argument("--upstream-port", type=int, default=58830)
+    parser.add_argument("--listen-port", type=int, default=58831)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.certfile, keyfile = make_cert(tmpdir)
+        ctl, child_ctl = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=_load,
+                                        args=(args.upstream_port,
+                                              args.listen_port,
+                                              args.certfile,
+                                              keyfile,
+                                              child_ctl),
+                                        daemon=True)
+        child.start()
+        ctl.recv()
+        loop = asyncio.get_event_loop()
+        print("%-9s %-18s %9s %9s %10s %10s %10s" % (
+            "engine", "sizing", "rtt p50", "rtt p99", "burst 1st",
+            "burst all", "MB/cpu-s"))
+        for engine_name, sizing, engine, record_min, delay in CASES:
+            rtt50, rtt99, first, last, per_cpu = loop.run_until_complete(
+                bench(engine, record_min, delay, args, ctl))
+            print("%-9s %-18s %7.3fms %7.3fms %8.3fms %8.3fms %10.1f" % (
+                engine_name, sizing, rtt50 * 1000, rtt99 * 1000,
+                first * 1000, last * 1000, per_cpu / 2**20))
+        ctl.send(('exit',))
+        child.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+""" Compares relay engines of ptw Listener.
+
+Runs Listener and ConnPool in the current process and plain TCP echo
+upstream together with load generating clients in a child process, so
+CPU time spent in this process is attributable to relaying. Upstream is
+plain TCP to keep TLS cost out of the comparison. """
+
+import argparse
+import asyncio
+import gc
+import multiprocessing
+import time
+import tracemalloc
+
+from common import HOST
+from ptw.connpool import ConnPool
+from ptw.constants import RelayEngine
+from ptw.listener import Listener
+
+
+async def _echo(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def _client(port, size, chunk, hold):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    payload = b'x' * chunk
+    received = 0
+    sent = 0
+    while sent < size:
+        writer.write(payload)
+        sent += chunk
+        await writer.drain()
+        while received < sent - 4 * chunk:
+            received += len(await reader.read(65536))
+    while received < size:
+        received += len(await reader.read(65536))
+    if hold is not None:
+        await hold.wait()
+    writer.close()
+
+
+def _load(upstream_port, listen_port, ctl):
+    async def run():
+        server = await asyncio.start_server(_echo, HOST, upstream_port)
+        ctl.send('ready')
+        while True:
+            cmd = await asyncio.get_event_loop().run_in_executor(None,
+                                                                 ctl.recv)
+            if cmd[0] == 'bulk':
+                _, conns, size, chunk = cmd
+                await asyncio.gather(*(_client(listen_port, size, chunk, None)
+                                       for _ in range(conns)))
+                ctl.send('done')
+            elif cmd[0] == 'hold':
+                _, conns = cmd
+                hold = asyncio.Event()
+                tasks = [asyncio.ensure_future(_client(listen_port, 1024,
+                                                       1024, hold))
+                         for _ in range(conns)]
+                await asyncio.sleep(1)
+                ctl.send('holding')
+                await asyncio.get_event_loop().run_in_executor(None, ctl.recv)
+                hold.set()
+                await asyncio.gather(*tasks)
+                ctl.send('done')
+            else:
+                break
+        server.close()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+async def bench(engine, args, ctl):
+    loop = asyncio.get_event_loop()
+    pool = ConnPool(dst_address=HOST,
+                    dst_port=args.upstream_port,
+                    ssl_context=None,
+                    size=args.conns,
+                    ttl=600,
+                    loop=loop)
+    await pool.start()
+    listener = Listener(listen_address=HOST,
+                        listen_port=args.listen_port,
+                        pool=pool,
+                        relay_engine=engine,
+                        loop=loop)
+    await listener.start()
+    while len(pool._reserve) < args.conns:
+        await asyncio.sleep(.1)
+
+    total = args.conns * args.size * 2
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    ctl.send(('bulk', args.conns, args.size, args.chunk))
+    await loop.run_in_executor(None, ctl.recv)
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    while len(pool._reserve) < args.conns:
+        await asyncio.sleep(.1)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    ctl.send(('hold', args.conns))
+    await loop.run_in_executor(None, ctl.recv)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    ctl.send(('release',))
+    await loop.run_in_executor(None, ctl.recv)
+
+    await listener.stop()
+    await pool.stop()
+    return {
+        'engine': str(engine),
+        'bytes_per_cpu_sec': total / cpu,
+        'bytes_per_sec': total / wall,
+        'bytes_per_conn': (held - base) / args.conns,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--conns", type=int, default=50,
+                        help="concurrent client connections")
+    parser.add_argument("--size", type=int, default=16 * 1024 * 1024,
+                        help="bytes sent by each client")
+    parser.add_argument("--chunk", type=int, default=64 * 1024,
+                        help="client write size")
+    parser.add_argument("--upstream-port", type=int, default=58800)
+    parser.add_argument("--listen-port", type=int, default=58801)
+    args = parser.parse_args()
+
+    ctl, child_ctl = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=_load,
+                                    args=(args.upstream_port,
+                                          args.listen_port,
+                                          child_ctl),
+                                    daemon=True)
+    child.start()
+    ctl.recv()
+    loop = asyncio.get_event_loop()
+    print("%-10s %16s %16s %16s" % ("engine", "MB/s per core", "MB/s",
+                                    "bytes per conn"))
+    for engine in RelayEngine:
+        res = loop.run_until_complete(bench(engine, args, ctl))
+        print("%-10s %16.1f %16.1f %16.0f" % (res['engine'],
+                                              res['bytes_per_cpu_sec'] / 2**20,
+                                              res['bytes_per_sec'] / 2**20,
+                                              res['bytes_per_conn']))
+    ctl.send(('exit',))
+    child.join()
+
+
+if __name__ == '__main__':
+    main()
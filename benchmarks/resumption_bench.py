@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+""" Measures handshake CPU cost of pooled upstream connections with and
+without TLS session resumption.
+
+Local TLS server runs in a child process and reports its own CPU time, so
+both client and server sides of handshake are accounted. """
+
+import argparse
+import asyncio
+import multiprocessing
+import ssl
+import tempfile
+import time
+
+from common import HOST, make_cert, server_context, client_context
+from ptw.sessioncache import SessionCache, install_session_hook
+
+
+async def _drop(reader, writer):
+    try:
+        await reader.read(1)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def _serve(port, certfile, keyfile, ctl):
+    async def run():
+        server = await asyncio.start_server(
+            _drop, HOST, port, ssl=server_context(certfile, keyfile))
+        ctl.send('ready')
+        loop = asyncio.get_event_loop()
+        while await loop.run_in_executor(None, ctl.recv) == 'cpu':
+            ctl.send(time.process_time())
+        server.close()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+async def handshakes(port, context, count, cache):
+    for _ in range(count):
+        offered = cache.offer() if cache is not None else None
+        reader, writer = await asyncio.open_connection(
+            HOST, port, ssl=context, server_hostname=HOST)
+        if cache is not None:
+            cache.handshake_done(offered,
+                                 writer.get_extra_info('ssl_object'))
+        # let TLS 1.3 tickets arrive like they do for idle pooled
+        # connections
+        await asyncio.sleep(.001)
+        if cache is not None:
+            cache.put(writer.get_extra_info('ssl_object'))
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=500,
+                        help="handshakes per run")
+    parser.add_argument("--port", type=int, default=58802)
+    parser.add_argument("--tls-max", choices=("1.2", "1.3"), default="1.3",
+                        help="maximal TLS version")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        certfile, keyfile = make_cert(tmpdir)
+        ctl, child_ctl = multiprocessing.Pipe()
+        child = multiprocessing.Process(target=_serve,
+                                        args=(args.port, certfile, keyfile,
+                                              child_ctl),
+                                        daemon=True)
+        child.start()
+        ctl.recv()
+        loop = asyncio.get_event_loop()
+        print("%-12s %14s %14s %10s" % ("mode", "client us/hs", "server us/hs",
+                                        "hits"))
+        for resume in (False, True):
+            context = client_context(certfile)
+            if args.tls_max == "1.2":
+                context.maximum_version = ssl.TLSVersion.TLSv1_2
+            cache = None
+            if resume:
+                install_session_hook(context)
+                cache = SessionCache()
+            ctl.send('cpu')
+            server_start = ctl.recv()
+            client_start = time.process_time()
+            loop.run_until_complete(handshakes(args.port, context,
+                                               args.count, cache))
+            client_cpu = time.process_time() - client_start
+            ctl.send('cpu')
+            server_cpu = ctl.recv() - server_start
+            print("%-12s %14.0f %14.0f %10s" % (
+                "resumption" if resume else "full",
+                client_cpu / args.count * 1e6,
+                server_cpu / args.count * 1e6,
+                cache.hits if cache is not None else "-"))
+        ctl.send('exit')
+        child.join()
+
+
+if __name__ == '__main__':
+    main()
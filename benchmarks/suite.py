@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+""" End to end benchmark suite of ptw.
+
+Starts local TLS echo server in a child process and runs real ptw
+command line in front of it in another one, once per combination of
+event loop, pool size and TTL. Load is generated from this process.
+Reported figures:
+
+* conn_per_sec: short connections (one roundtrip each) per second
+* ttfb_{warm,cold}_p{50,99}_ms: time from connect to first echoed byte,
+  with filled pool and right after ptw start
+* bulk_mb_per_cpu_sec: relayed megabytes per CPU second of ptw process
+* rss_mb_per_1k_conns: RSS growth of ptw process per 1000 open
+  connections
+
+Results are printed as table and optionally written as JSON for
+tracking regressions between releases. Linux only: ptw CPU and memory
+are read from /proc. """
+
+import argparse
+import asyncio
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import HOST, make_cert, server_context, start_tls_server
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAUNCHER = "import sys; sys.argv[0] = 'ptw'; from ptw.__main__ import main; main()"
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def _serve(port, certfile, keyfile, handshake_delay, ctl):
+    async def run():
+        server = await start_tls_server(port,
+                                        server_context(certfile, keyfile),
+                                        handshake_delay)
+        ctl.send('ready')
+        await asyncio.get_event_loop().run_in_executor(None, ctl.recv)
+        server.close()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100.))]
+
+
+def cpu_seconds(pid):
+    with open('/proc/%d/stat' % (pid,)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def rss_bytes(pid):
+    with open('/proc/%d/status' % (pid,)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class Ptw:
+    """ ptw command line process """
+
+    def __init__(self, args, loop_name, pool_size, ttl):
+        cmd = [sys.executable, '-c', LAUNCHER,
+               '-v', 'error',
+               '-a', HOST, '-p', str(args.listen_port),
+               '-n', str(pool_size), '-T', str(ttl),
+               '-C', args.certfile,
+               '--metrics-port', str(args.metrics_port),
+               HOST, str(args.upstream_port)]
+        if loop_name == 'asyncio':
+            cmd.insert(3, '--disable-uvloop')
+        env = dict(os.environ)
+        env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+        self._metrics_port = args.metrics_port
+        self.proc = subprocess.Popen(cmd, env=env)
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    async def idle(self):
+        """ Reads number of idle pooled connections from metrics endpoint.
+        Returns None if ptw is not ready yet. """
+        try:
+            reader, writer = await asyncio.open_connection(HOST,
+                                                           self._metrics_port)
+        except OSError:
+            return None
+        try:
+            writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+            body = await reader.read()
+        finally:
+            writer.close()
+        for line in body.decode('utf-8').splitlines():
+            if line.startswith('ptw_pool_idle_connections'):
+                return int(float(line.rsplit(' ', 1)[1]))
+        return None
+
+    async def wait_listening(self, port, timeout=10.):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                _, writer = await asyncio.open_connection(HOST, port)
+            except OSError:
+                await asyncio.sleep(.005)
+                continue
+            writer.close()
+            return
+        raise RuntimeError("ptw didn't start listening")
+
+    async def wait_filled(self, size, timeout=30.):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            idle = await self.idle()
+            if idle is not None and idle >= size:
+                return
+            await asyncio.sleep(.05)
+        raise RuntimeError("pool was not filled in time")
+
+    def stop(self):
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+async def roundtrip(port, hold=None, timeout=30.):
+    """ Connects, sends one byte and returns time to its echo """
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(HOST, port)
+    try:
+        writer.write(b'x')
+        if not await asyncio.wait_for(reader.read(1), timeout):
+            raise ConnectionError("connection closed by ptw")
+        ttfb = time.perf_counter() - start
+        if hold is not None:
+            await hold.wait()
+    finally:
+        writer.close()
+    return ttfb
+
+
+async def measure_rate(args):
+    done = 0
+    deadline = time.monotonic() + args.duration
+
+    async def worker():
+        nonlocal done
+        while time.monotonic() < deadline:
+            await roundtrip(args.listen_port)
+            done += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    return done / (time.monotonic() - start)
+
+
+async def measure_ttfb_warm(args, ptw, pool_size):
+    samples = []
+    for _ in range(args.samples):
+        await ptw.wait_filled(pool_size)
+        samples.append(await roundtrip(args.listen_port))
+    return samples
+
+
+async def measure_ttfb_cold(args, loop_name, pool_size, ttl):
+    samples = []
+    for _ in range(args.cold_samples):
+        ptw = Ptw(args, loop_name, pool_size, ttl)
+        try:
+            await ptw.wait_listening(args.listen_port)
+            samples.append(await roundtrip(args.listen_port))
+        finally:
+            ptw.stop()
+    return samples
+
+
+async def bulk_client(port, size, chunk):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    payload = b'x' * chunk
+    sent = received = 0
+    while sent < size:
+        writer.write(payload)
+        sent += chunk
+        await writer.drain()
+        while received < sent - 4 * chunk:
+            received += len(await reader.read(65536))
+    while received < size:
+        received += len(await reader.read(65536))
+    writer.close()
+
+
+async def measure_bulk(args, ptw, pool_size):
+    await ptw.wait_filled(min(pool_size, args.bulk_conns))
+    cpu_start = cpu_seconds(ptw.pid)
+    await asyncio.gather(*(bulk_client(args.listen_port, args.bulk_size,
+                                       65536)
+                           for _ in range(args.bulk_conns)))
+    cpu = cpu_seconds(ptw.pid) - cpu_start
+    total = 2 * args.bulk_size * args.bulk_conns
+    return total / 2**20 / cpu if cpu else None
+
+
+async def measure_rss(args, ptw, pool_size):
+    await ptw.wait_filled(pool_size)
+    base = rss_bytes(ptw.pid)
+    hold = asyncio.Event()
+    tasks = [asyncio.ensure_future(roundtrip(args.listen_port, hold))
+             for _ in range(args.hold_conns)]
+    try:
+        # every connection has made its roundtrip once pool is refilled
+        await ptw.wait_filled(pool_size, timeout=120.)
+        await asyncio.sleep(.5)
+        held = rss_bytes(ptw.pid)
+    finally:
+        hold.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return (held - base) / 2**20 / args.hold_conns * 1000
+
+
+async def run_case(args, loop_name, pool_size, ttl):
+    res = {
+        'loop': loop_name,
+        'pool_size': pool_size,
+        'ttl': ttl,
+    }
+    cold = await measure_ttfb_cold(args, loop_name, pool_size, ttl)
+    ptw = Ptw(args, loop_name, pool_size, ttl)
+    try:
+        await ptw.wait_listening(args.listen_port)
+        warm = await measure_ttfb_warm(args, ptw, pool_size)
+        await ptw.wait_filled(pool_size)
+        res['conn_per_sec'] = await measure_rate(args)
+        res['bulk_mb_per_cpu_sec'] = await measure_bulk(args, ptw, pool_size)
+        res['rss_mb_per_1k_conns'] = await measure_rss(args, ptw, pool_size)
+    finally:
+        ptw.stop()
+    for name, samples in (('warm', warm), ('cold', cold)):
+        for pct in (50, 99):
+            res['ttfb_%s_p%d_ms' % (name, pct)] = (
+                percentile(samples, pct) * 1000 if samples else None)
+    return res
+
+
+COLUMNS = (
+    ('loop', '%-8s', '%-8s'),
+    ('pool_size', '%5s', '%5d'),
+    ('ttl', '%6s', '%6g'),
+    ('conn_per_sec', '%9s', '%9.0f'),
+    ('ttfb_warm_p50_ms', '%9s', '%9.2f'),
+    ('ttfb_warm_p99_ms', '%9s', '%9.2f'),
+    ('ttfb_cold_p50_ms', '%9s', '%9.2f'),
+    ('ttfb_cold_p99_ms', '%9s', '%9.2f'),
+    ('bulk_mb_per_cpu_sec', '%9s', '%9.1f'),
+    ('rss_mb_per_1k_conns', '%9s', '%9.1f'),
+)
+HEADERS = ('loop', 'pool', 'ttl', 'conn/s', 'warm p50', 'warm p99',
+           'cold p50', 'cold p99', 'MB/cpu-s', 'RSS/1k')
+
+
+def format_row(res):
+    cells = []
+    for key, head_fmt, fmt in COLUMNS:
+        value = res.get(key)
+        cells.append(head_fmt % ('-',) if value is None else fmt % (value,))
+    return ' '.join(cells)
+
+
+def csv_list(cast):
+    def parse(value):
+        return [cast(item) for item in value.split(',') if item]
+    return parse
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO,
+                              check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--loops", type=csv_list(str),
+                        default=['asyncio', 'uvloop'],
+                        help="comma separated event loops to compare")
+    parser.add_argument("--pool-sizes", type=csv_list(int), default=[25],
+                        help="comma separated pool sizes to compare")
+    parser.add_argument("--ttls", type=csv_list(float), default=[30.],
+                        help="comma separated pool TTLs to compare")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="concurrent clients in connection rate test")
+    parser.add_argument("--duration", type=float, default=5.,
+                        help="connection rate test duration")
+    parser.add_argument("--samples", type=int, default=200,
+                        help="warm pool time to first byte samples")
+    parser.add_argument("--cold-samples", type=int, default=10,
+                        help="cold pool time to first byte samples. Each "
+                        "one restarts ptw")
+    parser.add_argument("--bulk-conns", type=int, default=10,
+                        help="concurrent connections in throughput test")
+    parser.add_argument("--bulk-size", type=int, default=32 * 2**20,
+                        help="bytes sent by each throughput test client")
+    parser.add_argument("--hold-conns", type=int, default=1000,
+                        help="open connections in memory test")
+    parser.add_argument("--handshake-delay", type=float, default=0.,
+                        help="artificial server handshake delay in seconds")
+    parser.add_argument("--upstream-port", type=int, default=58820)
+    parser.add_argument("--listen-port", type=int, default=58821)
+    parser.add_argument("--metrics-port", type=int, default=58822)
+    parser.add_argument("--json", metavar="FILE",
+                        help="write results to FILE, '-' for stdout")
+    args = parser.parse_args()
+
+    loops = []
+    for name in args.loops:
+        if name == 'uvloop' and importlib.util.find_spec('uvloop') is None:
+            print("uvloop is not installed, skipping it.", file=sys.stderr)
+            continue
+        loops.append(name)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.certfile, keyfile = make_cert(tmpdir)
+        ctl, child_ctl = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(args.upstream_port,
+                                               args.certfile,
+                                               keyfile,
+                                               args.handshake_delay,
+                                               child_ctl),
+                                         daemon=True)
+        server.start()
+        ctl.recv()
+        loop = asyncio.get_event_loop()
+        print(' '.join(head_fmt % (header,) for (_, head_fmt, _), header
+                       in zip(COLUMNS, HEADERS)), file=sys.stderr)
+        for loop_name, pool_size, ttl in itertools.product(loops,
+                                                           args.pool_sizes,
+                                                           args.ttls):
+            res = loop.run_until_complete(run_case(args, loop_name,
+                                                   pool_size, ttl))
+            print(format_row(res), file=sys.stderr)
+            results.append(res)
+        ctl.send('exit')
+        server.join()
+
+    if args.json is not None:
+        report = {
+            'timestamp': time.time(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': {key: value for key, value in vars(args).items()
+                       if key != 'certfile'},
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+""" Compares reserve hand-out policies and TTL staggering of ConnPool.
+
+Upstream echoes data only on connections which were idle for less than
+its idle timeout and silently ignores older ones, like load balancer or
+NAT which dropped connection state. Clients arrive at random and count
+hand-outs which got no answer. Handshake rate variance is measured over
+fixed intervals from upstream accept times. """
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from common import HOST
+from ptw.connpool import ConnPool
+from ptw.constants import ReservePolicy
+
+
+CASES = (
+    ("fifo", ReservePolicy.fifo, 0., False),
+    ("lifo", ReservePolicy.lifo, 0., False),
+    ("lifo+jitter", ReservePolicy.lifo, .1, False),
+    ("lifo+jitter+stagger", ReservePolicy.lifo, .1, True),
+)
+
+
+class Upstream:
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.accepts = []
+
+    async def handler(self, reader, writer):
+        self.accepts.append(time.monotonic())
+        last = time.monotonic()
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                now = time.monotonic()
+                if now - last < self.idle_timeout:
+                    writer.write(data)
+                last = now
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def _client(pool, timeout, results):
+    reader, writer = await pool.get()
+    try:
+        writer.write(b'x')
+        await asyncio.wait_for(reader.readexactly(1), timeout)
+        results.append(True)
+    except (asyncio.TimeoutError, ConnectionError,
+            asyncio.IncompleteReadError):
+        results.append(False)
+    finally:
+        writer.close()
+
+
+async def bench(policy, jitter, stagger, args):
+    upstream = Upstream(args.server_idle)
+    server = await asyncio.start_server(upstream.handler, HOST,
+                                        args.upstream_port)
+    pool = ConnPool(dst_address=HOST,
+                    dst_port=args.upstream_port,
+                    ssl_context=None,
+                    size=args.size,
+                    ttl=args.ttl,
+                    ttl_jitter=jitter,
+                    stagger=stagger,
+                    policy=policy)
+    start = time.monotonic()
+    await pool.start()
+    results = []
+    tasks = []
+    deadline = start + args.duration
+    while time.monotonic() < deadline:
+        await asyncio.sleep(random.expovariate(args.rate))
+        tasks.append(asyncio.ensure_future(_client(pool, args.reply_timeout,
+                                                   results)))
+    await asyncio.gather(*tasks)
+    await pool.stop()
+    server.close()
+    await server.wait_closed()
+
+    # skip initial fill, count handshakes per interval
+    buckets = [0] * int((args.duration - args.ttl) / args.interval)
+    for accepted in upstream.accepts:
+        idx = int((accepted - start - args.ttl) / args.interval)
+        if 0 <= idx < len(buckets):
+            buckets[idx] += 1
+    mean = statistics.mean(buckets)
+    return (mean / args.interval,
+            statistics.pstdev(buckets) / mean if mean else 0.,
+            max(buckets) / args.interval,
+            results.count(False) / len(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=50,
+                        help="pool size")
+    parser.add_argument("--ttl", type=float, default=3.,
+                        help="pool connection TTL")
+    parser.add_argument("--server-idle", type=float, default=2.5,
+                        help="upstream idle timeout")
+    parser.add_argument("--rate", type=float, default=20.,
+                        help="client arrival rate per second")
+    parser.add_argument("--duration", type=float, default=15.,
+                        help="test duration in seconds")
+    parser.add_argument("--interval", type=float, default=.25,
+                        help="handshake rate measurement interval")
+    parser.add_argument("--reply-timeout", type=float, default=.3,
+                        help="time to wait for upstream answer")
+    parser.add_argument("--upstream-port", type=int, default=58840)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    print("%-20s %12s %12s %12s %12s" % ("case", "handshakes/s", "rate CV",
+                                         "peak rate/s", "failed"))
+    for name, policy, jitter, stagger in CASES:
+        rate, cv, peak, failed = loop.run_until_complete(
+            bench(policy, jitter, stagger, args))
+        print("%-20s %12.1f %12.2f %12.1f %11.1f%%" % (name, rate, cv, peak,
+                                                      failed * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+""" Compares N single-tunnel ptw processes with one process serving N
+tunnels from config file.
+
+Every tunnel has its own listen port and pool to local TLS echo server
+running in a child process. Once all pools are filled, total RSS of ptw
+processes is taken and their CPU usage is measured over idle period.
+Linux only: memory and CPU time are read from /proc. """
+
+import argparse
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import HOST, make_cert
+from suite import REPO, LAUNCHER, _serve, cpu_seconds, rss_bytes
+
+
+def _launch(args, extra):
+    cmd = [sys.executable, '-c', LAUNCHER, '-v', 'error'] + extra
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.Popen(cmd, env=env)
+
+
+def _tunnel_options(args, idx):
+    return [('bind-address', HOST),
+            ('bind-port', str(args.listen_port + idx)),
+            ('pool-size', str(args.pool_size)),
+            ('ttl', str(args.ttl)),
+            ('cafile', args.certfile),
+            ('dst-address', HOST),
+            ('dst-port', str(args.upstream_port))]
+
+
+def separate(args):
+    procs = []
+    for idx in range(args.tunnels):
+        extra = []
+        for key, value in _tunnel_options(args, idx):
+            if not key.startswith('dst-'):
+                extra.extend(('--' + key, value))
+        extra.extend((HOST, str(args.upstream_port)))
+        procs.append(_launch(args, extra))
+    return procs
+
+
+def combined(args):
+    config = os.path.join(args.tmpdir, 'tunnels.ini')
+    with open(config, 'w') as f:
+        for idx in range(args.tunnels):
+            f.write("[tunnel%d]\n" % (idx,))
+            for key, value in _tunnel_options(args, idx):
+                f.write("%s = %s\n" % (key, value))
+    return [_launch(args, ['--config', config])]
+
+
+def measure(procs, args):
+    try:
+        # pools are filled and startup garbage is settled by then
+        time.sleep(args.settle)
+        for proc in procs:
+            if proc.poll() is not None:
+                raise RuntimeError("ptw exited with code %d" %
+                                   (proc.returncode,))
+        rss = sum(rss_bytes(proc.pid) for proc in procs)
+        cpu_start = sum(cpu_seconds(proc.pid) for proc in procs)
+        time.sleep(args.idle)
+        cpu = sum(cpu_seconds(proc.pid) for proc in procs) - cpu_start
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+    return rss, cpu / args.idle
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tunnels", type=int, default=20,
+                        help="number of tunnels")
+    parser.add_argument("--pool-size", type=int, default=10,
+                        help="pool size of every tunnel")
+    parser.add_argument("--ttl", type=float, default=30.,
+                        help="pool connection TTL")
+    parser.add_argument("--settle", type=float, default=5.,
+                        help="time given to ptw to fill pools")
+    parser.add_argument("--idle", type=float, default=20.,
+                        help="idle CPU measurement period")
+    parser.add_argument("--upstream-port", type=int, default=58850)
+    parser.add_argument("--listen-port", type=int, default=58860,
+                        help="first listen port")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.tmpdir = tmpdir
+        args.certfile, keyfile = make_cert(tmpdir)
+        ctl, child_ctl = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(args.upstream_port,
+                                               args.certfile,
+                                               keyfile,
+                                               0.,
+                                               child_ctl),
+                                         daemon=True)
+        server.start()
+        ctl.recv()
+        print("%-10s %10s %12s %14s" % ("mode", "processes", "RSS MB",
+                                        "idle CPU %"))
+        for name, launch in (("separate", separate), ("combined", combined)):
+            procs = launch(args)
+            rss, cpu = measure(procs, args)
+            print("%-10s %10d %12.1f %14.2f" % (name, len(procs),
+                                                rss / 2**20, cpu * 100))
+        ctl.send('exit')
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+""" Compares TCP and UNIX domain sockets on client and upstream side of ptw.
+
+Local TLS echo server in a child process listens both on TCP port and
+UNIX socket. For every case ptw is started with filled pool, then clients
+connect one at a time, send one byte and wait for its echo. Reported are
+median and 99th percentile of connect-to-echo latency and CPU time spent
+by ptw per 1000 connections. Linux only: CPU time is read from /proc. """
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import HOST, make_cert, server_context, echo
+from suite import REPO, LAUNCHER, percentile, cpu_seconds
+
+
+CASES = (
+    ("tcp/tcp", False, False),
+    ("unix/tcp", True, False),
+    ("unix/unix", True, True),
+)
+
+
+def _serve(port, path, certfile, keyfile, ctl):
+    async def run():
+        context = server_context(certfile, keyfile)
+        servers = [await asyncio.start_server(echo, HOST, port,
+                                              ssl=context),
+                   await asyncio.start_unix_server(echo, path, ssl=context)]
+        ctl.send('ready')
+        await asyncio.get_event_loop().run_in_executor(None, ctl.recv)
+        for server in servers:
+            server.close()
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def _launch(args, unix_listen, unix_upstream):
+    cmd = [sys.executable, '-c', LAUNCHER, '-v', 'error',
+           '-n', str(args.pool_size), '-T', str(args.ttl),
+           '-C', args.certfile]
+    if unix_listen:
+        cmd.extend(('-a', args.listen_path))
+    else:
+        cmd.extend(('-a', HOST, '-p', str(args.listen_port)))
+    if unix_upstream:
+        cmd.extend(('--tls-servername', HOST, '--', args.upstream_path))
+    else:
+        cmd.extend((HOST, str(args.upstream_port)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.Popen(cmd, env=env)
+
+
+async def _connect(args, unix_listen):
+    if unix_listen:
+        return await asyncio.open_unix_connection(args.listen_path)
+    return await asyncio.open_connection(HOST, args.listen_port)
+
+
+async def _wait_listening(args, unix_listen, timeout=10.):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await _connect(args, unix_listen)
+        except OSError:
+            await asyncio.sleep(.005)
+            continue
+        writer.close()
+        return
+    raise RuntimeError("ptw didn't start listening")
+
+
+async def bench(proc, args, unix_listen):
+    await _wait_listening(args, unix_listen)
+    # let pool refill after probe connection
+    await asyncio.sleep(args.settle)
+    latencies = []
+    cpu_start = cpu_seconds(proc.pid)
+    for _ in range(args.connections):
+        start = time.perf_counter()
+        reader, writer = await _connect(args, unix_listen)
+        try:
+            writer.write(b'x')
+            if not await asyncio.wait_for(reader.read(1), 30.):
+                raise ConnectionError("connection closed by ptw")
+            latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+        await writer.wait_closed()
+    cpu = cpu_seconds(proc.pid) - cpu_start
+    return (percentile(latencies, 50), percentile(latencies, 99),
+            cpu * 1000 / args.connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000,
+                        help="number of sequential client connections")
+    parser.add_argument("--pool-size", type=int, default=20,
+                        help="pool size")
+    parser.add_argument("--ttl", type=float, default=30.,
+                        help="pool connection TTL")
+    parser.add_argument("--settle", type=float, default=2.,
+                        help="time given to ptw to fill pool")
+    parser.add_argument("--upstream-port", type=int, default=58870)
+    parser.add_argument("--listen-port", type=int, default=58871)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.certfile, keyfile = make_cert(tmpdir)
+        args.upstream_path = os.path.join(tmpdir, 'upstream.sock')
+        args.listen_path = os.path.join(tmpdir, 'ptw.sock')
+        ctl, child_ctl = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve,
+                                         args=(args.upstream_port,
+                                               args.upstream_path,
+                                               args.certfile,
+                                               keyfile,
+                                               child_ctl),
+                                         daemon=True)
+        server.start()
+        ctl.recv()
+        loop = asyncio.get_event_loop()
+        print("%-10s %12s %12s %18s" % ("case", "p50 ms", "p99 ms",
+                                        "CPU s/1000 conn"))
+        for name, unix_listen, unix_upstream in CASES:
+            proc = _launch(args, unix_listen, unix_upstream)
+            try:
+                p50, p99, cpu = loop.run_until_complete(
+                    bench(proc, args, unix_listen))
+            finally:
+                proc.send_signal(signal.SIGTERM)
+                try:
+                    proc.wait(10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+            print("%-10s %12.3f %12.3f %18.3f" % (name, p50 * 1000,
+                                                  p99 * 1000, cpu))
+        ctl.send('exit')
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
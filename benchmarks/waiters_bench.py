@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+""" Compares ConnPool waiting queues under sustained pool exhaustion.
+
+Pool connects to local TLS echo server with slow handshakes, so it hands
+out connections slower than clients arrive. Noisy source opens clients
+at high rate, most of them give up after wait timeout. Quiet source
+opens few clients. Reported are wait times and share of served clients
+of quiet source and peak length of queue structure, which includes
+abandoned waiters not cleaned up yet. Previous plain deque is reproduced
+for reference. """
+
+import argparse
+import asyncio
+import collections
+import random
+import tempfile
+import time
+
+from common import (HOST, make_cert, server_context, client_context,
+                    start_tls_server)
+from suite import percentile
+from ptw.connpool import ConnPool
+from ptw.waitqueue import WaitQueue
+
+
+class DequeQueue:
+    """ Waiting queue of ConnPool before WaitQueue: cancelled waiters are
+    dropped only when they are reached by dispatch """
+
+    def __init__(self):
+        self._waiters = collections.deque()
+
+    def __len__(self):
+        return len(self._waiters)
+
+    @property
+    def sources(self):
+        return 0
+
+    def push(self, fut, source=None, priority=0):  # pylint: disable=unused-argument
+        self._waiters.append(fut)
+
+    def pop(self):
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.cancelled():
+                return fut
+        return None
+
+
+CASES = (
+    ("deque", DequeQueue, 0),
+    ("fair", WaitQueue, 0),
+    ("fair+priority", WaitQueue, 1),
+)
+
+
+async def _client(pool, source, priority, args, results):
+    start = time.monotonic()
+    try:
+        _, writer = await asyncio.wait_for(pool.get(source, priority),
+                                           args.wait_timeout)
+    except asyncio.TimeoutError:
+        results.append(None)
+        return
+    results.append(time.monotonic() - start)
+    await asyncio.sleep(args.hold)
+    writer.close()
+
+
+async def _source(pool, source, priority, rate, deadline, args, results):
+    tasks = []
+    while time.monotonic() < deadline:
+        await asyncio.sleep(random.expovariate(rate))
+        tasks.append(asyncio.ensure_future(
+            _client(pool, source, priority, args, results)))
+    await asyncio.gather(*tasks)
+
+
+async def bench(queue_factory, quiet_priority, args):
+    server = await start_tls_server(args.upstream_port,
+                                    server_context(args.certfile,
+                                                   args.keyfile),
+                                    args.handshake_delay)
+    pool = ConnPool(dst_address=HOST,
+                    dst_port=args.upstream_port,
+                    ssl_context=client_context(args.certfile),
+                    size=args.size,
+                    ttl=60.)
+    pool._waiters = queue_factory()  # pylint: disable=protected-access
+    await pool.start()
+    await asyncio.sleep(1.)
+    peak = 0
+
+    async def watch():
+        nonlocal peak
+        while True:
+            peak = max(peak, len(pool._waiters))  # pylint: disable=protected-access
+            await asyncio.sleep(.01)
+
+    watcher = asyncio.ensure_future(watch())
+    noisy, quiet = [], []
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(
+        _source(pool, "10.0.0.1", 0, args.noisy_rate, deadline, args, noisy),
+        _source(pool, "10.0.0.2", quiet_priority, args.quiet_rate, deadline,
+                args, quiet))
+    watcher.cancel()
+    await pool.stop()
+    server.close()
+    await server.wait_closed()
+    served = [wait for wait in quiet if wait is not None]
+    return (len(served) / len(quiet),
+            percentile(served, 50), percentile(served, 99),
+            sum(1 for wait in noisy if wait is not None) / len(noisy),
+            peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=4,
+                        help="pool size")
+    parser.add_argument("--handshake-delay", type=float, default=.05,
+                        help="upstream handshake delay")
+    parser.add_argument("--noisy-rate", type=float, default=500.,
+                        help="noisy source arrival rate per second")
+    parser.add_argument("--quiet-rate", type=float, default=10.,
+                        help="quiet source arrival rate per second")
+    parser.add_argument("--wait-timeout", type=float, default=1.,
+                        help="client pool wait timeout")
+    parser.add_argument("--hold", type=float, default=.01,
+                        help="time client holds connection")
+    parser.add_argument("--duration", type=float, default=10.,
+                        help="test duration in seconds")
+    parser.add_argument("--upstream-port", type=int, default=58880)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        args.certfile, args.keyfile = make_cert(tmpdir)
+        print("%-14s %12s %12s %12s %12s %10s" % ("queue", "quiet served",
+                                                  "quiet p50 ms",
+                                                  "quiet p99 ms",
+                                                  "noisy served",
+                                                  "peak len"))
+        for name, queue_factory, quiet_priority in CASES:
+            served, p50, p99, noisy, peak = loop.run_until_complete(
+                bench(queue_factory, quiet_priority, args))
+            print("%-14s %11.1f%% %12s %12s %11.1f%% %10d" % (
+                name, served * 100,
+                "-" if p50 is None else "%.1f" % (p50 * 1000,),
+                "-" if p99 is None else "%.1f" % (p99 * 1000,),
+                noisy * 100, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,28 +4,61 @@ import asyncio
 import logging
 import ssl
 import signal
+import socket
+import copy
 from functools import partial
 from urllib.parse import urlparse
 
 from .asdnotify import AsyncSystemdNotifier
 
 from .listener import Listener
-from .constants import LogLevel
+from .constants import (LogLevel, RelayEngine, BalancePolicy, ReservePolicy,
+                        BUFSIZE, SMALL_RECORD, HALF_CLOSE_FALLBACK_TIMEOUT)
 from .proxy_protocol import ProxyProtocol, check_proxyprotocol
 from . import utils
 from .connpool import ConnPool
+from .balancer import Balancer
+from .mux import MuxPool
+from .metrics import MetricsServer
+from .tracing import Tracer
+from .accesslog import AccessLog
+from .history import DemandHistory
+from .config import PROCESS_OPTIONS, ConfigError, read_config, section_argv
+from .readiness import announce_ready, StatusReporter
+from .supervisor import Supervisor
+from .timers import close_timers
 
 
-def parse_args():
+def _config_error(message):
+    raise ConfigError(message)
+
+
+def build_parser():
     parser = argparse.ArgumentParser(
-        description="Pooling TLS wrapper",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        description="Pooling TLS wrapper. Arguments may be read from file "
+        "given as @FILE, one or more per line. SIGHUP rereads such files and "
+        "certificates and applies new TLS and pool options",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        fromfile_prefix_chars='@')
+    parser.convert_arg_line_to_args = utils.config_line_args
 
     parser.add_argument("dst_address",
-                        help="target hostname")
+                        nargs="?",
+                        help="target hostname or UNIX socket path. Path "
+                        "is told from hostname by slash in it")
     parser.add_argument("dst_port",
+                        nargs="?",
                         type=utils.check_port,
-                        help="target port")
+                        help="target port. Not used with UNIX socket")
+    parser.add_argument("--config",
+                        metavar="FILE",
+                        help="serve tunnels defined in this file instead of "
+                        "single one given by command line. Every section "
+                        "of file defines a tunnel by long options without "
+                        "leading dashes and their values, including "
+                        "dst-address and dst-port. Options of DEFAULT "
+                        "section apply to all tunnels. Options in command "
+                        "line apply to whole process")
     parser.add_argument("-v", "--verbosity",
                         help="logging verbosity",
                         type=utils.check_loglevel,
@@ -34,43 +67,276 @@ def parse_args():
     parser.add_argument("-l", "--logfile",
                         help="log file location",
                         metavar="FILE")
+    parser.add_argument("--access-log",
+                        metavar="FILE",
+                        help="write JSON record with duration, pool wait "
+                        "and byte counts of every finished client connection "
+                        "to this file. \"-\" means standard output")
     parser.add_argument("--disable-uvloop",
                         help="do not use uvloop even if it is available",
                         action="store_true")
+    parser.add_argument("--workers",
+                        default=1,
+                        type=utils.check_positive_int,
+                        help="number of worker processes. Each worker binds "
+                        "listen port with SO_REUSEPORT and maintains its own "
+                        "share of connection pool")
+
+    parser.add_argument("--metrics-address",
+                        default="127.0.0.1",
+                        help="bind address of metrics HTTP endpoint")
+    parser.add_argument("--metrics-port",
+                        type=utils.check_port,
+                        help="serve metrics in Prometheus text format on this "
+                        "port. Worker processes use consecutive ports "
+                        "starting from this one")
+
+    trace_group = parser.add_argument_group('tracing options')
+    trace_group.add_argument("--trace-sample",
+                             default=0.,
+                             type=utils.check_ratio,
+                             metavar="RATIO",
+                             help="share of client connections to trace "
+                             "through accept, pool wait, proxy-protocol "
+                             "prologue and first upstream byte. Slow ones "
+                             "are logged as JSON records")
+    trace_group.add_argument("--trace-slow",
+                             default=.5,
+                             type=utils.check_positive_float,
+                             help="report traced connections which took "
+                             "longer than this many seconds to reach last "
+                             "phase. SIGUSR1 dumps listener and pool state "
+                             "regardless of tracing")
+
+    systemd_group = parser.add_argument_group('service manager options')
+    systemd_group.add_argument("--ready-fill",
+                               default=0.,
+                               type=utils.check_ratio,
+                               metavar="RATIO",
+                               help="report readiness to systemd only after "
+                               "this share of pool is ready to be handed out")
+    systemd_group.add_argument("--ready-timeout",
+                               default=30,
+                               type=utils.check_positive_float,
+                               help="report readiness after this many seconds "
+                               "even if pool did not reach --ready-fill")
+    systemd_group.add_argument("--status-interval",
+                               default=10,
+                               type=utils.check_positive_float,
+                               help="interval of status updates with pool "
+                               "fill and throughput sent to systemd")
 
     listen_group = parser.add_argument_group('listen options')
     listen_group.add_argument("-a", "--bind-address",
                               default="127.0.0.1",
-                              help="bind address")
+                              help="bind address or UNIX socket path. "
+                              "Ignored if listen socket is passed by systemd "
+                              "socket activation")
     listen_group.add_argument("-p", "--bind-port",
                               default=57800,
                               type=utils.check_port,
                               help="bind port")
+    listen_group.add_argument("--bind-mode",
+                              type=utils.check_file_mode,
+                              metavar="MODE",
+                              help="octal permissions of UNIX listen socket, "
+                              "e.g. 660. Defaults to umask")
     listen_group.add_argument("-W", "--pool-wait-timeout",
                               default=15,
                               type=utils.check_positive_float,
                               help="timeout for pool await state of client "
                               "connection")
+    listen_group.add_argument("--idle-timeout",
+                              type=utils.check_positive_float,
+                              metavar="SECONDS",
+                              help="close client connection which passed no "
+                              "data in either direction for this time. "
+                              "Disabled by default")
+    listen_group.add_argument("--half-close-timeout",
+                              type=utils.check_positive_float,
+                              metavar="SECONDS",
+                              help="close client connection which passed no "
+                              "data for this time after one side has "
+                              "finished sending. By default only relay "
+                              "which couldn't pass EOF to other side is "
+                              "closed, after %.0f seconds" %
+                              (HALF_CLOSE_FALLBACK_TIMEOUT,))
+    listen_group.add_argument("--priority-network",
+                              action="append",
+                              type=utils.check_priority_network,
+                              metavar="NETWORK=CLASS",
+                              help="priority class of clients from network "
+                              "when waiting for connection from exhausted "
+                              "pool. Higher class is served first, default "
+                              "class is 0. First matching network applies. "
+                              "Can be specified multiple times")
     listen_group.add_argument("-P", "--proxy-protocol",
                               default=ProxyProtocol.none,
                               choices=ProxyProtocol,
                               type=check_proxyprotocol,
                               help="transparent mode: prepend all connections"
                               " with proxy-protocol data")
+    listen_group.add_argument("--proxy-protocol-id",
+                              action="store_true",
+                              help="pass unique connection ID to upstream in "
+                              "proxy-protocol v2 TLV. It is also logged to "
+                              "access log")
+    listen_group.add_argument("--prologue-delay",
+                              default=0.,
+                              type=float,
+                              metavar="SECONDS",
+                              help="wait this long for first client data to "
+                              "send it together with proxy-protocol prologue "
+                              "in single TLS record. Delays prologue of "
+                              "protocols where server speaks first. 0 sends "
+                              "prologue as soon as upstream connection is "
+                              "ready")
+    listen_group.add_argument("-R", "--relay-engine",
+                              default=RelayEngine.stream,
+                              choices=RelayEngine,
+                              type=utils.check_relay_engine,
+                              help="data relay implementation: stream "
+                              "reader/writer pumps, buffered protocols "
+                              "paired directly with each other or splice(2) "
+                              "between sockets for kernel TLS upstream "
+                              "connections. Splice falls back to protocols "
+                              "when upstream connection uses user space TLS")
+    listen_group.add_argument("--record-min",
+                              default=SMALL_RECORD,
+                              type=utils.check_positive_int,
+                              help="initial size of relay reads and TLS "
+                              "records made of them. Size doubles while "
+                              "transfer fills records and returns to initial "
+                              "one after idle second")
+    listen_group.add_argument("--record-max",
+                              default=BUFSIZE,
+                              type=utils.check_positive_int,
+                              help="maximal size of relay reads")
+    listen_group.add_argument("--coalesce-delay",
+                              default=0,
+                              type=float,
+                              metavar="SECONDS",
+                              help="hold relayed data smaller than current "
+                              "record size for up to this time to send it "
+                              "together with following data. Applies to "
+                              "protocol relay engine. 0 disables coalescing")
+    listen_group.add_argument("--write-high-water",
+                              type=utils.check_positive_int,
+                              metavar="BYTES",
+                              help="pause reading from relay side when "
+                              "opposite side has this much data buffered. "
+                              "Defaults to event loop setting")
+    listen_group.add_argument("--write-low-water",
+                              type=utils.check_positive_int,
+                              metavar="BYTES",
+                              help="resume reading once buffered data drops "
+                              "below this size")
 
     pool_group = parser.add_argument_group('pool options')
     pool_group.add_argument("-n", "--pool-size",
                             default=25,
                             type=utils.check_positive_int,
-                            help="connection pool size")
+                            help="connection pool size. Initial size in "
+                            "adaptive mode")
+    pool_group.add_argument("--pool-min",
+                            default=1,
+                            type=utils.check_positive_int,
+                            help="minimal pool size in adaptive mode")
+    pool_group.add_argument("--pool-max",
+                            type=utils.check_positive_int,
+                            help="enable adaptive pool sizing driven by "
+                            "client arrival rate and handshake time, "
+                            "limited by this maximal pool size")
+    pool_group.add_argument("--pool-history",
+                            metavar="FILE",
+                            help="keep daily profile of demand in this state "
+                            "file and grow adaptive pool ahead of recurring "
+                            "peaks. In worker mode every worker uses own "
+                            "file with worker number suffix")
+    pool_group.add_argument("--prewarm-ahead",
+                            default=900,
+                            type=utils.check_positive_float,
+                            metavar="SECONDS",
+                            help="size pool for highest demand expected "
+                            "within this time according to pool history")
+    pool_group.add_argument("-U", "--upstream",
+                            action="append",
+                            type=utils.check_endpoint,
+                            metavar="HOST:PORT[@WEIGHT]",
+                            help="additional upstream endpoint. Pool size "
+                            "is split between upstreams according to their "
+                            "weights. Can be specified multiple times")
+    pool_group.add_argument("--balance",
+                            default=BalancePolicy.latency,
+                            choices=BalancePolicy,
+                            type=utils.check_balance_policy,
+                            help="policy of upstream choice: least handshake "
+                            "time, weighted round robin or power of two "
+                            "choices")
+    pool_group.add_argument("--mux",
+                            type=utils.check_positive_int,
+                            metavar="CONNECTIONS",
+                            help="multiplex client connections as streams "
+                            "over this many upstream connections. Upstream "
+                            "has to run ptw-demux")
+    pool_group.add_argument("--mux-streams",
+                            default=256,
+                            type=utils.check_positive_int,
+                            help="maximal number of streams per multiplexed "
+                            "upstream connection")
     pool_group.add_argument("-B", "--backoff",
                             default=5,
                             type=utils.check_positive_float,
-                            help="delay after connection attempt failure in seconds")
+                            help="delay after connection attempt failure in "
+                            "seconds. Doubles with every failure in a row, "
+                            "randomized to spread retries")
+    pool_group.add_argument("--backoff-max",
+                            default=60,
+                            type=utils.check_positive_float,
+                            help="maximal delay between connection attempts "
+                            "in seconds")
+    pool_group.add_argument("--max-handshakes",
+                            default=10,
+                            type=utils.check_positive_int,
+                            help="limit of concurrent connection attempts "
+                            "per upstream")
+    pool_group.add_argument("--breaker-threshold",
+                            default=3,
+                            type=utils.check_positive_int,
+                            help="number of failures in a row which suspends "
+                            "connection attempts until single probe "
+                            "connection succeeds")
     pool_group.add_argument("-T", "--ttl",
                             default=30,
                             type=utils.check_positive_float,
                             help="lifetime of idle pool connection in seconds")
+    pool_group.add_argument("--ttl-jitter",
+                            default=.1,
+                            type=utils.check_ratio,
+                            help="shorten lifetime of every idle connection "
+                            "by random share of TTL up to this ratio")
+    pool_group.add_argument("--no-ttl-stagger",
+                            action="store_true",
+                            help="do not spread expirations of connections "
+                            "built together over TTL")
+    pool_group.add_argument("--reserve-policy",
+                            default=ReservePolicy.lifo,
+                            choices=ReservePolicy,
+                            type=utils.check_reserve_policy,
+                            help="which idle connection to hand out first: "
+                            "most recently built one or the oldest one")
+    pool_group.add_argument("--dns-ttl",
+                            default=30,
+                            type=utils.check_positive_float,
+                            help="cache upstream addresses for this many "
+                            "seconds. Expired addresses are used while they "
+                            "are refreshed in background")
+    pool_group.add_argument("--happy-eyeballs-delay",
+                            default=.25,
+                            type=utils.check_positive_float,
+                            help="delay before connection attempt to next "
+                            "upstream address if previous one did not "
+                            "complete yet")
     pool_group.add_argument("-w", "--timeout",
                             default=4,
                             type=utils.check_positive_float,
@@ -84,6 +350,16 @@ def parse_args():
     tls_group.add_argument("-C", "--cafile",
                            help="override default CA certs "
                            "by set specified in file")
+    tls_group.add_argument("--ktls",
+                           action="store_true",
+                           help="hand TLS encryption of upstream connections "
+                           "to Linux kernel after handshake. Requires Python "
+                           "3.12+ and tls kernel module. Best combined with "
+                           "splice relay engine")
+    tls_group.add_argument("--no-session-resumption",
+                           action="store_true",
+                           help="do not resume TLS sessions of previous "
+                           "upstream connections")
     ssl_name_group=tls_group.add_mutually_exclusive_group()
     ssl_name_group.add_argument("--no-hostname-check",
                                 action="store_true",
@@ -94,69 +370,446 @@ def parse_args():
                                 type=utils.check_ssl_hostname,
                                 help="specifies hostname to expect in server "
                                 "TLS certificate")
-    return parser.parse_args()
+    return parser
 
 
-async def amain(args, loop):  # pragma: no cover
-    logger = logging.getLogger('MAIN')
+def check_args(parser, args):
+    if args.dst_address is None:
+        parser.error("the following arguments are required: dst_address, "
+                     "dst_port")
+    if utils.is_unix_path(args.dst_address):
+        if not (args.tls_servername or args.no_hostname_check):
+            parser.error("UNIX socket upstream requires --tls-servername or "
+                         "--no-hostname-check")
+    elif args.dst_port is None:
+        parser.error("the following arguments are required: dst_port")
+    if utils.is_unix_path(args.bind_address) and args.workers > 1:
+        parser.error("--workers can't share UNIX listen socket")
+    if args.record_min > args.record_max:
+        parser.error("--record-min can't be greater than --record-max")
+    if args.proxy_protocol_id and args.proxy_protocol is not ProxyProtocol.v2:
+        parser.error("--proxy-protocol-id requires proxy-protocol v2")
+    if args.prologue_delay < 0:
+        parser.error("--prologue-delay can't be negative")
+    if args.coalesce_delay < 0:
+        parser.error("--coalesce-delay can't be negative")
+    if (args.write_high_water is not None and
+            args.write_low_water is not None and
+            args.write_low_water > args.write_high_water):
+        parser.error("--write-low-water can't be greater than "
+                     "--write-high-water")
+    if args.no_hostname_check and not args.cafile:
+        parser.error("--no-hostname-check requires --cafile")
+    if args.pool_max is not None and args.pool_max < args.pool_min:
+        parser.error("--pool-max can't be less than --pool-min")
+    if args.pool_history is not None and args.pool_max is None:
+        parser.error("--pool-history requires adaptive mode (--pool-max)")
+    if args.workers > 1 and not utils.reuse_port_supported():
+        parser.error("--workers requires fork() and SO_REUSEPORT support")
 
-    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+
+def load_tunnels(parser, args):
+    """ Parses options of tunnels defined in config file. Returns list of
+    tunnel names and their options, which also carry process-wide options
+    of args. """
+    defaults = vars(parser.parse_args([]))
+    for name, default in defaults.items():
+        if name not in PROCESS_OPTIONS and getattr(args, name) != default:
+            parser.error("--%s is a tunnel option and has to be set in "
+                         "config file" % (name.replace('_', '-'),))
+    try:
+        sections = read_config(args.config)
+    except ConfigError as exc:
+        parser.error(str(exc))
+    tunnels = []
+    error = parser.error
+    for name, section in sections:
+        try:
+            argv = section_argv(parser, name, section)
+        except ConfigError as exc:
+            error(str(exc))
+        parser.error = partial(_tunnel_error, error, name)
+        try:
+            tunnel_args = parser.parse_args(argv)
+            tunnel_args.tunnels = None
+            for option in PROCESS_OPTIONS:
+                setattr(tunnel_args, option, getattr(args, option))
+            check_args(parser, tunnel_args)
+        finally:
+            parser.error = error
+        tunnels.append((name, tunnel_args))
+    return tunnels
+
+
+def _tunnel_error(error, name, message):
+    error("tunnel %s: %s" % (name, message))
+
+
+def parse_args(on_error=None):
+    parser = build_parser()
+    if on_error is not None:
+        parser.error = on_error
+    args = parser.parse_args()
+    args.tunnels = None
+    if args.config is None:
+        check_args(parser, args)
+    elif args.dst_address is not None:
+        parser.error("dst_address and dst_port can't be used with --config")
+    else:
+        args.tunnels = load_tunnels(parser, args)
+    return args
+
+
+# options applied by reload
+RELOADABLE = frozenset((
+    'cafile', 'cert', 'key', 'no_hostname_check', 'tls_servername',
+    'no_session_resumption', 'ktls', 'timeout', 'backoff', 'backoff_max',
+    'max_handshakes', 'breaker_threshold', 'ttl', 'ttl_jitter',
+    'no_ttl_stagger', 'reserve_policy', 'pool_size', 'pool_min', 'pool_max',
+    'dns_ttl', 'happy_eyeballs_delay', 'prewarm_ahead', 'pool_wait_timeout',
+    'priority_network', 'idle_timeout', 'half_close_timeout',
+))
+
+
+def make_ssl_context(args, cache=None):
+    """ Returns TLS context for upstream connections and expected server
+    hostname override. Tunnels with the same TLS files share context
+    through cache. """
     ssl_hostname = None
-    if args.cafile:
-        context.load_verify_locations(cafile=args.cafile)
     if args.no_hostname_check:
-        if not args.cafile:
-            logger.fatal("CAfile option is required when hostname check "
-                         "is disabled. Terminating program.")
-            sys.exit(2)
         ssl_hostname = ''
     elif args.tls_servername:
         ssl_hostname = args.tls_servername
+    # kTLS is enabled by pool through context options
+    key = (args.cafile, args.cert, args.key, args.ktls)
+    if cache is not None and key in cache:
+        return cache[key], ssl_hostname
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    if args.cafile:
+        context.load_verify_locations(cafile=args.cafile)
     if args.cert:
         context.load_cert_chain(certfile=args.cert, keyfile=args.key)
+    if cache is not None:
+        cache[key] = context
+    return context, ssl_hostname
+
+
+def pool_params(args, context, ssl_hostname, share):
+    """ Settings of ConnPool which gets given share of total pool size """
+    def part(value):
+        return max(1, round(value * share))
+    return dict(ssl_context=context,
+                ssl_hostname=ssl_hostname,
+                timeout=args.timeout,
+                backoff=args.backoff,
+                backoff_max=max(args.backoff, args.backoff_max),
+                max_handshakes=args.max_handshakes,
+                breaker_threshold=args.breaker_threshold,
+                ttl=args.ttl,
+                ttl_jitter=args.ttl_jitter,
+                stagger=not args.no_ttl_stagger,
+                policy=args.reserve_policy,
+                size=part(args.pool_size),
+                min_size=part(args.pool_min),
+                max_size=(None if args.pool_max is None
+                          else part(args.pool_max)),
+                session_cache=not args.no_session_resumption,
+                ktls=args.ktls,
+                dns_ttl=args.dns_ttl,
+                happy_eyeballs_delay=args.happy_eyeballs_delay,
+                prewarm=args.prewarm_ahead)
+
+
+def reload_args(args):
+    """ Parses command line again, rereading argument and config files.
+    Raises ConfigError if arguments are invalid. """
+    new_args = parse_args(on_error=_config_error)
+    new_args.listen_sockets = args.listen_sockets
+    new_args.worker = args.worker
+    if args.worker is not None:
+        new_args = worker_share(new_args, args.worker)
+    return new_args
+
+
+def changed_options(old, new, ignore=()):
+    """ Names of options which differ and are not in ignore set """
+    return ["--" + name.replace('_', '-')
+            for name, value in sorted(vars(new).items())
+            if name not in ignore and value != getattr(old, name, None)]
+
+
+def tunnel_list(args):
+    """ Pairs of tunnel name and options. Single tunnel defined by command
+    line has no name. """
+    return args.tunnels if args.tunnels is not None else [(None, args)]
+
+
+class Tunnel:
+    """ Listener with its upstream pools, built from options of one
+    tunnel """
+
+    def __init__(self, name, args, *,
+                 contexts,
+                 sock=None,
+                 history=None,
+                 access_log=None,
+                 tracer=None,
+                 loop):
+        self.name = name
+        self.args = args
+        context, ssl_hostname = make_ssl_context(args, contexts)
+        proxy_protocol = None
+        if args.proxy_protocol is ProxyProtocol.v2:
+            proxy_protocol = args.proxy_protocol.value(
+                unique_id=args.proxy_protocol_id)
+        elif args.proxy_protocol.value:
+            proxy_protocol = args.proxy_protocol.value()
+        upstreams = [(args.dst_address, args.dst_port, 1)]
+        if args.upstream:
+            upstreams.extend(args.upstream)
+        total_weight = sum(weight for _, _, weight in upstreams)
+
+        # upstream pools and their shares of total pool size
+        self.pools = []
+
+        def make_pool(host, port, weight):
+            share = weight / total_weight
+            address = utils.endpoint(host, port)
+            label = address if name is None else "%s/%s" % (name, address)
+            pool = ConnPool(dst_address=host,
+                            dst_port=port,
+                            history=history,
+                            label=label,
+                            name=(label if name is not None or
+                                  len(upstreams) > 1 else None),
+                            loop=loop,
+                            **pool_params(args, context, ssl_hostname,
+                                          share))
+            self.pools.append((pool, share))
+            return pool
+
+        if len(upstreams) == 1:
+            pool = make_pool(*upstreams[0])
+        else:
+            pool = Balancer([(make_pool(host, port, weight), weight)
+                             for host, port, weight in upstreams],
+                            policy=args.balance,
+                            loop=loop)
+        if args.mux is not None:
+            pool = MuxPool(pool,
+                           sessions=args.mux,
+                           max_streams=args.mux_streams,
+                           label=(name if name is not None
+                                  else utils.endpoint(args.bind_address,
+                                                      args.bind_port)),
+                           loop=loop)
+        self.pool = pool
+        self.listener = Listener(
+            listen_address=args.bind_address,
+            listen_port=args.bind_port,
+            timeout=args.pool_wait_timeout,
+            pool=pool,
+            proxy_protocol=proxy_protocol,
+            prologue_delay=args.prologue_delay,
+            relay_engine=args.relay_engine,
+            reuse_port=args.workers > 1,
+            tracer=tracer,
+            access_log=access_log,
+            record_min=args.record_min,
+            record_max=args.record_max,
+            coalesce_delay=args.coalesce_delay,
+            write_limits=(None if args.write_high_water is None and
+                          args.write_low_water is None
+                          else (args.write_high_water,
+                                args.write_low_water)),
+            sock=sock,
+            unix_mode=args.bind_mode,
+            priorities=args.priority_network,
+            idle_timeout=args.idle_timeout,
+            half_close_timeout=args.half_close_timeout,
+            loop=loop)
+
+    async def start(self):
+        await self.pool.start()
+        await self.listener.start()
+
+    async def stop(self):
+        await self.listener.stop()
+        await self.pool.stop()
+
+    def reconfigure(self, args, contexts):
+        """ Applies reloadable options and returns names of changed ones
+        which require restart """
+        context, ssl_hostname = make_ssl_context(args, contexts)
+        for pool, share in self.pools:
+            pool.reconfigure(**pool_params(args, context, ssl_hostname,
+                                           share))
+        self.listener.reconfigure(
+            timeout=args.pool_wait_timeout,
+            priorities=args.priority_network,
+            idle_timeout=args.idle_timeout,
+            half_close_timeout=args.half_close_timeout)
+        fixed = changed_options(self.args, args,
+                                RELOADABLE | PROCESS_OPTIONS |
+                                {'listen_sockets', 'worker', 'tunnels'})
+        self.args = args
+        return fixed
 
 
-    proxy_protocol = args.proxy_protocol.value() if args.proxy_protocol.value else None
-    pool = ConnPool(dst_address=args.dst_address,
-                    dst_port=args.dst_port,
-                    ssl_context=context,
-                    ssl_hostname=ssl_hostname,
-                    timeout=args.timeout,
-                    backoff=args.backoff,
-                    ttl=args.ttl,
-                    size=args.pool_size,
+def inherited_socket(sockets, args, single):
+    """ Picks socket passed by systemd for tunnel. Single tunnel takes
+    first socket, tunnels from config file take socket bound to their
+    listen address. """
+    if single:
+        return sockets[0] if sockets else None
+    for sock in sockets:
+        if sock.family == getattr(socket, 'AF_UNIX', None):
+            if sock.getsockname() == args.bind_address:
+                return sock
+        elif sock.getsockname()[:2] == (args.bind_address, args.bind_port):
+            return sock
+    return None
+
+
+async def amain(args, loop):  # pragma: no cover
+    logger = logging.getLogger('MAIN')
+
+    history = None
+    if args.pool_history is not None:
+        history = DemandHistory(args.pool_history, loop=loop)
+        await history.start()
+    access_log = None
+    if args.access_log is not None:
+        access_log = AccessLog(args.access_log, loop=loop)
+        await access_log.start()
+    tracer = Tracer(sample_rate=args.trace_sample,
+                    slow_threshold=args.trace_slow,
                     loop=loop)
-    await pool.start()
-    server = Listener(listen_address=args.bind_address,
-                      listen_port=args.bind_port,
-                      timeout=args.pool_wait_timeout,
-                      pool=pool,
-                      proxy_protocol=proxy_protocol,
-                      loop=loop)
-    await server.start()
+    if args.tunnels is None and len(args.listen_sockets) > 1:
+        logger.warning("Got %d sockets from systemd, using only first "
+                       "one.", len(args.listen_sockets))
+    # identical TLS contexts are shared between tunnels
+    contexts = {}
+    tunnels = []
+    for name, tunnel_args in tunnel_list(args):
+        tunnels.append(Tunnel(name, tunnel_args,
+                              contexts=contexts,
+                              sock=inherited_socket(args.listen_sockets,
+                                                    tunnel_args,
+                                                    args.tunnels is None),
+                              history=history,
+                              access_log=access_log,
+                              tracer=tracer,
+                              loop=loop))
+    await asyncio.gather(*(tunnel.start() for tunnel in tunnels))
+    listeners = [tunnel.listener for tunnel in tunnels]
+    pools = [tunnel.pool for tunnel in tunnels]
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(address=args.metrics_address,
+                                       port=args.metrics_port,
+                                       loop=loop)
+        await metrics_server.start()
     logger.info("Server started.")
 
+    def reload():
+        nonlocal args
+        logger.info("Reloading configuration...")
+        contexts = {}
+        try:
+            new_args = reload_args(args)
+            # load all TLS files before applying anything
+            new_tunnels = dict(tunnel_list(new_args))
+            for tunnel_args in new_tunnels.values():
+                make_ssl_context(tunnel_args, contexts)
+        except ConfigError as exc:
+            logger.error("Invalid configuration, keeping current one: %s",
+                         str(exc))
+            return
+        except (OSError, ssl.SSLError) as exc:
+            logger.error("Unable to load TLS files, keeping current "
+                         "configuration: %s", str(exc))
+            return
+        if new_args.tunnels is None:
+            fixed = changed_options(args, new_args, RELOADABLE)
+        else:
+            # options of tunnels are compared by tunnels themselves
+            fixed = changed_options(args, new_args,
+                                    set(vars(new_args)) - PROCESS_OPTIONS)
+        for tunnel in tunnels:
+            tunnel_args = new_tunnels.get(tunnel.name)
+            if tunnel_args is None:
+                fixed.append("tunnel %s removal" % (tunnel.name,))
+                continue
+            tunnel_fixed = tunnel.reconfigure(tunnel_args, contexts)
+            if tunnel.name is not None:
+                fixed.extend("%s of tunnel %s" % (option, tunnel.name)
+                             for option in tunnel_fixed)
+        fixed.extend("tunnel %s addition" % (name,) for name in new_tunnels
+                     if name not in {tunnel.name for tunnel in tunnels})
+        if fixed:
+            logger.warning("Changes of %s require restart and were not "
+                           "applied.", ", ".join(fixed))
+        args = new_args
+        logger.info("Configuration reloaded.")
+
+    def dump():
+        for tunnel in tunnels:
+            tracer.dump(tunnel.listener, tunnel.pool)
+
     exit_event = asyncio.Event()
     async with utils.Heartbeat():
         sig_handler = partial(utils.exit_handler, exit_event)
         signal.signal(signal.SIGTERM, sig_handler)
         signal.signal(signal.SIGINT, sig_handler)
+        # handled within event loop: state must not change while dumped
+        loop.add_signal_handler(signal.SIGUSR1, dump)
+        loop.add_signal_handler(signal.SIGHUP, reload)
         async with AsyncSystemdNotifier() as notifier:
-            await notifier.notify(b"READY=1")
+            status = StatusReporter(notifier, listeners, pools,
+                                    interval=args.status_interval,
+                                    loop=loop)
+            await status.start()
+            if args.ready_fill:
+                await status.notify("Warming up connection pool")
+            if not await announce_ready(notifier, pools, args.ready_fill,
+                                        args.ready_timeout,
+                                        abort=exit_event,
+                                        loop=loop):
+                logger.warning("Pool is not filled up to %.0f%% in %.1f "
+                               "seconds, reporting readiness anyway.",
+                               args.ready_fill * 100, args.ready_timeout)
+            await status.notify()
             await exit_event.wait()
 
             logger.debug("Eventloop interrupted. Shutting down server...")
+            await status.stop()
             await notifier.notify(b"STOPPING=1")
-    await server.stop()
-    await pool.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await asyncio.gather(*(tunnel.stop() for tunnel in tunnels))
+    if history is not None:
+        await history.stop()
+    if access_log is not None:
+        await access_log.stop()
+    close_timers(loop)
 
 
-def main():  # pragma: no cover
-    args = parse_args()
+def run(args):  # pragma: no cover
     with utils.AsyncLoggingHandler(args.logfile) as log_handler:
         logger = utils.setup_logger('MAIN', args.verbosity, log_handler)
         utils.setup_logger('Listener', args.verbosity, log_handler)
         utils.setup_logger('ConnPool', args.verbosity, log_handler)
+        utils.setup_logger('Resolver', args.verbosity, log_handler)
+        utils.setup_logger('DemandHistory', args.verbosity, log_handler)
+        utils.setup_logger('Relay', args.verbosity, log_handler)
+        utils.setup_logger('Balancer', args.verbosity, log_handler)
+        utils.setup_logger('CircuitBreaker', args.verbosity, log_handler)
+        utils.setup_logger('MetricsServer', args.verbosity, log_handler)
+        utils.setup_logger('MuxPool', args.verbosity, log_handler)
+        utils.setup_logger('MuxSession', args.verbosity, log_handler)
+        utils.setup_logger('Tracer', args.verbosity, log_handler)
+        utils.setup_logger('AccessLog', args.verbosity, log_handler)
 
         logger.info("Starting eventloop...")
         if not args.disable_uvloop:
@@ -172,3 +825,47 @@ def main():  # pragma: no cover
         loop.run_until_complete(amain(args, loop))
         loop.close()
         logger.info("Server finished its work.")
+
+
+def worker_share(args, idx):
+    """ Returns arguments of idx-th worker with its share of pool size and
+    own metrics port and history file """
+    worker_args = copy.copy(args)
+    worker_args.worker = idx
+    worker_args.pool_size = max(1, utils.share(args.pool_size,
+                                               args.workers, idx))
+    if args.metrics_port is not None:
+        worker_args.metrics_port = args.metrics_port + idx
+    worker_args.pool_min = max(1, utils.share(args.pool_min,
+                                              args.workers, idx))
+    worker_args.max_handshakes = max(1, utils.share(args.max_handshakes,
+                                                    args.workers, idx))
+    if args.pool_history is not None:
+        worker_args.pool_history = "%s.%d" % (args.pool_history, idx)
+    if args.pool_max is not None:
+        worker_args.pool_max = max(worker_args.pool_min,
+                                   utils.share(args.pool_max,
+                                               args.workers, idx))
+    if args.tunnels is not None:
+        worker_args.tunnels = [(name, worker_share(tunnel_args, idx))
+                               for name, tunnel_args in args.tunnels]
+    return worker_args
+
+
+def run_worker(args, idx):  # pragma: no cover
+    run(worker_share(args, idx))
+
+
+def main():  # pragma: no cover
+    args = parse_args()
+    # taken before fork: workers share inherited sockets
+    args.listen_sockets = utils.systemd_sockets()
+    args.worker = None
+    if args.workers == 1:
+        run(args)
+        return
+    # Supervisor forks workers, so it logs synchronously instead of
+    # running logging thread.
+    utils.setup_logger('Supervisor', args.verbosity,
+                       utils.sync_log_handler(args.logfile))
+    sys.exit(Supervisor(args.workers, partial(run_worker, args)).run())
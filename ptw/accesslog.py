@@ -0,0 +1,103 @@
+import asyncio
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+from .utils import LOG_DROPPED
+
+
+RECORD = ('{"ts":%.3f,"listener":"%s","client":"%s","status":"%s",'
+          '"wait":%.3f,"duration":%.3f,"up":%d,"down":%d%s}\n')
+
+
+class AccessLog:
+    """ Writes one JSON line per finished client connection. Records are
+    formatted in event loop and handed to writer thread in batches, so the
+    loop does neither file I/O nor locking per connection. """
+
+    def __init__(self, filename, *,
+                 batch=256,
+                 flush_interval=1.,
+                 maxsize=64,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._filename = filename
+        self._batch = batch
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._queue = queue.Queue(maxsize)
+        self._out = None
+        self._thread = None
+        self._flusher = None
+        self.dropped = 0
+        LOG_DROPPED.labels("access").set_function(lambda: self.dropped)
+
+    def record(self, listener, peer, status, wait, duration, up, down,
+               conn_id=None):
+        if peer is None:
+            client = ""
+        elif not isinstance(peer, tuple):
+            # UNIX socket client: bound path if any
+            client = (json.dumps(peer)[1:-1]
+                      if isinstance(peer, str) and peer else "unix")
+        elif ':' in peer[0]:
+            client = "[%s]:%d" % (peer[0], peer[1])
+        else:
+            client = "%s:%d" % (peer[0], peer[1])
+        extra = "" if conn_id is None else ',"id":"%s"' % (conn_id.hex(),)
+        self._pending.append(RECORD % (time.time(), listener, client, status,
+                                       wait, duration, up, down, extra))
+        if len(self._pending) >= self._batch:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            self._queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped += len(batch)
+
+    def _writer(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            try:
+                self._out.write("".join(batch).encode())
+                self._out.flush()
+            except OSError as exc:
+                self._logger.error("Access log write failed: %s", str(exc))
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            self._flush()
+
+    async def start(self):
+        # whole batch goes in single append, so worker processes may share
+        # log file
+        self._out = (sys.stdout.buffer if self._filename == '-'
+                     else open(self._filename, 'ab', buffering=0))
+        self._thread = threading.Thread(target=self._writer,
+                                        name="access-log",
+                                        daemon=True)
+        self._thread.start()
+        self._flusher = self._loop.create_task(self._flush_periodically())
+
+    async def stop(self):
+        self._flusher.cancel()
+        await asyncio.gather(self._flusher, return_exceptions=True)
+        self._flush()
+        await self._loop.run_in_executor(None, self._queue.put, None)
+        await self._loop.run_in_executor(None, self._thread.join)
+        if self._out is not sys.stdout.buffer:
+            self._out.close()
+        if self.dropped:
+            self._logger.warning("%d access log records were dropped.",
+                                 self.dropped)
@@ -0,0 +1,107 @@
+import math
+
+
+class EWMA:
+    def __init__(self, alpha):
+        self._alpha = alpha
+        self.value = None
+
+    def update(self, sample):
+        if self.value is None:
+            self.value = sample
+        else:
+            self.value += self._alpha * (sample - self.value)
+        return self.value
+
+
+class PoolSizer:
+    """ Estimates number of connection builders required to keep idle
+    reserve ahead of demand.
+
+    While connection is being handed out, builder which owned it spends
+    handshake time T building replacement. With arrival rate L there are
+    L*T builders busy with handshakes on average, and idle reserve should
+    cover L*T arrivals expected during refill plus z standard deviations of
+    Poisson burst. Clients which had to wait for connection indicate burst
+    reserve failed to cover, so their peak count is added to current size.
+    """
+
+    def __init__(self, min_size, max_size, *,
+                 interval=1.,
+                 alpha=.3,
+                 z=2.,
+                 shrink_delay=30.):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interval = interval
+        self._z = z
+        self._shrink_delay = shrink_delay
+        self._rate = EWMA(alpha)
+        self._handshake = EWMA(alpha)
+        self._shrink_since = None
+
+    @property
+    def rate(self):
+        return self._rate.value or 0.
+
+    @property
+    def handshake_time(self):
+        return self._handshake.value
+
+    def record_handshake(self, duration):
+        self._handshake.update(duration)
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.max_size, size))
+
+    def _required(self, rate):
+        handshake_time = self.handshake_time
+        if handshake_time is None:
+            busy = 0.
+        else:
+            busy = rate * handshake_time
+        return math.ceil(2 * busy + self._z * math.sqrt(busy))
+
+    def estimate(self, waiters, current, forecast=None):
+        target = self._required(self.rate)
+        if waiters:
+            target = max(target, current + waiters)
+        if forecast is not None:
+            # clients which waited at this time of day before show how much
+            # reserve derived from rate alone fell short during ramp-up
+            rate, expected_waiters = forecast
+            target = max(target,
+                         self._required(rate) + round(expected_waiters))
+        return self.clamp(target)
+
+    def update(self, arrivals, waiters, current, now, forecast=None):
+        """ Accounts arrivals and peak waiters count over last interval and
+        returns pair of new size and human readable reason of change.
+        Reason is None if size is unchanged. Optional forecast is pair of
+        expected arrival rate and peak waiters for the time ahead. """
+        self._rate.update(arrivals / self.interval)
+        target = self.estimate(waiters, current, forecast)
+        handshake_time = self.handshake_time
+        stats = ("arrival rate %.2f/s, handshake time %s, peak waiters %d" %
+                 (self.rate,
+                  "n/a" if handshake_time is None
+                  else "%.3fs" % handshake_time,
+                  waiters))
+        if forecast is not None:
+            stats += ", expected rate %.2f/s, expected waiters %.1f" % forecast
+        if target > current:
+            self._shrink_since = None
+            return target, "demand exceeds reserve (%s)" % stats
+        if target < current:
+            if self._shrink_since is None:
+                self._shrink_since = now
+            elif now - self._shrink_since >= self._shrink_delay:
+                # shrink by half of surplus at once: bursts seen before
+                # are forgotten gradually
+                self._shrink_since = now
+                return (current - (current - target + 1) // 2,
+                        "reserve exceeded demand for %d seconds (%s)" %
+                        (self._shrink_delay, stats))
+        else:
+            self._shrink_since = None
+        return current, None
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import random
+
+from .timers import get_timers
+
+
+class Backoff:
+    """ Exponential backoff with jitter. Delay doubles with every failure
+    in a row up to cap, then random half of it is shaved off, so builders
+    which failed together don't retry together. """
+
+    def __init__(self, base, cap=None, *, jitter=.5):
+        self._base = base
+        self._cap = cap if cap is not None else base
+        self._jitter = jitter
+
+    def delay(self, streak):
+        """ Delay before next attempt after streak failures in a row """
+        delay = min(self._cap, self._base * 2 ** max(0, min(streak - 1, 32)))
+        return delay * (1 - self._jitter * random.random())
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+PROBING = "probing"
+
+
+class CircuitBreaker:
+    """ Stops connection attempts to upstream after threshold failures in a
+    row. Once backoff is over, single probe attempt is admitted. Its success
+    closes circuit for everyone, failure opens it again for longer. """
+
+    def __init__(self, *, backoff, threshold=3, name=None, loop=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        if name is not None:
+            self._logger = self._logger.getChild(name)
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._timers = get_timers(self._loop)
+        self.backoff = backoff
+        self.threshold = threshold
+        self._state = CLOSED
+        self._streak = 0
+        self._trips = 0
+        self._timer = None
+        self._waiters = set()
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def streak(self):
+        """ Number of consecutive failed attempts """
+        return self._streak
+
+    @property
+    def open(self):
+        return self._state != CLOSED
+
+    def _set_state(self, state):
+        self._state = state
+        waiters, self._waiters = self._waiters, set()
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+    async def admit(self):
+        """ Waits until connection attempt is allowed """
+        while self._state != CLOSED:
+            if self._state == HALF_OPEN:
+                self._state = PROBING
+                self._logger.info("Probing upstream.")
+                return
+            fut = self._loop.create_future()
+            self._waiters.add(fut)
+            try:
+                await fut
+            finally:
+                self._waiters.discard(fut)
+
+    def success(self):
+        self._streak = 0
+        self._trips = 0
+        if self._state != CLOSED:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._logger.warning("Upstream is back. Circuit closed.")
+            self._set_state(CLOSED)
+
+    def failure(self):
+        """ Accounts failed attempt. Returns backoff delay for attempts
+        which are still allowed, None if circuit is open now. """
+        self._streak += 1
+        if self._state == OPEN or self._state == HALF_OPEN:
+            # attempt started before circuit opened
+            return None
+        if self._state == PROBING or self._streak >= self.threshold:
+            self._trips += 1
+            delay = self.backoff.delay(self._trips)
+            self._logger.warning("Circuit opened after %d failures in a row. "
+                                 "Next probe in %.1f seconds.",
+                                 self._streak, delay)
+            self._set_state(OPEN)
+            self._timer = self._timers.call_later(delay, self._half_open)
+            return None
+        return self.backoff.delay(self._streak)
+
+    def _half_open(self):
+        self._timer = None
+        self._set_state(HALF_OPEN)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._set_state(CLOSED)
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import random
+
+from .constants import BalancePolicy
+
+
+class Backend:
+    def __init__(self, pool, weight=1):
+        self.pool = pool
+        self.weight = weight
+        self.healthy = True
+        self.recovered_at = None
+        self.current_weight = 0
+
+    def admission(self, now, slow_start):
+        """ Share of traffic allowed to backend which is recovering after
+        failure """
+        if self.recovered_at is None:
+            return 1.
+        ratio = (now - self.recovered_at) / slow_start
+        if ratio >= 1.:
+            self.recovered_at = None
+            return 1.
+        return ratio
+
+    def score(self):
+        """ Lower is better """
+        handshake_time = self.pool.handshake_time
+        return (handshake_time or 0.) / self.weight
+
+
+class Balancer:
+    """ Spreads connection requests over several upstream pools. Has the
+    same interface as ConnPool. """
+
+    def __init__(self, backends, *,
+                 policy=BalancePolicy.latency,
+                 fail_threshold=3,
+                 slow_start=30.,
+                 loop=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._backends = [Backend(pool, weight) for pool, weight in backends]
+        self._fail_threshold = fail_threshold
+        self._slow_start = slow_start
+        self._pick = {
+            BalancePolicy.latency: self._pick_latency,
+            BalancePolicy.wrr: self._pick_wrr,
+            BalancePolicy.p2c: self._pick_p2c,
+        }[policy]
+
+    async def start(self):
+        await asyncio.gather(*(b.pool.start() for b in self._backends))
+
+    async def stop(self):
+        await asyncio.gather(*(b.pool.stop() for b in self._backends))
+
+    @property
+    def idle(self):
+        return sum(b.pool.idle for b in self._backends)
+
+    @property
+    def size(self):
+        return sum(b.pool.size for b in self._backends)
+
+    def snapshot(self):
+        """ Returns JSON-serializable state of upstream pools """
+        upstreams = []
+        for backend in self._backends:
+            state = backend.pool.snapshot()
+            state["healthy"] = backend.healthy
+            upstreams.append(state)
+        return {"upstreams": upstreams}
+
+    def _refresh_health(self, now):
+        for backend in self._backends:
+            failures = backend.pool.failures
+            if backend.healthy and failures >= self._fail_threshold:
+                backend.healthy = False
+                backend.recovered_at = None
+                self._logger.warning("Draining upstream %s after %d "
+                                     "consecutive connection failures.",
+                                     backend.pool.address, failures)
+            elif not backend.healthy and not failures:
+                backend.healthy = True
+                backend.recovered_at = now
+                self._logger.warning("Upstream %s recovered. Readmitting it "
+                                     "gradually over %d seconds.",
+                                     backend.pool.address, self._slow_start)
+
+    @staticmethod
+    def _pick_latency(candidates):
+        return min(candidates, key=lambda b: (b.score(), -b.pool.idle))
+
+    @staticmethod
+    def _pick_wrr(candidates):
+        # smooth weighted round robin
+        total = 0
+        best = None
+        for backend in candidates:
+            backend.current_weight += backend.weight
+            total += backend.weight
+            if best is None or backend.current_weight > best.current_weight:
+                best = backend
+        best.current_weight -= total
+        return best
+
+    @staticmethod
+    def _pick_p2c(candidates):
+        if len(candidates) < 2:
+            return candidates[0]
+        first, second = random.sample(candidates, 2)
+        return first if first.score() <= second.score() else second
+
+    async def get(self, source=None, priority=0):
+        now = self._loop.time()
+        self._refresh_health(now)
+        healthy = [b for b in self._backends
+                   if b.healthy and
+                   random.random() < b.admission(now, self._slow_start)]
+        if not healthy:
+            healthy = ([b for b in self._backends if b.healthy] or
+                       self._backends)
+        ready = [b for b in healthy if b.pool.idle]
+        if not ready:
+            # have to wait: prefer upstreams which are not failing now
+            ready = [b for b in healthy if not b.pool.failures] or healthy
+        backend = self._pick(ready)
+        return await backend.pool.get(source, priority)
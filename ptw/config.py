@@ -0,0 +1,73 @@
+import argparse
+import configparser
+
+
+# options which apply to whole process, not to single tunnel
+PROCESS_OPTIONS = frozenset((
+    'verbosity', 'logfile', 'access_log', 'disable_uvloop', 'workers',
+    'metrics_address', 'metrics_port', 'trace_sample', 'trace_slow',
+    'ready_fill', 'ready_timeout', 'status_interval', 'pool_history',
+    'config',
+))
+
+POSITIONALS = ('dst_address', 'dst_port')
+
+
+class ConfigError(Exception):
+    pass
+
+
+def read_config(filename):
+    """ Reads tunnels config file. Returns list of pairs of tunnel name and
+    its options section. Options of DEFAULT section apply to every
+    tunnel. """
+    config = configparser.ConfigParser(interpolation=None)
+    try:
+        with open(filename) as f:
+            config.read_file(f)
+    except (OSError, configparser.Error) as exc:
+        raise ConfigError("unable to read %s: %s" % (filename, exc))
+    if not config.sections():
+        raise ConfigError("no tunnels defined in %s" % (filename,))
+    return [(name, config[name]) for name in config.sections()]
+
+
+def section_argv(parser, name, section):
+    """ Converts tunnel section to command line arguments. Keys are long
+    option names without leading dashes, flags take boolean values and
+    repeatable options take whitespace separated list. """
+    actions = {action.dest: action for action in parser._actions}  # pylint: disable=protected-access
+    argv = []
+    positionals = {}
+    for key in section:
+        dest = key.replace('-', '_')
+        action = actions.get(dest)
+        if action is None or isinstance(action, argparse._HelpAction):  # pylint: disable=protected-access
+            raise ConfigError("unknown option \"%s\" in tunnel %s" %
+                              (key, name))
+        if dest in PROCESS_OPTIONS:
+            raise ConfigError("option \"%s\" in tunnel %s applies to whole "
+                              "process and can be set only in command line" %
+                              (key, name))
+        value = section[key]
+        if dest in POSITIONALS:
+            positionals[dest] = value
+            continue
+        option = max(action.option_strings, key=len)
+        if isinstance(action, argparse._StoreTrueAction):  # pylint: disable=protected-access
+            try:
+                enabled = section.getboolean(key)
+            except ValueError:
+                raise ConfigError("option \"%s\" in tunnel %s takes boolean "
+                                  "value" % (key, name))
+            if enabled:
+                argv.append(option)
+        elif isinstance(action, argparse._AppendAction):  # pylint: disable=protected-access
+            for item in value.split():
+                argv.extend((option, item))
+        else:
+            argv.extend((option, value))
+    argv.append("--")
+    argv.extend(positionals[dest] for dest in POSITIONALS
+                if dest in positionals)
+    return argv
@@ -1,22 +1,69 @@
 import asyncio
 import logging
 import collections
-from functools import partial
+import random
+import socket
+import ssl
+import time
 
-from .constants import BUFSIZE
-from .utils import wall_clock_sleep
+from .constants import ReservePolicy
+from .utils import wall_clock_sleep, is_unix_path, endpoint
+from .idle import PooledConn
+from .timers import get_timers
+from .backoff import Backoff, CircuitBreaker
+from .autoscale import PoolSizer, EWMA
+from .sessioncache import SessionCache, install_session_hook
+from .resolver import Resolver, staggered_connect
+from .waitqueue import WaitQueue
+from . import ktls
+from . import metrics
 
 
-class InappropriateRead(Exception):
-    pass
+GET_WAIT = metrics.REGISTRY.histogram(
+    "ptw_pool_get_wait_seconds",
+    "Time spent by clients waiting for pooled connection",
+    ("upstream",), buckets=metrics.LATENCY_BUCKETS)
+IDLE = metrics.REGISTRY.gauge(
+    "ptw_pool_idle_connections",
+    "Connections in pool reserve",
+    ("upstream",))
+WAITERS = metrics.REGISTRY.gauge(
+    "ptw_pool_waiters",
+    "Clients waiting for connection from exhausted pool",
+    ("upstream",))
+HANDSHAKE = metrics.REGISTRY.histogram(
+    "ptw_pool_handshake_seconds",
+    "Duration of successful upstream connection setup",
+    ("upstream",), buckets=metrics.LATENCY_BUCKETS)
+HANDSHAKES = metrics.REGISTRY.counter(
+    "ptw_pool_handshakes_total",
+    "Upstream connection attempts by result",
+    ("upstream", "result"))
+EXPIRED_TOTAL = metrics.REGISTRY.counter(
+    "ptw_pool_expired_total",
+    "Idle connections closed due to TTL expiration",
+    ("upstream",))
+CORRUPTED_TOTAL = metrics.REGISTRY.counter(
+    "ptw_pool_corrupted_total",
+    "Idle connections which received unexpected data or EOF",
+    ("upstream",))
+CIRCUIT_OPEN = metrics.REGISTRY.gauge(
+    "ptw_pool_circuit_open",
+    "Whether connection attempts are suspended after repeated failures",
+    ("upstream",))
+STALE_TOTAL = metrics.REGISTRY.counter(
+    "ptw_pool_stale_handouts_total",
+    "Pooled connections found closed when being handed out",
+    ("upstream",))
+RESUMPTIONS = metrics.REGISTRY.counter(
+    "ptw_pool_tls_resumptions_total",
+    "Offered TLS sessions by resumption result",
+    ("upstream", "result"))
 
 
-class SuccessError(Exception):
-    pass
-
-
-class TTLExpired(Exception):
-    pass
+TAKEN = "taken"
+EXPIRED = "expired"
+CORRUPTED = "corrupted"
 
 
 class ConnPool:
@@ -27,159 +74,550 @@ class ConnPool:
                  ssl_hostname=None,
                  timeout=5,
                  backoff=5,
+                 backoff_max=None,
+                 max_handshakes=None,
+                 breaker_threshold=3,
                  ttl=30,
+                 ttl_jitter=.1,
+                 stagger=True,
+                 policy=ReservePolicy.lifo,
                  size=10,
+                 min_size=None,
+                 max_size=None,
+                 history=None,
+                 prewarm=900.,
+                 session_cache=True,
+                 ktls=False,
+                 dns_ttl=30.,
+                 happy_eyeballs_delay=.25,
+                 label=None,
+                 name=None,
                  loop=None):
         self._logger = logging.getLogger(self.__class__.__name__)
+        if name is not None:
+            self._logger = self._logger.getChild(name)
         self._loop = loop if loop is not None else asyncio.get_event_loop()
         self._dst_address = dst_address
         self._dst_port = dst_port
+        # identifies pool in metrics and demand history
+        self._label = label if label is not None else self.address
         self._ssl_context = ssl_context
-        self._ssl_hostname = ssl_hostname
+        self._server_hostname = None
+        if ssl_context:
+            self._server_hostname = (dst_address if ssl_hostname is None
+                                     else ssl_hostname)
+        self._unix = is_unix_path(dst_address)
+        self._resolver = (None if self._unix
+                          else Resolver(dst_address, dst_port, ttl=dns_ttl,
+                                        loop=self._loop))
+        self._happy_eyeballs_delay = happy_eyeballs_delay
         self._timeout = timeout
         self._ttl = ttl
+        self._ttl_jitter = ttl_jitter
+        self._stagger = stagger
+        self._last_deadline = 0.
+        self._lifo = policy is ReservePolicy.lifo
         self._size = size
-        self._backoff = backoff
-        self._waiters = collections.deque()
-        self._reserve = collections.deque()
+        self._backoff = Backoff(backoff, backoff_max)
+        self._breaker = CircuitBreaker(backoff=self._backoff,
+                                       threshold=breaker_threshold,
+                                       name=name,
+                                       loop=self._loop)
+        self._max_handshakes = max_handshakes
+        self._handshake_gate = (asyncio.Semaphore(max_handshakes)
+                                if max_handshakes is not None else None)
+        self._waiters = WaitQueue()
+        self._reserve = collections.OrderedDict()
+        self._timers = get_timers(self._loop)
         self._conn_builders = set()
+        self._retire = 0
+        self._arrivals = 0
+        self._peak_waiters = 0
+        self._handshake_time = EWMA(.3)
+        self._autoscaler = None
+        self._sizer = None
+        self._history = history
+        self._demand = None
+        self._prewarm = prewarm
+        self._session_cache = None
+        if session_cache and install_session_hook(ssl_context):
+            self._session_cache = SessionCache()
+        self._ktls = False
+        self._ktls_tickets = {}
+        if ktls:
+            self._enable_ktls()
+        if max_size is not None:
+            self._sizer = PoolSizer(min_size if min_size is not None else 1,
+                                    max_size)
+            self._size = self._sizer.clamp(size)
+        self._init_metrics()
+
+    def _enable_ktls(self):
+        if not isinstance(self._ssl_context, ssl.SSLContext):
+            reason = "no explicit TLS context"
+        else:
+            reason = ktls.unavailable_reason()
+        if reason is not None:
+            self._logger.warning("Kernel TLS is not available: %s", reason)
+            return
+        ktls.enable(self._ssl_context)
+        self._ktls = True
+        self._ktls_tickets = {}
+
+    def _init_metrics(self):
+        label = self._label
+        self._m_get_wait = GET_WAIT.labels(label)
+        self._m_handshake = HANDSHAKE.labels(label)
+        self._m_success = HANDSHAKES.labels(label, "success")
+        self._m_failure = HANDSHAKES.labels(label, "failure")
+        self._m_timeout = HANDSHAKES.labels(label, "timeout")
+        self._m_expired = EXPIRED_TOTAL.labels(label)
+        self._m_corrupted = CORRUPTED_TOTAL.labels(label)
+        self._m_stale = STALE_TOTAL.labels(label)
+        IDLE.labels(label).set_function(lambda: len(self._reserve))
+        WAITERS.labels(label).set_function(lambda: len(self._waiters))
+        CIRCUIT_OPEN.labels(label).set_function(
+            lambda: int(self._breaker.open))
+        if self._session_cache is not None:
+            self._export_session_cache()
+
+    def _export_session_cache(self):
+        label = self._label
+        cache = self._session_cache
+        RESUMPTIONS.labels(label, "hit").set_function(lambda: cache.hits)
+        RESUMPTIONS.labels(label, "miss").set_function(lambda: cache.misses)
+
+    @property
+    def address(self):
+        return endpoint(self._dst_address, self._dst_port)
+
+    @property
+    def idle(self):
+        """ Number of connections ready to be handed out """
+        return len(self._reserve)
+
+    @property
+    def size(self):
+        """ Target number of idle connections """
+        return self._size
+
+    @property
+    def handshake_time(self):
+        """ Moving average of upstream connection setup time """
+        return self._handshake_time.value
+
+    @property
+    def failures(self):
+        """ Number of consecutive failed connection attempts """
+        return self._breaker.streak
+
+    def snapshot(self):
+        """ Returns JSON-serializable state of pool """
+        now = time.time()
+        return {
+            "upstream": self.address,
+            "size": self._size,
+            "idle_ages": [round(now - conn.parked, 3)
+                          for conn in self._reserve],
+            "waiters": len(self._waiters),
+            "waiting_sources": self._waiters.sources,
+            "builders": len(self._conn_builders),
+            "in_flight": len(self._conn_builders) - len(self._reserve),
+            "retiring": self._retire,
+            "failures": self._breaker.streak,
+            "circuit_open": self._breaker.open,
+        }
+
+    def _spawn_builders(self, count):
+        for _ in range(count):
+            task = self._loop.create_task(self._build_conn())
+            self._conn_builders.add(task)
+            task.add_done_callback(self._conn_builders.discard)
+
+    def _resize(self, size):
+        delta = size - self._size
+        self._size = size
+        if delta > 0:
+            # cancel pending retirements first
+            revoked = min(delta, self._retire)
+            self._retire -= revoked
+            self._spawn_builders(delta - revoked)
+        else:
+            # builders leave as soon as they are done with current
+            # connection, so idle connections are not wasted
+            self._retire -= delta
+
+    async def _autoscale(self):
+        interval = self._sizer.interval
+        while True:
+            await asyncio.sleep(interval)
+            arrivals, self._arrivals = self._arrivals, 0
+            waiters = max(len(self._waiters), self._peak_waiters)
+            self._peak_waiters = 0
+            forecast = None
+            if self._demand is not None:
+                now = time.time()
+                self._demand.record(now, arrivals, waiters, interval)
+                forecast = self._demand.forecast(now, self._prewarm)
+            size, reason = self._sizer.update(arrivals, waiters, self._size,
+                                              self._loop.time(), forecast)
+            if reason is not None:
+                self._logger.info("%s pool from %d to %d connections: %s",
+                                  "Growing" if size > self._size
+                                  else "Shrinking",
+                                  self._size, size, reason)
+                self._resize(size)
+
+    def _restore_demand(self):
+        """ Picks up demand history and sizes pool for demand expected at
+        this time of day """
+        self._demand = self._history.series(self._label)
+        if self._demand.handshake_time is not None:
+            self._sizer.record_handshake(self._demand.handshake_time)
+        forecast = self._demand.forecast(time.time(), self._prewarm)
+        if forecast is None:
+            return
+        size = max(self._size, self._sizer.estimate(0, self._size, forecast))
+        if size > self._size:
+            self._logger.info("Prewarming pool to %d connections for "
+                              "expected rate %.2f/s", size, forecast[0])
+            self._size = size
+
+    def _set_tls(self, ssl_context, ssl_hostname, session_cache, ktls):
+        changed = ssl_context is not self._ssl_context
+        self._ssl_context = ssl_context
+        self._server_hostname = None
+        if ssl_context:
+            self._server_hostname = (self._dst_address if ssl_hostname is None
+                                     else ssl_hostname)
+        if not session_cache or not install_session_hook(ssl_context):
+            self._session_cache = None
+        elif self._session_cache is None:
+            self._session_cache = SessionCache()
+            self._export_session_cache()
+        elif changed:
+            # sessions of previous context can't be resumed with new one
+            self._session_cache.clear()
+        if not ktls:
+            self._ktls = False
+        elif changed or not self._ktls:
+            self._enable_ktls()
+
+    def _set_sizing(self, size, min_size, max_size):
+        if max_size is None:
+            self._sizer = None
+            if self._autoscaler is not None:
+                self._autoscaler.cancel()
+                self._autoscaler = None
+            self._resize(size)
+            return
+        min_size = min_size if min_size is not None else 1
+        if self._sizer is None:
+            # adaptive mode starts from configured size, then follows demand
+            self._sizer = PoolSizer(min_size, max_size)
+            self._resize(self._sizer.clamp(size))
+            self._autoscaler = self._loop.create_task(self._autoscale())
+        else:
+            self._sizer.min_size = min_size
+            self._sizer.max_size = max_size
+            self._resize(self._sizer.clamp(self._size))
+
+    def reconfigure(self, *,
+                    ssl_context,
+                    ssl_hostname,
+                    timeout,
+                    backoff,
+                    backoff_max,
+                    max_handshakes,
+                    breaker_threshold,
+                    ttl,
+                    ttl_jitter,
+                    stagger,
+                    policy,
+                    size,
+                    min_size,
+                    max_size,
+                    session_cache,
+                    ktls,
+                    dns_ttl,
+                    happy_eyeballs_delay,
+                    prewarm):
+        """ Applies new settings to running pool. Connections built from now
+        on use them, connections already in reserve stay there until handed
+        out or expired by TTL they were parked with. """
+        self._set_tls(ssl_context, ssl_hostname, session_cache, ktls)
+        self._timeout = timeout
+        self._backoff = Backoff(backoff, backoff_max)
+        self._breaker.backoff = self._backoff
+        self._breaker.threshold = breaker_threshold
+        if max_handshakes != self._max_handshakes:
+            # handshakes in progress release previous semaphore
+            self._max_handshakes = max_handshakes
+            self._handshake_gate = (asyncio.Semaphore(max_handshakes)
+                                    if max_handshakes is not None else None)
+        self._ttl = ttl
+        self._ttl_jitter = ttl_jitter
+        self._stagger = stagger
+        self._lifo = policy is ReservePolicy.lifo
+        if self._resolver is not None:
+            self._resolver.ttl = dns_ttl
+        self._happy_eyeballs_delay = happy_eyeballs_delay
+        self._prewarm = prewarm
+        self._set_sizing(size, min_size, max_size)
 
     async def start(self):
-        self._conn_builders = set(self._loop.create_task(self._build_conn())
-                                  for _ in range(self._size))
+        if self._history is not None and self._sizer is not None:
+            self._restore_demand()
+        self._spawn_builders(self._size)
+        if self._sizer is not None:
+            self._autoscaler = self._loop.create_task(self._autoscale())
 
     async def stop(self):
+        if self._autoscaler is not None:
+            self._autoscaler.cancel()
+            await asyncio.gather(self._autoscaler, return_exceptions=True)
+            self._autoscaler = None
         while self._conn_builders:
             tasks = list(self._conn_builders)
             self._conn_builders.clear()
             for t in tasks:
                 t.cancel()
             await asyncio.gather(*tasks, return_exceptions=True)
-        for (reader, writer), _ in self._reserve:
-            writer.close()
+        self._breaker.close()
+        if self._resolver is not None:
+            await self._resolver.close()
+        while self._reserve:
+            conn, _ = self._reserve.popitem()
+            conn.timer.cancel()
+            conn.writer.close()
+
+    def _save_session(self, conn):
+        if (self._session_cache is not None and
+                conn[1].get_extra_info('sslcontext') is self._ssl_context):
+            self._session_cache.put(conn[1].get_extra_info('ssl_object'))
+
+    def _drop_session(self, session):
+        if self._session_cache is not None:
+            self._session_cache.discard(session)
+
+    def _deadline(self):
+        """ Expiration time of connection parked now. Lifetime is shortened
+        by random jitter. With staggering, expirations are also spread over
+        TTL evenly, so connections built at once are replaced one by one
+        at steady rate instead of all together every TTL. """
+        now = time.time()
+        deadline = now + self._ttl * (1. - self._ttl_jitter * random.random())
+        if self._stagger:
+            slot = max(now, self._last_deadline) + self._ttl / self._size
+            if slot < deadline:
+                deadline = slot
+            if deadline > self._last_deadline:
+                self._last_deadline = deadline
+        return deadline
+
+    def _park(self, conn):
+        conn.parked = time.time()
+        conn.park(self._corrupted)
+        self._reserve[conn] = None
+        conn.timer = self._timers.call_at(conn.deadline, self._expire, conn)
+
+    def _release(self, conn, reason):
+        """ Removes idle connection from reserve and notifies its builder.
+        Returns False if connection has already left reserve. """
+        try:
+            del self._reserve[conn]
+        except KeyError:
+            return False
+        conn.timer.cancel()
+        if not conn.done.done():
+            conn.done.set_result(reason)
+        return True
+
+    def _expire(self, conn):
+        if self._release(conn, EXPIRED):
+            self._m_expired.inc()
+            self._save_session((conn.reader, conn.writer))
+            conn.writer.close()
+
+    def _corrupted(self, conn, event):
+        if self._release(conn, CORRUPTED):
+            self._logger.debug("Idle upstream connection got %s.", event)
+            self._m_corrupted.inc()
+            # late session ticket, if any, is waited for again
+            self._ktls_tickets.clear()
+            conn.writer.close()
+
+    async def _open_unix_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            await self._loop.sock_connect(sock, self._dst_address)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def _open_socket(self):
+        """ Connects to upstream address which answers first """
+        if self._unix:
+            return await self._open_unix_socket()
+        infos = await self._resolver.resolve()
+        sock, addr = await staggered_connect(
+            infos, self._happy_eyeballs_delay,
+            on_failure=self._resolver.failed,
+            loop=self._loop)
+        self._resolver.succeeded(addr)
+        return sock
+
+    async def _open_connection(self):
+        sock = await self._open_socket()
+        try:
+            return await asyncio.open_connection(
+                sock=sock,
+                ssl=self._ssl_context,
+                server_hostname=self._server_hostname)
+        except BaseException:
+            sock.close()
+            raise
+
+    async def _connect_ktls(self, offered):
+        try:
+            reader, writer, tls = await ktls.open_connection(
+                ssl_context=self._ssl_context,
+                server_hostname=self._server_hostname,
+                session=offered,
+                tickets=self._ktls_tickets,
+                sock=await self._open_socket(),
+                loop=self._loop)
+        except ktls.KTLSUnavailable as exc:
+            if self._ktls:
+                self._ktls = False
+                self._logger.warning("Kernel TLS is not usable, falling back "
+                                     "to user space TLS: %s", str(exc))
+            return None
+        return (reader, writer), tls
+
+    async def _connect(self, offered):
+        """ Returns connection, its TLS object and handshake duration """
+        start = self._loop.time()
+        if self._ktls:
+            res = await asyncio.wait_for(self._connect_ktls(offered),
+                                         self._timeout)
+            if res is not None:
+                return res + (self._loop.time() - start,)
+        conn = await asyncio.wait_for(self._open_connection(), self._timeout)
+        return (conn, conn[1].get_extra_info('ssl_object'),
+                self._loop.time() - start)
+
+    async def _handshake(self, offered):
+        """ Connects to upstream, keeping number of concurrent handshakes
+        within limit """
+        if self._handshake_gate is None:
+            return await self._connect(offered)
+        async with self._handshake_gate:
+            return await self._connect(offered)
 
     async def _build_conn(self):
         async def fail():
-            self._logger.debug("Failed upstream connection. Backoff for %d "
-                               "seconds", self._backoff)
-            await wall_clock_sleep(self._backoff)
+            delay = self._breaker.failure()
+            if delay is not None:
+                self._logger.debug("Failed upstream connection. Backoff for "
+                                   "%.1f seconds", delay)
+                await wall_clock_sleep(delay)
 
         async def fail_corrupted():
+            delay = self._backoff.delay(1)
             self._logger.warning("Upstream connection corrupted. Backoff for"
-                                 " %d seconds", self._backoff)
-            await wall_clock_sleep(self._backoff)
-
-        async def reader_guard(reader):
-            try:
-                await reader.read(1)
-            except asyncio.CancelledError:
-                raise
-            except Exception as exc:
-                self._logger.debug("reader_guard catched exception on "
-                                   "reader.read(): %s", str(exc))
-            raise InappropriateRead()
-
-        async def waiter_guard(event):
-            await event.wait()
-            raise SuccessError()
-
-        async def timeout_guard(timeout):
-            await wall_clock_sleep(timeout)
-            raise TTLExpired()
-
-        async def taker(grabbed, read_task):
-            grabbed.set()
-            if read_task.done():
-                raise InapproptiateRead()
-            else:
-                try:
-                    await read_task
-                except asyncio.CancelledError:
-                    pass
-                else:
-                    raise InappropriateRead()
-
-        def try_remove_from_queue(elem):
-            try:
-                self._reserve.remove(elem)
-            except ValueError:
-                self._logger.debug("Not found expired connection "
-                                   "in reserve. This should not happen.")
-            else:
-                elem[0][1].close()
+                                 " %.1f seconds", delay)
+            await wall_clock_sleep(delay)
 
         while True:
+            if self._retire:
+                self._retire -= 1
+                return
+            offered = None
             try:
                 try:
-                    conn = await asyncio.wait_for(
-                        asyncio.open_connection(self._dst_address,
-                                                self._dst_port,
-                                                ssl=self._ssl_context,
-                                                server_hostname=self._ssl_hostname),
-                        self._timeout)
+                    await self._breaker.admit()
+                    if self._session_cache is not None:
+                        offered = self._session_cache.offer()
+                    conn, tls, handshake_time = await self._handshake(offered)
                 except asyncio.TimeoutError:
                     self._logger.error("Connection to upstream timed out.")
+                    self._m_timeout.inc()
+                    self._drop_session(offered)
                     await fail()
                 except asyncio.CancelledError:
                     raise
                 except Exception as exc:
                     self._logger.exception("Got exception while connecting to upstream: %s", str(exc))
+                    self._m_failure.inc()
+                    self._drop_session(offered)
                     await fail()
                 else:
                     self._logger.debug("Successfully built upstream connection.")
-                    while self._waiters:
-                        fut = self._waiters.popleft()
-                        if not fut.cancelled():
-                            self._logger.warning("Pool exhausted. Dispatching connection directly to waiter!")
-                            fut.set_result(conn)
-                            break
+                    if self._session_cache is not None:
+                        resumed = self._session_cache.handshake_done(offered,
+                                                                     tls)
+                        self._logger.debug("TLS session %s. Resumption "
+                                           "hits/misses: %d/%d",
+                                           "resumed" if resumed else "created",
+                                           self._session_cache.hits,
+                                           self._session_cache.misses)
+                    self._breaker.success()
+                    self._handshake_time.update(handshake_time)
+                    if self._sizer is not None:
+                        self._sizer.record_handshake(handshake_time)
+                    if self._demand is not None:
+                        # persisted to size pool before first handshake
+                        demand = self._demand
+                        demand.handshake_time = self._handshake_time.value
+                    self._m_success.inc()
+                    self._m_handshake.observe(handshake_time)
+                    fut = self._waiters.pop()
+                    if fut is not None:
+                        self._logger.warning("Pool exhausted. Dispatching connection directly to waiter!")
+                        fut.set_result(conn)
                     else:
-                        grabbed = asyncio.Event()
-
-                        read_task = asyncio.ensure_future(reader_guard(conn[0]))
-                        tasks = [
-                            asyncio.ensure_future(waiter_guard(grabbed)),
-                            asyncio.ensure_future(timeout_guard(self._ttl)),
-                            read_task,
-                        ]
-
-                        elem = (conn, partial(taker, grabbed, read_task))
-                        self._reserve.append(elem)
-
-                        try:
-                            await asyncio.gather(*tasks)
-                        except InappropriateRead:
-                            if not grabbed.is_set():
-                                try_remove_from_queue(elem)
+                        pooled = PooledConn(conn[0], conn[1],
+                                            self._deadline(),
+                                            self._loop.create_future())
+                        self._park(pooled)
+                        if await pooled.done == CORRUPTED:
                             await fail_corrupted()
-                        except TTLExpired:
-                            if not grabbed.is_set():
-                                try_remove_from_queue(elem)
-                        except SuccessError:
-                            pass
-                        finally:
-                            for task in tasks:
-                                if not task.done():
-                                    task.cancel()
             except asyncio.CancelledError:
                 raise
             except Exception as exc:
                 self._logger.exception("_build_conn crashed with exception: %s",
                                        str(exc))
-                    
-    async def get(self):
-        while True:
-            if self._reserve:
-                conn, take = self._reserve.popleft()
-                try:
-                    await take()
-                except InappropriateRead:
-                    pass
-                else:
-                    self._logger.debug("Obtained connection from pool.")
-                    return conn
-            else:
-                fut = self._loop.create_future()
-                self._waiters.append(fut)
-                self._logger.debug("Awaiting for free connection.")
-                return await fut
+
+    async def get(self, source=None, priority=0):
+        """ Hands out upstream connection. When pool is exhausted, waiting
+        clients are served by priority class, taking turns between sources
+        within class. """
+        self._arrivals += 1
+        start = self._loop.time()
+        conn = await self._get(source, priority)
+        self._m_get_wait.observe(self._loop.time() - start)
+        return conn
+
+    async def _get(self, source, priority):
+        while self._reserve:
+            # reserve is ordered by parking time: LIFO hands out the
+            # freshest connection, least likely to hit server idle timeout
+            conn, _ = self._reserve.popitem(last=self._lifo)
+            conn.timer.cancel()
+            conn.done.set_result(TAKEN)
+            if conn.writer.transport.is_closing():
+                self._m_stale.inc()
+                continue
+            self._logger.debug("Obtained connection from pool.")
+            conn = conn.unpark()
+            self._save_session(conn)
+            return conn
+        fut = self._loop.create_future()
+        self._waiters.push(fut, source, priority)
+        if len(self._waiters) > self._peak_waiters:
+            self._peak_waiters = len(self._waiters)
+        self._logger.debug("Awaiting for free connection.")
+        return await fut
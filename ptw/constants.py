@@ -1,5 +1,6 @@
 import enum
 import logging
+import os
 
 
 class LogLevel(enum.IntEnum):
@@ -14,6 +15,47 @@ class LogLevel(enum.IntEnum):
         return self.name
 
 
+class RelayEngine(enum.Enum):
+    stream = "stream"
+    protocol = "protocol"
+    splice = "splice"
+
+    def __str__(self):
+        return self.name
+
+
+class BalancePolicy(enum.Enum):
+    latency = "latency"
+    wrr = "wrr"
+    p2c = "p2c"
+
+    def __str__(self):
+        return self.name
+
+
+class ReservePolicy(enum.Enum):
+    lifo = "lifo"
+    fifo = "fifo"
+
+    def __str__(self):
+        return self.name
+
+
 BUFSIZE = 16 * 1024
+# plaintext which fits single TCP segment after TLS record framing
+SMALL_RECORD = 1360
+RECORD_IDLE_RESET = 1.
+# reaps half-closed relay when EOF couldn't be passed to other side
+HALF_CLOSE_FALLBACK_TIMEOUT = 60.
 SO_ORIGINAL_DST = 80
 SOL_IPV6 = 41
+CLOCK_REALTIME = 0
+# defined as file flags by Linux, which differ between architectures
+TFD_NONBLOCK = getattr(os, 'O_NONBLOCK', 0)
+TFD_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+TFD_TIMER_ABSTIME = 1
+TFD_TIMER_CANCEL_ON_SET = 2
+TCP_ULP = 31
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
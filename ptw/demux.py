@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import logging
+import ssl
+import signal
+from functools import partial
+
+from .constants import LogLevel
+from .mux import MuxSession
+from .relay import Relay, RelayBuffer
+from . import metrics
+from . import utils
+
+
+class _PendingBackend(asyncio.Protocol):
+    """ Holds backend data in socket buffer until relay takes over """
+
+    def connection_made(self, transport):
+        transport.pause_reading()
+
+
+class Demux:
+    """ Accepts multiplexed TLS connections from ptw and connects every
+    stream carried by them to backend """
+
+    def __init__(self, *,
+                 listen_address,
+                 listen_port,
+                 ssl_context,
+                 backend_address,
+                 backend_port,
+                 timeout=4,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._listen_address = listen_address
+        self._listen_port = listen_port
+        self._ssl_context = ssl_context
+        self._backend_address = backend_address
+        self._backend_port = backend_port
+        self._timeout = timeout
+        self._relay_buffer = RelayBuffer()
+        self._counters = (metrics.Value(), metrics.Value())
+        self._sessions = set()
+        self._children = set()
+        self._server = None
+
+    def _session_factory(self):
+        session = MuxSession(client=False,
+                             on_open=self._stream_opened,
+                             on_lost=self._sessions.discard,
+                             loop=self._loop)
+        self._sessions.add(session)
+        return session
+
+    def _stream_opened(self, stream):
+        task = self._loop.create_task(self.handler(stream))
+        self._children.add(task)
+        task.add_done_callback(self._children.discard)
+
+    async def handler(self, stream):
+        peer_addr = stream.get_extra_info('peername')
+        self._logger.debug("Stream %d from %s opened", stream.id,
+                           str(peer_addr))
+        try:
+            backend, _ = await asyncio.wait_for(
+                self._loop.create_connection(_PendingBackend,
+                                             self._backend_address,
+                                             self._backend_port),
+                self._timeout)
+        except asyncio.CancelledError:
+            stream.abort()
+            raise
+        except Exception as exc:
+            self._logger.error("Backend connection failed: %s", str(exc))
+            stream.abort()
+            return
+        relay = Relay(buffer=self._relay_buffer,
+                      counters=self._counters,
+                      loop=self._loop)
+        done = relay.attach(stream, backend)
+        backend.resume_reading()
+        try:
+            await done
+        except asyncio.CancelledError:
+            relay.abort()
+            raise
+        finally:
+            self._logger.debug("Stream %d from %s closed", stream.id,
+                               str(peer_addr))
+
+    async def start(self):
+        self._server = await self._loop.create_server(self._session_factory,
+                                                      self._listen_address,
+                                                      self._listen_port,
+                                                      ssl=self._ssl_context)
+        self._logger.info("Server ready.")
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for session in list(self._sessions):
+            session.close()
+        while self._children:
+            children = list(self._children)
+            self._children.clear()
+            for task in children:
+                task.cancel()
+            await asyncio.wait(children)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Demultiplexer of ptw mux connections",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("backend_address",
+                        help="backend hostname")
+    parser.add_argument("backend_port",
+                        type=utils.check_port,
+                        help="backend port")
+    parser.add_argument("-v", "--verbosity",
+                        help="logging verbosity",
+                        type=utils.check_loglevel,
+                        choices=LogLevel,
+                        default=LogLevel.info)
+    parser.add_argument("-l", "--logfile",
+                        help="log file location",
+                        metavar="FILE")
+    parser.add_argument("--disable-uvloop",
+                        help="do not use uvloop even if it is available",
+                        action="store_true")
+
+    listen_group = parser.add_argument_group('listen options')
+    listen_group.add_argument("-a", "--bind-address",
+                              default="0.0.0.0",
+                              help="bind address")
+    listen_group.add_argument("-p", "--bind-port",
+                              default=57801,
+                              type=utils.check_port,
+                              help="bind port")
+    listen_group.add_argument("-w", "--timeout",
+                              default=4,
+                              type=utils.check_positive_float,
+                              help="backend connect timeout")
+
+    tls_group = parser.add_argument_group('TLS options')
+    tls_group.add_argument("-c", "--cert",
+                           required=True,
+                           help="use certificate for server TLS auth")
+    tls_group.add_argument("-k", "--key",
+                           help="key for TLS certificate")
+    tls_group.add_argument("-C", "--cafile",
+                           help="require client certificates signed by "
+                           "these CAs")
+    return parser.parse_args()
+
+
+async def amain(args, loop):  # pragma: no cover
+    logger = logging.getLogger('MAIN')
+
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=args.cert, keyfile=args.key)
+    if args.cafile:
+        context.load_verify_locations(cafile=args.cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+
+    server = Demux(listen_address=args.bind_address,
+                   listen_port=args.bind_port,
+                   ssl_context=context,
+                   backend_address=args.backend_address,
+                   backend_port=args.backend_port,
+                   timeout=args.timeout,
+                   loop=loop)
+    await server.start()
+    logger.info("Server started.")
+
+    exit_event = asyncio.Event()
+    async with utils.Heartbeat():
+        sig_handler = partial(utils.exit_handler, exit_event)
+        signal.signal(signal.SIGTERM, sig_handler)
+        signal.signal(signal.SIGINT, sig_handler)
+        await exit_event.wait()
+        logger.debug("Eventloop interrupted. Shutting down server...")
+    await server.stop()
+
+
+def main():  # pragma: no cover
+    args = parse_args()
+    with utils.AsyncLoggingHandler(args.logfile) as log_handler:
+        logger = utils.setup_logger('MAIN', args.verbosity, log_handler)
+        utils.setup_logger('Demux', args.verbosity, log_handler)
+        utils.setup_logger('MuxSession', args.verbosity, log_handler)
+        utils.setup_logger('Relay', args.verbosity, log_handler)
+
+        logger.info("Starting eventloop...")
+        if not args.disable_uvloop:
+            if utils.enable_uvloop():
+                logger.info("uvloop enabled.")
+            else:
+                logger.info("uvloop is not available. "
+                            "Falling back to built-in event loop.")
+
+        loop = asyncio.get_event_loop()
+        utils.ignore_ssl_error(loop)
+        loop.run_until_complete(amain(args, loop))
+        loop.close()
+        logger.info("Server finished its work.")
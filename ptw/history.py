@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+
+DAY = 86400
+
+
+def time_of_day(now):
+    """ Seconds since local midnight """
+    tm = time.localtime(now)
+    return tm.tm_hour * 3600 + tm.tm_min * 60 + tm.tm_sec
+
+
+class DemandSeries:
+    """ Daily profile of pool demand: get() rate and peak waiters count per
+    time slot of day, each smoothed over days. Current slot accumulates
+    observations and is folded into profile when slot ends. """
+
+    def __init__(self, slot, alpha):
+        self._slot = slot
+        self._alpha = alpha
+        self.slots = [None] * (DAY // slot)
+        self.handshake_time = None
+        self._current = None
+        self._arrivals = 0
+        self._elapsed = 0.
+        self._peak = 0
+
+    def _index(self, now):
+        return time_of_day(now) // self._slot % len(self.slots)
+
+    def _fold(self):
+        if not self._elapsed:
+            return
+        rate = self._arrivals / self._elapsed
+        entry = self.slots[self._current]
+        if entry is None:
+            self.slots[self._current] = [rate, float(self._peak)]
+        else:
+            entry[0] += self._alpha * (rate - entry[0])
+            entry[1] += self._alpha * (self._peak - entry[1])
+
+    def record(self, now, arrivals, waiters, interval):
+        idx = self._index(now)
+        if idx != self._current:
+            self._fold()
+            self._current = idx
+            self._arrivals = 0
+            self._elapsed = 0.
+            self._peak = 0
+        self._arrivals += arrivals
+        self._elapsed += interval
+        self._peak = max(self._peak, waiters)
+
+    def forecast(self, now, lookahead):
+        """ Returns highest expected get() rate and peak waiters over slots
+        from now till now + lookahead, or None if there is no history """
+        first = self._index(now)
+        count = 1 + int(lookahead // self._slot)
+        rate = waiters = None
+        for i in range(first, first + count):
+            entry = self.slots[i % len(self.slots)]
+            if entry is not None:
+                rate = entry[0] if rate is None else max(rate, entry[0])
+                waiters = (entry[1] if waiters is None
+                           else max(waiters, entry[1]))
+        if rate is None:
+            return None
+        return rate, waiters
+
+    def dump(self):
+        # partially observed slot is not stored: its rate would be biased
+        # towards part of slot seen before restart
+        return {
+            "slots": [None if entry is None
+                      else [round(entry[0], 3), round(entry[1], 3)]
+                      for entry in self.slots],
+            "handshake_time": self.handshake_time,
+        }
+
+    def load(self, state):
+        slots = state["slots"]
+        if len(slots) != len(self.slots):
+            raise ValueError("history has %d slots per day, expected %d" %
+                             (len(slots), len(self.slots)))
+        self.slots = [None if entry is None else [float(entry[0]),
+                                                   float(entry[1])]
+                      for entry in slots]
+        self.handshake_time = state.get("handshake_time")
+
+
+class DemandHistory:
+    """ Keeps daily demand profiles of pools in state file, so adaptive
+    pools can grow ahead of recurring peaks even right after restart """
+
+    def __init__(self, filename, *,
+                 slot=900,
+                 alpha=.3,
+                 save_interval=300.,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._filename = filename
+        self._slot = slot
+        self._alpha = alpha
+        self._save_interval = save_interval
+        self._series = {}
+        self._state = {}
+        self._saver = None
+
+    def series(self, key):
+        """ Returns demand profile with given key, restored from state file
+        if it was there """
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = DemandSeries(self._slot, self._alpha)
+            state = self._state.get(key)
+            if state is not None:
+                try:
+                    series.load(state)
+                except (KeyError, TypeError, ValueError) as exc:
+                    self._logger.warning("Ignoring demand history of %s: %s",
+                                         key, str(exc))
+        return series
+
+    def _read(self):
+        try:
+            with open(self._filename) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write(self, state):
+        tmpname = self._filename + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(state, f)
+        os.replace(tmpname, self._filename)
+
+    async def _save(self):
+        # profiles of pools not present anymore are kept
+        state = dict(self._state)
+        for key, series in self._series.items():
+            state[key] = series.dump()
+        try:
+            await self._loop.run_in_executor(None, self._write, state)
+        except OSError as exc:
+            self._logger.error("Unable to save demand history: %s", str(exc))
+
+    async def _save_periodically(self):
+        while True:
+            await asyncio.sleep(self._save_interval)
+            await self._save()
+
+    async def start(self):
+        """ Loads state file. Must complete before series() is called. """
+        try:
+            self._state = await self._loop.run_in_executor(None, self._read)
+        except (OSError, ValueError) as exc:
+            self._logger.warning("Unable to load demand history: %s",
+                                 str(exc))
+        if not isinstance(self._state, dict):
+            self._state = {}
+        self._saver = self._loop.create_task(self._save_periodically())
+
+    async def stop(self):
+        self._saver.cancel()
+        await asyncio.gather(self._saver, return_exceptions=True)
+        await self._save()
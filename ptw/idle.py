@@ -0,0 +1,45 @@
+import asyncio
+
+
+class IdleGuard(asyncio.Protocol):
+    """ Stands in for stream protocol of idle pooled connection. Any data,
+    EOF or connection loss means connection is no longer usable. """
+
+    def __init__(self, conn, callback):
+        self._conn = conn
+        self._callback = callback
+
+    def data_received(self, data):
+        self._callback(self._conn, "unexpected read")
+
+    def eof_received(self):
+        self._callback(self._conn, "EOF")
+
+    def connection_lost(self, exc):
+        self._callback(self._conn, "connection lost")
+
+
+class PooledConn:
+    __slots__ = ('reader', 'writer', 'protocol', 'deadline', 'done', 'timer',
+                 'parked')
+
+    def __init__(self, reader, writer, deadline, done):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = None
+        self.deadline = deadline
+        self.done = done
+        self.timer = None
+        self.parked = None
+
+    def park(self, callback):
+        """ Detaches stream protocol from transport, so connection events
+        are delivered to callback without reader task """
+        transport = self.writer.transport
+        self.protocol = transport.get_protocol()
+        transport.set_protocol(IdleGuard(self, callback))
+
+    def unpark(self):
+        self.writer.transport.set_protocol(self.protocol)
+        return self.reader, self.writer
+
@@ -0,0 +1,234 @@
+import asyncio
+import os
+import socket
+import ssl
+import sys
+
+from . import constants
+
+
+class KTLSUnavailable(Exception):
+    pass
+
+
+_unavailable_reason = False
+
+
+def _probe_ulp():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        with socket.create_connection(listener.getsockname()) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, constants.TCP_ULP, b"tls")
+    finally:
+        listener.close()
+
+
+def unavailable_reason():
+    """ Returns None if kernel TLS can be used, otherwise explanation why
+    it can't """
+    global _unavailable_reason  # pylint: disable=global-statement
+    if _unavailable_reason is not False:
+        return _unavailable_reason
+    reason = None
+    if not sys.platform.startswith('linux'):
+        reason = "kernel TLS is supported only on Linux"
+    elif not hasattr(ssl, 'OP_ENABLE_KTLS'):
+        reason = "ssl module lacks OP_ENABLE_KTLS (Python 3.12+ required)"
+    elif not hasattr(os, 'splice'):
+        reason = "os.splice is not available"
+    else:
+        try:
+            _probe_ulp()
+        except OSError as exc:
+            reason = "tls kernel module is not available: %s" % (exc,)
+    _unavailable_reason = reason
+    return reason
+
+
+def enable(context):
+    """ Makes OpenSSL install keys into kernel for sockets wrapped with
+    context. Connections with memory BIO, like asyncio ones, are not
+    affected. """
+    context.options |= ssl.OP_ENABLE_KTLS  # pylint: disable=no-member
+
+
+def splice_capable(transport):
+    """ Checks if data of transport can be moved by splice: it has to be
+    plain socket transport. Upstream transports are plain only when kernel
+    does TLS for them. """
+    if not hasattr(os, 'splice') or transport.is_closing():
+        return False
+    if transport.get_extra_info('sslcontext') is not None:
+        return False
+    sock = transport.get_extra_info('socket')
+    return sock is not None and sock.type == socket.SOCK_STREAM
+
+
+def is_active(sock):
+    """ Tells if both directions of socket are handled by kernel TLS """
+    for option in (constants.TLS_TX, constants.TLS_RX):
+        try:
+            sock.getsockopt(constants.SOL_TLS, option, 64)
+        except OSError:
+            return False
+    return True
+
+
+async def _wait_fd(loop, fd, writable, timeout=None):
+    fut = loop.create_future()
+
+    def ready():
+        if not fut.done():
+            fut.set_result(True)
+
+    add, remove = ((loop.add_writer, loop.remove_writer) if writable
+                   else (loop.add_reader, loop.remove_reader))
+    add(fd, ready)
+    try:
+        await asyncio.wait_for(fut, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        remove(fd)
+
+
+class TLSInfo:
+    """ Handshake results of connection which no longer has TLS object.
+    Quacks like SSLObject for session cache. """
+
+    __slots__ = ('session', 'session_reused', '_version')
+
+    def __init__(self, ssl_sock):
+        self.session = ssl_sock.session
+        self.session_reused = ssl_sock.session_reused
+        self._version = ssl_sock.version()
+
+    def version(self):
+        return self._version
+
+
+def _session_id(ssl_sock):
+    session = ssl_sock.session
+    if session is None or not session.has_ticket:
+        return None
+    return session.id
+
+
+async def _settle(loop, ssl_sock, timeout, expected=None):
+    """ Lets OpenSSL consume TLS 1.3 post-handshake messages (session
+    tickets), which would break plain reads from kernel TLS socket.
+    Server sends them about one round trip after handshake completes on
+    client side, all in one flight. Socket is watched until new ticket
+    is received or timeout expires, unless expected is False, which
+    means upstream sends no tickets. Returns True if ticket was received. """
+    fd = ssl_sock.fileno()
+    deadline = loop.time() + timeout
+    # every ticket makes new session, identified by ticket hash
+    offered = _session_id(ssl_sock)
+    while True:
+        try:
+            data = ssl_sock.recv(1)
+        except ssl.SSLWantReadError:
+            received = _session_id(ssl_sock) not in (None, offered)
+            if received or expected is False:
+                return received
+            remaining = deadline - loop.time()
+            if (remaining <= 0 or
+                    not await _wait_fd(loop, fd, False, remaining)):
+                return False
+            continue
+        if data:
+            raise ConnectionError("Unexpected data from idle upstream")
+        raise ConnectionError("Upstream closed connection")
+
+
+async def _connect(loop, host, port):
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    exc = None
+    for family, type_, proto, _, addr in infos:
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setblocking(False)
+            await loop.sock_connect(sock, addr)
+            return sock
+        except OSError as err:
+            sock.close()
+            exc = err
+        except BaseException:
+            sock.close()
+            raise
+    raise exc if exc is not None else OSError("No address for %s" % (host,))
+
+
+async def open_connection(host=None, port=None, *,
+                          ssl_context,
+                          server_hostname=None,
+                          session=None,
+                          settle_timeout=.1,
+                          tickets=None,
+                          sock=None,
+                          loop=None):
+    """ Makes TLS connection with keys installed into kernel and returns
+    reader, writer pair of plain socket transport together with TLSInfo.
+    Context has to be prepared with enable(). Already connected
+    non-blocking sock may be passed instead of host and port, then it is
+    closed on failure. Raises KTLSUnavailable if kernel TLS was not
+    enabled for connection. TLS 1.3 connection is handed to kernel only
+    after session tickets are received or settle_timeout expires. Whether
+    upstream sends tickets after full and resumed handshakes is learned
+    into tickets dict, if passed, so connections to upstream which sends
+    none don't wait for timeout. """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    reason = unavailable_reason()
+    if reason is not None:
+        if sock is not None:
+            sock.close()
+        raise KTLSUnavailable(reason)
+    if server_hostname is None:
+        server_hostname = host
+    if sock is None:
+        sock = await _connect(loop, host, port)
+
+    try:
+        ssl_sock = ssl_context.wrap_socket(
+            sock,
+            server_hostname=server_hostname or None,
+            do_handshake_on_connect=False,
+            session=session)
+    except BaseException:
+        sock.close()
+        raise
+    try:
+        while True:
+            try:
+                ssl_sock.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                await _wait_fd(loop, ssl_sock.fileno(), False)
+            except ssl.SSLWantWriteError:
+                await _wait_fd(loop, ssl_sock.fileno(), True)
+        if not is_active(ssl_sock):
+            raise KTLSUnavailable("OpenSSL didn't enable kernel TLS for "
+                                  "cipher %s" % (ssl_sock.cipher()[0],))
+        if ssl_sock.version() == 'TLSv1.3':
+            reused = ssl_sock.session_reused
+            expected = tickets.get(reused) if tickets is not None else None
+            received = await _settle(loop, ssl_sock, settle_timeout,
+                                     expected)
+            if tickets is not None:
+                tickets[reused] = received
+        info = TLSInfo(ssl_sock)
+        raw = socket.socket(fileno=os.dup(ssl_sock.fileno()))
+    finally:
+        # no close_notify: connection lives on in kernel
+        ssl_sock.close()
+    try:
+        raw.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock=raw)
+    except BaseException:
+        raw.close()
+        raise
+    return reader, writer, info
@@ -1,10 +1,50 @@
 import asyncio
 import logging
 import collections
+import ipaddress
+import os
+import socket
+import stat
 from functools import partial
 
-from .constants import BUFSIZE
-from .utils import get_orig_dst
+from .constants import BUFSIZE, SMALL_RECORD, RelayEngine
+from .utils import get_orig_dst, is_unix_path, endpoint
+from .relay import (Relay, RelayBuffer, RecordSizer, SpliceRelay,
+                    IdleMonitor, write_eof)
+from .proxy_protocol import ConnectionIDs
+from .ktls import splice_capable
+from . import metrics
+
+
+ACTIVE = metrics.REGISTRY.gauge(
+    "ptw_listener_active_handlers",
+    "Client connections being handled",
+    ("listener",))
+ACCEPTED = metrics.REGISTRY.counter(
+    "ptw_listener_connections_total",
+    "Accepted client connections",
+    ("listener",))
+RELAYED = metrics.REGISTRY.counter(
+    "ptw_relay_bytes_total",
+    "Bytes relayed from client to upstream and back",
+    ("listener", "direction"))
+REAPED = metrics.REGISTRY.counter(
+    "ptw_relay_reaped_total",
+    "Relays closed after inactivity, by state",
+    ("listener", "reason"))
+
+
+def _first_exception(tasks):
+    """ Retrieves exceptions of all finished tasks, so none of them is
+    reported as never retrieved, and returns the first one """
+    first = None
+    for task in tasks:
+        if task.cancelled():
+            continue
+        exc = task.exception()
+        if first is None:
+            first = exc
+    return first
 
 
 class Listener:  # pylint: disable=too-many-instance-attributes
@@ -14,20 +54,72 @@ class Listener:  # pylint: disable=too-many-instance-attributes
                  pool,
                  timeout=None,
                  proxy_protocol=None,
+                 prologue_delay=0.,
+                 relay_engine=RelayEngine.stream,
+                 reuse_port=False,
+                 tracer=None,
+                 access_log=None,
+                 record_min=SMALL_RECORD,
+                 record_max=BUFSIZE,
+                 coalesce_delay=0.,
+                 write_limits=None,
+                 sock=None,
+                 unix_mode=None,
+                 priorities=None,
+                 idle_timeout=None,
+                 half_close_timeout=None,
                  loop=None):
         self._loop = loop if loop is not None else asyncio.get_event_loop()
         self._logger = logging.getLogger(self.__class__.__name__)
+        if sock is not None and sock.family == getattr(socket, 'AF_UNIX',
+                                                      None):
+            listen_address, listen_port = sock.getsockname(), None
+        elif sock is not None:
+            listen_address, listen_port = sock.getsockname()[:2]
         self._listen_address = listen_address
         self._listen_port = listen_port
-        self._children = set()
+        self._sock = sock
+        self._unix_mode = unix_mode
+        # handler task -> (client writer, accept time, trace)
+        self._children = {}
         self._server = None
         self._timeout = timeout
+        self._priorities = priorities or ()
+        self._idle_timeout = idle_timeout
+        self._half_close_timeout = half_close_timeout
         self._conn_pool = pool
         self._proxy_protocol = proxy_protocol
+        self._prologue_delay = prologue_delay
+        self._conn_ids = ConnectionIDs()
+        self._relay_engine = relay_engine
+        self._record_sizes = (record_min, record_max)
+        self._coalesce_delay = coalesce_delay
+        self._write_limits = write_limits
+        self._relay_buffer = RelayBuffer(record_max)
+        self._reuse_port = reuse_port
+        self._tracer = tracer
+        self._access_log = access_log
+        self._relay = {
+            RelayEngine.stream: self._stream_relay,
+            RelayEngine.protocol: self._protocol_relay,
+            RelayEngine.splice: self._splice_relay,
+        }[relay_engine]
+        self._label = label = endpoint(listen_address, listen_port)
+        self._m_accepted = ACCEPTED.labels(label)
+        self._m_bytes = (RELAYED.labels(label, "upstream"),
+                         RELAYED.labels(label, "downstream"))
+        self._m_reaped = {reason: REAPED.labels(label, reason)
+                          for reason in ("idle", "half_closed")}
+        ACTIVE.labels(label).set_function(lambda: len(self._children))
 
     async def stop(self):
         self._server.close()
         await self._server.wait_closed()
+        if self._sock is None and is_unix_path(self._listen_address):
+            try:
+                os.unlink(self._listen_address)
+            except OSError:
+                pass
         while self._children:
             children = list(self._children)
             self._children.clear()
@@ -40,72 +132,335 @@ class Listener:  # pylint: disable=too-many-instance-attributes
             # after wait_closed() completed
             await asyncio.sleep(.5)
 
-    async def _pump(self, writer, reader):
+    async def _pump(self, writer, reader, counter, stats, idx,
+                    first_byte=None, prefix=None):
+        sizer = RecordSizer(*self._record_sizes)
         while True:
-            data = await reader.read(BUFSIZE)
+            if prefix is None:
+                data = await reader.read(sizer.size)
+            else:
+                try:
+                    data = await asyncio.wait_for(reader.read(sizer.size),
+                                                  self._prologue_delay)
+                except asyncio.TimeoutError:
+                    # silent client: upstream may have to speak first
+                    writer.write(prefix)
+                    prefix = None
+                    continue
             if not data:
+                if prefix is not None:
+                    writer.write(prefix)
                 break
-            writer.write(data)
+            if first_byte is not None:
+                first_byte()
+                first_byte = None
+            nbytes = len(data)
+            counter.inc(nbytes)
+            stats[idx] += nbytes
+            size = sizer.get(self._loop.time())
+            if prefix is not None:
+                # prefix shares TLS record with first client data
+                data = prefix + data
+                size += len(prefix)
+                prefix = None
+            if len(data) > size:
+                # burst after idle period was read with large size: let
+                # its first bytes leave in small record
+                writer.write(data[:size])
+                writer.write(data[size:])
+            else:
+                writer.write(data)
+            sizer.grow(nbytes)
             await writer.drain()
 
-    async def handler(self, reader, writer):
+    async def _stream_relay(self, reader, writer, dst_reader, dst_writer,
+                            stats, monitor, prologue=None, first_byte=None):
+        upstream_counter, downstream_counter = self._m_bytes
+        t1 = asyncio.ensure_future(self._pump(writer, dst_reader,
+                                              downstream_counter, stats, 1,
+                                              first_byte))
+        t2 = asyncio.ensure_future(self._pump(dst_writer, reader,
+                                              upstream_counter, stats, 0,
+                                              prefix=prologue))
+
+        def reap():
+            writer.transport.abort()
+            dst_writer.transport.abort()
+
+        monitor.start(lambda: stats[0] + stats[1], reap)
+        try:
+            done, pending = await asyncio.wait(
+                (t1, t2), return_when=asyncio.FIRST_COMPLETED)
+            exc = _first_exception(done)
+            if exc is None and pending:
+                if t1 in done:
+                    propagated = write_eof(writer.transport)
+                else:
+                    propagated = write_eof(dst_writer.transport)
+                monitor.half_close(propagated)
+                # TLS transport closes on EOF: remaining direction has
+                # nowhere to go
+                if not (writer.transport.is_closing() or
+                        dst_writer.transport.is_closing()):
+                    await asyncio.wait(pending)
+                    exc = _first_exception(pending)
+            if exc is not None:
+                raise exc
+        finally:
+            for t in (t1, t2):
+                if not t.done():
+                    t.cancel()
+                    while not t.done():
+                        try:
+                            await t
+                        except asyncio.CancelledError:
+                            pass
+                        except Exception:  # pylint: disable=broad-except
+                            # failure after cancellation is not reported
+                            pass
+
+    async def _protocol_relay(self, reader, writer, dst_reader, dst_writer,
+                              stats, monitor, prologue=None, first_byte=None):
+        relay = Relay(buffer=self._relay_buffer,
+                      counters=self._m_bytes,
+                      record_sizes=self._record_sizes,
+                      coalesce_delay=self._coalesce_delay,
+                      on_half_close=monitor.half_close,
+                      loop=self._loop)
+        done = relay.attach(writer.transport, dst_writer.transport,
+                            first_byte=first_byte,
+                            prefix=prologue,
+                            prefix_delay=self._prologue_delay)
+        monitor.start(lambda: sum(relay.bytes_received), relay.abort)
+        try:
+            await done
+        except asyncio.CancelledError:
+            relay.abort()
+            raise
+        finally:
+            stats[:] = relay.bytes_received
+
+    async def _splice_relay(self, reader, writer, dst_reader, dst_writer,
+                            stats, monitor, prologue=None, first_byte=None):
+        if prologue is not None:
+            # kernel moves client data: prologue can't join it
+            dst_writer.write(prologue)
+        upstream = dst_writer.transport
+        if not (splice_capable(writer.transport) and
+                splice_capable(upstream) and
+                not upstream.get_write_buffer_size()):
+            # upstream is user space TLS: relay it with protocols
+            return await self._protocol_relay(reader, writer,
+                                              dst_reader, dst_writer,
+                                              stats, monitor, None,
+                                              first_byte)
+        upstream.pause_reading()
+        relay = SpliceRelay(counters=self._m_bytes,
+                            on_half_close=monitor.half_close,
+                            loop=self._loop)
+        done = relay.attach(writer.transport, upstream, first_byte=first_byte)
+        monitor.start(lambda: sum(relay.bytes_received), relay.abort)
+        try:
+            await done
+        finally:
+            stats[:] = relay.bytes_received
+            relay.abort()
+
+    def _classify(self, peer_addr):
+        """ Returns source and priority class of client for pool waiting
+        queue. UNIX socket clients share single source. """
+        if not isinstance(peer_addr, tuple):
+            return None, 0
+        host = peer_addr[0]
+        if self._priorities:
+            addr = ipaddress.ip_address(host.partition('%')[0])
+            if addr.version == 6 and addr.ipv4_mapped is not None:
+                addr = addr.ipv4_mapped
+            for network, priority in self._priorities:
+                if addr in network:
+                    return host, priority
+        return host, 0
+
+    async def handler(self, reader, writer, trace=None):
+        started = self._loop.time()
         peer_addr = writer.transport.get_extra_info('peername')
-        self._logger.info("Client %s connected", str(peer_addr))
+        # arguments are formatted only if record is emitted
+        self._logger.info("Client %s connected", peer_addr)
+        if trace is not None:
+            trace.mark("handler", self._loop.time())
+        prologue = conn_id = None
         if self._proxy_protocol:
             try:
                 sock = writer.transport.get_extra_info('socket')
-                orig_dst = get_orig_dst(sock)
-                prologue = self._proxy_protocol.prologue(peer_addr, orig_dst)
-                self._logger.debug("Client %s orig_dst=%s", str(peer_addr), str(orig_dst))
-                self._logger.debug("Client %s prologue=%s", str(peer_addr), repr(prologue))
+                # UNIX socket clients are reported as unknown origin
+                orig_dst = (get_orig_dst(sock)
+                            if sock.family in (socket.AF_INET,
+                                               socket.AF_INET6)
+                            else None)
+                if self._proxy_protocol.unique_id:
+                    conn_id = self._conn_ids.next()
+                prologue = self._proxy_protocol.prologue(peer_addr, orig_dst,
+                                                         sock.family, conn_id)
+                self._logger.debug("Client %s orig_dst=%s", peer_addr, orig_dst)
+                self._logger.debug("Client %s prologue=%r", peer_addr, prologue)
+                if trace is not None:
+                    trace.mark("prologue", self._loop.time())
             except Exception as exc:
                 self._logger.exception("Unable to handle connection transparency: "
                                    "%s", str(exc))
+                if self._access_log is not None:
+                    self._access_log.record(self._label, peer_addr, "error",
+                                            0., self._loop.time() - started,
+                                            0, 0, conn_id)
                 return
         dst_writer = None
+        first_byte = None
+        status = "ok"
+        wait = 0.
+        stats = [0, 0]
+        monitor = IdleMonitor(idle_timeout=self._idle_timeout,
+                              half_close_timeout=self._half_close_timeout,
+                              loop=self._loop)
         try:
-            dst_reader, dst_writer = await asyncio.wait_for(self._conn_pool.get(),
-                                                            self._timeout)
-            if self._proxy_protocol:
+            source, priority = self._classify(peer_addr)
+            dst_reader, dst_writer = await asyncio.wait_for(
+                self._conn_pool.get(source, priority), self._timeout)
+            wait = self._loop.time() - started
+            if self._write_limits is not None:
+                for transport in (writer.transport, dst_writer.transport):
+                    transport.set_write_buffer_limits(*self._write_limits)
+            if trace is not None:
+                trace.mark("pool_get", self._loop.time())
+                first_byte = trace.first_byte
+            if prologue is not None and not self._prologue_delay:
                 dst_writer.write(prologue)
-            t1 = asyncio.ensure_future(self._pump(writer, dst_reader))
-            t2 = asyncio.ensure_future(self._pump(dst_writer, reader))
-            try:
-                await asyncio.gather(t1, t2)
-            finally:
-                for t in (t1, t2):
-                    if not t.done():
-                        t.cancel()
-                        while not t.done():
-                            try:
-                                await t
-                            except asyncio.CancelledError:
-                                pass
-        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+                prologue = None
+            await self._relay(reader, writer, dst_reader, dst_writer,
+                              stats, monitor, prologue, first_byte)
+        except asyncio.CancelledError:
+            status = "cancelled"
             raise
         except asyncio.TimeoutError:
+            status = "timeout"
             self._logger.error("Dropping client %s due to upstream connection "
                                "wait timed out.", peer_addr)
         except ConnectionResetError:
+            status = "reset"
             self._logger.debug("Dropping client %s due to connection reset.", peer_addr)
         except Exception as exc:  # pragma: no cover
+            status = "error"
             self._logger.exception("Connection handler stopped with exception:"
                                    " %s", str(exc))
         finally:
-            self._logger.info("Client %s disconnected", str(peer_addr))
+            monitor.stop()
+            if monitor.reaped is not None:
+                status = monitor.reaped
+                self._m_reaped[status].inc()
+                self._logger.info("Closed %s relay of client %s",
+                                  "idle" if status == "idle"
+                                  else "half-closed", peer_addr)
+            self._logger.info("Client %s disconnected", peer_addr)
             if dst_writer is not None:
                 dst_writer.close()
             writer.close()
+            if trace is not None:
+                self._tracer.finish(trace, self._label)
+            if self._access_log is not None:
+                self._access_log.record(self._label, peer_addr, status, wait,
+                                        self._loop.time() - started,
+                                        stats[0], stats[1], conn_id)
+
+    def reconfigure(self, *, timeout, priorities=None, idle_timeout=None,
+                    half_close_timeout=None):
+        """ Applies new pool wait timeout, priority classes and relay
+        timeouts to clients accepted from now on """
+        self._timeout = timeout
+        self._priorities = priorities or ()
+        self._idle_timeout = idle_timeout
+        self._half_close_timeout = half_close_timeout
+
+    @property
+    def active(self):
+        """ Number of client connections being handled """
+        return len(self._children)
+
+    @property
+    def accepted(self):
+        """ Number of client connections accepted so far """
+        return self._m_accepted.value
+
+    @property
+    def relayed(self):
+        """ Number of bytes relayed in both directions so far """
+        return self._m_bytes[0].value + self._m_bytes[1].value
+
+    def snapshot(self):
+        """ Returns JSON-serializable state of active client handlers """
+        now = self._loop.time()
+        handlers = []
+        for writer, accepted, trace in self._children.values():
+            handler = {
+                "peer": str(writer.transport.get_extra_info('peername')),
+                "age": round(now - accepted, 3),
+            }
+            if trace is not None:
+                handler["phase"] = trace.phase
+            handlers.append(handler)
+        return {
+            "listener": self._label,
+            "active": len(self._children),
+            "handlers": handlers,
+        }
+
+    def _bind_unix(self):
+        path = self._listen_address
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                # left behind by process which didn't exit cleanly
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # socket file is created with permissions already restricted,
+        # no window for connections before chmod
+        umask = (os.umask(0o777 & ~self._unix_mode)
+                 if self._unix_mode is not None else None)
+        try:
+            sock.bind(path)
+        except BaseException:
+            sock.close()
+            raise
+        finally:
+            if umask is not None:
+                os.umask(umask)
+        return sock
 
     async def start(self):
         def _spawn(reader, writer):
             def task_cb(task, fut):
-                self._children.discard(task)
-            task = self._loop.create_task(self.handler(reader, writer))
-            self._children.add(task)
+                self._children.pop(task, None)
+            if self._relay_engine is not RelayEngine.stream:
+                # Hold incoming data in socket buffer until transport is
+                # handed over to relay
+                writer.transport.pause_reading()
+            self._m_accepted.inc()
+            trace = None
+            if self._tracer is not None:
+                trace = self._tracer.begin(
+                    writer.transport.get_extra_info('peername'))
+            task = self._loop.create_task(self.handler(reader, writer, trace))
+            self._children[task] = (writer, self._loop.time(), trace)
             task.add_done_callback(partial(task_cb, task))
 
-        self._server = await asyncio.start_server(_spawn,
-                                                  self._listen_address,
-                                                  self._listen_port)
+        if self._sock is not None:
+            # socket inherited from service manager
+            self._server = await asyncio.start_server(_spawn, sock=self._sock)
+        elif is_unix_path(self._listen_address):
+            self._server = await asyncio.start_unix_server(
+                _spawn, sock=self._bind_unix())
+        else:
+            self._server = await asyncio.start_server(_spawn,
+                                                      self._listen_address,
+                                                      self._listen_port,
+                                                      reuse_port=self._reuse_port or None)
         self._logger.info("Server ready.")
@@ -0,0 +1,240 @@
+import asyncio
+import bisect
+import logging
+import math
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values))
+    pairs.extend(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value)
+                                       .replace('\\', r'\\')
+                                       .replace('"', r'\"')
+                                       .replace('\n', r'\n'))
+                          for name, value in pairs) + "}"
+
+
+class Value:
+    """ Single counter or gauge sample. Updates are plain attribute
+    arithmetic, cheap enough for hot paths. """
+
+    __slots__ = ('value', '_function')
+
+    def __init__(self):
+        self.value = 0
+        self._function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """ Makes sample report function result at collection time """
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            return self._function()
+        return self.value
+
+
+class HistogramValue:
+    __slots__ = ('_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def _new_child(self):
+        return Value()
+
+    def labels(self, *values):
+        """ Returns sample for given label values. Callers keep returned
+        object to skip lookup on hot paths. """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("Wrong number of labels for metric %s" %
+                                 (self.name,))
+            child = self._new_child()
+            self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        self._children.pop(values, None)
+
+    def _samples(self, values, child):
+        yield self.name + _format_labels(self.labelnames, values), child.get()
+
+    def collect(self):
+        yield "# HELP %s %s" % (self.name, self.documentation)
+        yield "# TYPE %s %s" % (self.name, self.kind)
+        for values, child in list(self._children.items()):
+            for key, value in self._samples(values, child):
+                yield "%s %s" % (key, _format_value(value))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), *, buckets):
+        super().__init__(name, documentation, labelnames)
+        self._bounds = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramValue(self._bounds)
+
+    def _samples(self, values, child):
+        cumulative = 0
+        for bound, count in zip(self._bounds + (math.inf,), child.counts):
+            cumulative += count
+            yield (self.name + "_bucket" +
+                   _format_labels(self.labelnames, values,
+                                  (("le", _format_value(float(bound))),)),
+                   cumulative)
+        labels = _format_labels(self.labelnames, values)
+        yield self.name + "_sum" + labels, child.sum
+        yield self.name + "_count" + labels, child.count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Duplicate metric %s" % (metric.name,))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def expose(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                   .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+class MetricsServer:
+    """ Serves registry contents over HTTP in Prometheus text format """
+
+    def __init__(self, *,
+                 address,
+                 port,
+                 registry=REGISTRY,
+                 timeout=5,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._address = address
+        self._port = port
+        self._registry = registry
+        self._timeout = timeout
+        self._server = None
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+        return request_line.split()
+
+    async def handler(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader),
+                                                 self._timeout)
+            except ValueError as exc:
+                # line longer than StreamReader limit
+                self._logger.debug("Bad metrics request: %s", str(exc))
+                request = None
+            if request is None:
+                status = "400 Bad Request"
+                body = b''
+            elif len(request) >= 2 and request[0] in (b'GET', b'HEAD'):
+                status = "200 OK"
+                body = self._registry.expose().encode('utf-8')
+                if request[0] == b'HEAD':
+                    body = b''
+            else:
+                status = "405 Method Not Allowed"
+                body = b''
+            writer.write(("HTTP/1.0 %s\r\n"
+                          "Content-Type: text/plain; version=0.0.4; "
+                          "charset=utf-8\r\n"
+                          "Content-Length: %d\r\n"
+                          "Connection: close\r\n\r\n" %
+                          (status, len(body))).encode('ascii') + body)
+            await writer.drain()
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except (asyncio.TimeoutError, ConnectionError) as exc:
+            self._logger.debug("Metrics request failed: %s", str(exc))
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self.handler,
+                                                  self._address,
+                                                  self._port)
+        self._logger.info("Metrics server ready.")
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
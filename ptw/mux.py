@@ -0,0 +1,549 @@
+import asyncio
+import collections
+import logging
+import struct
+
+from . import metrics
+
+
+PREFACE = b"PTWMUX/1\n"
+HEADER = struct.Struct('!BIH')
+WINDOW_INCREMENT = struct.Struct('!I')
+
+FRAME_OPEN = 0
+FRAME_DATA = 1
+FRAME_EOF = 2
+FRAME_WINDOW = 3
+FRAME_RESET = 4
+
+# Largest DATA payload. It's also the quantum of round robin between
+# streams sharing one connection.
+MAX_PAYLOAD = 16 * 1024
+INITIAL_WINDOW = 256 * 1024
+WRITE_HIGH_WATER = 64 * 1024
+# stream IDs are 32-bit and never reused within connection
+MAX_STREAM_ID = 2**32 - 1
+
+SESSIONS = metrics.REGISTRY.gauge(
+    "ptw_mux_sessions",
+    "Upstream connections carrying multiplexed streams",
+    ("tunnel",))
+STREAMS = metrics.REGISTRY.gauge(
+    "ptw_mux_streams",
+    "Client streams multiplexed over upstream connections",
+    ("tunnel",))
+
+
+class MuxProtocolError(Exception):
+    pass
+
+
+def _deliver(protocol, data):
+    if not isinstance(protocol, asyncio.BufferedProtocol):
+        protocol.data_received(data)
+        return
+    data = memoryview(data)
+    while data:
+        buf = protocol.get_buffer(len(data))
+        size = min(len(buf), len(data))
+        if not size:
+            raise RuntimeError("get_buffer() returned an empty buffer")
+        buf[:size] = data[:size]
+        protocol.buffer_updated(size)
+        data = data[size:]
+
+
+class MuxStream(asyncio.Transport):  # pylint: disable=too-many-instance-attributes
+    """ Transport of single stream within multiplexed connection. Sender
+    may have at most window bytes in flight: receiver grants more window
+    as its protocol consumes data, so one slow stream does not stall the
+    others sharing the connection. """
+
+    def __init__(self, session, stream_id):
+        super().__init__()
+        self._session = session
+        self.id = stream_id
+        self._protocol = None
+        self._sendbuf = bytearray()
+        self._send_window = INITIAL_WINDOW
+        self._unacked = 0
+        self._recvq = collections.deque()
+        self._reading = True
+        self._write_paused = False
+        self._high_water = WRITE_HIGH_WATER
+        self._low_water = WRITE_HIGH_WATER // 4
+        self._eof_pending = False
+        self._eof_sent = False
+        self._eof_received = False
+        self._closing = False
+        self._closed = False
+
+    # Transport interface
+
+    def get_extra_info(self, name, default=None):
+        # TLS details stay with connection: stream itself is plain and
+        # supports half-close
+        if name in ('peername', 'sockname'):
+            return self._session.get_extra_info(name, default)
+        return super().get_extra_info(name, default)
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def get_protocol(self):
+        return self._protocol
+
+    def is_closing(self):
+        return self._closing or self._closed
+
+    def is_reading(self):
+        return self._reading
+
+    def pause_reading(self):
+        self._reading = False
+
+    def resume_reading(self):
+        if not self._reading:
+            self._reading = True
+            if self._recvq:
+                # like socket transports, deliver data on next iteration
+                self._session.loop.call_soon(self._drain_recvq)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = WRITE_HIGH_WATER if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self._high_water = high
+        self._low_water = low
+
+    def get_write_buffer_size(self):
+        return len(self._sendbuf)
+
+    def write(self, data):
+        if self._closing or self._closed or self._eof_pending or not data:
+            return
+        self._sendbuf += data
+        self._session.activate(self)
+        if not self._write_paused and len(self._sendbuf) > self._high_water:
+            self._write_paused = True
+            self._protocol.pause_writing()
+
+    def writelines(self, list_of_data):
+        for data in list_of_data:
+            self.write(data)
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        if self._closing or self._closed or self._eof_pending:
+            return
+        self._eof_pending = True
+        self._session.activate(self)
+
+    def close(self):
+        """ Flushes pending data and releases stream """
+        if self._closing or self._closed:
+            return
+        self._closing = True
+        self._session.activate(self)
+
+    def abort(self):
+        if self._closed:
+            return
+        self._sendbuf.clear()
+        self._session.send_control(HEADER.pack(FRAME_RESET, self.id, 0))
+        self._finish(None)
+
+    # Session side
+
+    def sendable(self):
+        if self._closed:
+            return False
+        if self._sendbuf:
+            return self._send_window > 0
+        return ((self._eof_pending and not self._eof_sent) or
+                self._closing)
+
+    def take_frames(self, frames):
+        """ Appends frames ready to be sent to list. Returns True if stream
+        still has something to send. """
+        size = min(len(self._sendbuf), self._send_window, MAX_PAYLOAD)
+        if size:
+            frames.append(HEADER.pack(FRAME_DATA, self.id, size) +
+                          bytes(self._sendbuf[:size]))
+            del self._sendbuf[:size]
+            self._send_window -= size
+            if self._write_paused and len(self._sendbuf) <= self._low_water:
+                self._write_paused = False
+                self._protocol.resume_writing()
+        if not self._sendbuf and not self._closed:
+            if self._eof_pending and not self._eof_sent:
+                self._eof_sent = True
+                frames.append(HEADER.pack(FRAME_EOF, self.id, 0))
+            if self._closing:
+                frames.append(HEADER.pack(FRAME_RESET, self.id, 0))
+                self._finish(None)
+        return self.sendable()
+
+    def window_update(self, increment):
+        self._send_window += increment
+        if self.sendable():
+            self._session.activate(self)
+
+    def data_received(self, data):
+        if self._closed:
+            return
+        if self._reading and self._protocol is not None and not self._recvq:
+            self._consumed(len(data))
+            _deliver(self._protocol, data)
+        else:
+            self._recvq.append(data)
+
+    def eof_received(self):
+        if self._closed:
+            return
+        self._eof_received = True
+        if self._reading and self._protocol is not None and not self._recvq:
+            self._deliver_eof()
+        else:
+            self._recvq.append(None)
+
+    def reset_received(self):
+        if self._closed:
+            return
+        self._sendbuf.clear()
+        self._finish(None if self._eof_received
+                     else ConnectionResetError("Stream reset by peer"))
+
+    def connection_lost(self, exc):
+        if not self._closed:
+            self._sendbuf.clear()
+            self._finish(exc if exc is not None
+                         else ConnectionResetError("Mux connection lost"))
+
+    def _deliver_eof(self):
+        if not self._protocol.eof_received():
+            self.close()
+
+    def _drain_recvq(self):
+        while (self._recvq and self._reading and
+               self._protocol is not None and not self._closed):
+            data = self._recvq.popleft()
+            if data is None:
+                self._deliver_eof()
+            else:
+                self._consumed(len(data))
+                _deliver(self._protocol, data)
+
+    def _consumed(self, size):
+        self._unacked += size
+        if self._unacked >= INITIAL_WINDOW // 2:
+            self._session.send_control(
+                HEADER.pack(FRAME_WINDOW, self.id, WINDOW_INCREMENT.size) +
+                WINDOW_INCREMENT.pack(self._unacked))
+            self._unacked = 0
+
+    def _finish(self, exc):
+        self._closed = True
+        self._recvq.clear()
+        self._session.stream_closed(self)
+        if self._protocol is not None:
+            self._session.loop.call_soon(self._protocol.connection_lost, exc)
+
+
+class MuxSession(asyncio.Protocol):  # pylint: disable=too-many-instance-attributes
+    """ Carries many streams over one connection. Client side opens streams,
+    server side accepts them through on_open callback. Pending streams are
+    served round robin, one frame at a time. """
+
+    def __init__(self, *, client, on_open=None, on_lost=None, label="",
+                 loop=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._m_streams = STREAMS.labels(label)
+        self._client = client
+        self._on_open = on_open
+        self._on_lost = on_lost
+        self._transport = None
+        self._streams = {}
+        self._next_id = 1
+        self._active = collections.deque()
+        self._queued = set()
+        self._control = []
+        self._flush_scheduled = False
+        self._paused = False
+        self._inbuf = bytearray()
+        self._preface_seen = client
+        self.closed = False
+        # no stream IDs left: connection is closed after last stream
+        self.draining = False
+
+    def __len__(self):
+        return len(self._streams)
+
+    def get_extra_info(self, name, default=None):
+        if self._transport is None:
+            return default
+        return self._transport.get_extra_info(name, default)
+
+    def connection_made(self, transport):
+        self._transport = transport
+        if self._client:
+            transport.write(PREFACE)
+
+    @property
+    def available(self):
+        """ Tells if new streams can be opened """
+        return not (self.closed or self.draining)
+
+    def open_stream(self):
+        if self.closed:
+            raise ConnectionResetError("Mux connection is closed")
+        if self.draining:
+            raise ConnectionResetError("Mux connection ran out of stream IDs")
+        stream_id = self._next_id
+        self._next_id += 2
+        if self._next_id > MAX_STREAM_ID:
+            self._logger.info("Mux connection ran out of stream IDs, "
+                              "closing it after %d remaining streams.",
+                              len(self._streams) + 1)
+            self.draining = True
+        self.send_control(HEADER.pack(FRAME_OPEN, stream_id, 0))
+        stream = MuxStream(self, stream_id)
+        self._streams[stream_id] = stream
+        self._m_streams.inc()
+        return stream
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+
+    # Outgoing data
+
+    def activate(self, stream):
+        if stream.id not in self._queued and stream.sendable():
+            self._queued.add(stream.id)
+            self._active.append(stream)
+            self._schedule()
+
+    def send_control(self, frame):
+        self._control.append(frame)
+        self._schedule()
+
+    def _schedule(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self.closed:
+            return
+        frames, self._control = self._control, []
+        if frames:
+            self._transport.write(b"".join(frames))
+        active = self._active
+        while active and not self._paused:
+            stream = active.popleft()
+            frames = []
+            if stream.take_frames(frames):
+                active.append(stream)
+            else:
+                self._queued.discard(stream.id)
+            if frames:
+                self._transport.write(b"".join(frames))
+        if self.draining and not (self._streams or self._active):
+            self.close()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        if self._active:
+            self._schedule()
+
+    def stream_closed(self, stream):
+        if self._streams.pop(stream.id, None) is not None:
+            self._m_streams.dec()
+            if self.draining and not self._streams:
+                # closes connection once last frames are written
+                self._schedule()
+
+    # Incoming data
+
+    def data_received(self, data):
+        inbuf = self._inbuf
+        inbuf += data
+        try:
+            pos = 0
+            if not self._preface_seen:
+                if len(inbuf) < len(PREFACE):
+                    return
+                if inbuf[:len(PREFACE)] != PREFACE:
+                    raise MuxProtocolError("bad preface")
+                pos = len(PREFACE)
+                self._preface_seen = True
+            end = len(inbuf)
+            while end - pos >= HEADER.size:
+                frame_type, stream_id, size = HEADER.unpack_from(inbuf, pos)
+                if end - pos - HEADER.size < size:
+                    break
+                start = pos + HEADER.size
+                pos = start + size
+                self._frame_received(frame_type, stream_id,
+                                     bytes(inbuf[start:pos]))
+                if self.closed:
+                    return
+            del inbuf[:pos]
+        except MuxProtocolError as exc:
+            self._logger.error("Mux protocol error: %s", str(exc))
+            self._transport.abort()
+
+    def _frame_received(self, frame_type, stream_id, payload):
+        if frame_type == FRAME_OPEN:
+            if self._client or stream_id in self._streams or not stream_id & 1:
+                raise MuxProtocolError("unexpected stream %d" % (stream_id,))
+            stream = MuxStream(self, stream_id)
+            stream.pause_reading()
+            self._streams[stream_id] = stream
+            self._m_streams.inc()
+            self._on_open(stream)
+            return
+        stream = self._streams.get(stream_id)
+        if frame_type == FRAME_DATA:
+            if stream is not None:
+                stream.data_received(payload)
+        elif frame_type == FRAME_EOF:
+            if stream is not None:
+                stream.eof_received()
+        elif frame_type == FRAME_WINDOW:
+            if len(payload) != WINDOW_INCREMENT.size:
+                raise MuxProtocolError("bad window update")
+            if stream is not None:
+                stream.window_update(WINDOW_INCREMENT.unpack(payload)[0])
+        elif frame_type == FRAME_RESET:
+            if stream is not None:
+                stream.reset_received()
+        else:
+            raise MuxProtocolError("unknown frame type %d" % (frame_type,))
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._active.clear()
+        self._queued.clear()
+        for stream in list(self._streams.values()):
+            stream.connection_lost(exc)
+        if self._on_lost is not None:
+            self._on_lost(self)
+
+
+class MuxPool:
+    """ Hands out streams multiplexed over a few long-lived upstream
+    connections taken from pool. Has the same interface as ConnPool. """
+
+    def __init__(self, pool, *, sessions=4, max_streams=256, label="",
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._pool = pool
+        self._size = sessions
+        self._max_streams = max_streams
+        self._sessions = []
+        self._connecting = None
+        # identifies tunnel in metrics
+        self._label = label
+        SESSIONS.labels(label).set_function(lambda: len(self._sessions))
+
+    async def start(self):
+        await self._pool.start()
+
+    async def stop(self):
+        if self._connecting is not None:
+            self._connecting.cancel()
+            await asyncio.gather(self._connecting, return_exceptions=True)
+        for session in list(self._sessions):
+            session.close()
+        await self._pool.stop()
+
+    @property
+    def idle(self):
+        return self._pool.idle
+
+    @property
+    def size(self):
+        return self._pool.size
+
+    def snapshot(self):
+        """ Returns JSON-serializable state of mux connections and
+        underlying pool """
+        return {
+            "sessions": [{"streams": len(session), "closed": session.closed,
+                          "draining": session.draining}
+                         for session in self._sessions],
+            "connecting": self._connecting is not None,
+            "pool": self._pool.snapshot(),
+        }
+
+    def _session_lost(self, session):
+        try:
+            self._sessions.remove(session)
+        except ValueError:
+            pass
+        else:
+            self._logger.info("Mux connection closed. %d remaining.",
+                              len(self._sessions))
+
+    async def _connect(self):
+        _, writer = await self._pool.get()
+        transport = writer.transport
+        session = MuxSession(client=True, on_lost=self._session_lost,
+                             label=self._label, loop=self._loop)
+        transport.set_protocol(session)
+        session.connection_made(transport)
+        self._sessions.append(session)
+        self._logger.info("Established mux connection. %d in use.",
+                          len(self._sessions))
+        return session
+
+    def _connect_done(self, fut):
+        self._connecting = None
+        if not fut.cancelled() and fut.exception() is not None:
+            self._logger.error("Mux connection setup failed: %s",
+                               str(fut.exception()))
+
+    def _start_connect(self):
+        if self._connecting is None:
+            self._connecting = self._loop.create_task(self._connect())
+            self._connecting.add_done_callback(self._connect_done)
+        return self._connecting
+
+    async def _session(self):
+        while True:
+            available = [s for s in self._sessions if s.available]
+            live = [s for s in available if len(s) < self._max_streams]
+            best = min(live, key=len) if live else None
+            if best is not None and (not len(best) or
+                                     len(available) >= self._size):
+                return best
+            connecting = self._start_connect()
+            if best is not None:
+                # use existing connection while new one is being set up
+                return best
+            await asyncio.shield(connecting)
+
+    async def get(self, source=None, priority=0):  # pylint: disable=unused-argument
+        # clients share mux connections instead of queueing for them
+        session = await self._session()
+        stream = session.open_stream()
+        reader = asyncio.StreamReader(loop=self._loop)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=self._loop)
+        stream.set_protocol(protocol)
+        protocol.connection_made(stream)
+        writer = asyncio.StreamWriter(stream, protocol, reader, self._loop)
+        return reader, writer
@@ -1,6 +1,8 @@
 from abc import ABC, abstractmethod
-import string
+import argparse
 import enum
+import itertools
+import os
 import socket
 import struct
 
@@ -13,79 +15,105 @@ af_map = {
 }
 
 
+class ConnectionIDs:
+    """ Generates connection IDs unique across processes and restarts:
+    random per-process prefix followed by sequence number """
+
+    ID = struct.Struct("!8sQ")
+
+    def __init__(self):
+        self._prefix = os.urandom(8)
+        self._counter = itertools.count()
+
+    def next(self):
+        return self.ID.pack(self._prefix, next(self._counter))
+
+
 class BaseProxyProtocol(ABC):
+    unique_id = False
+
     @abstractmethod
-    def prologue(self, src, dst):
+    def prologue(self, src, dst, family=None, unique_id=None):
         """ Returns bytes with prologue data. Accepts original
-        source and destination of TCP connection. 
+        source and destination of TCP connection.
         Params: src, dst
-        Each of them is a pair of host (IP as str) and port (int) """
+        Each of them is a pair of host (IP as str) and port (int).
+        Address family of connection socket spares its detection from
+        address. Protocols which support it pass unique_id bytes to
+        upstream. """
+
+
+def _family(src, family):
+    if family is None:
+        family = detect_af(src[0])
+    return family
 
 
 class ProxyProtocolV1(BaseProxyProtocol):
-    def prologue(self, src, dst):
-        src_ip, src_port = src
-        dst_ip, dst_port = dst
-        src_af = detect_af(src_ip)
-        dst_af = detect_af(src_ip)
-        if src_af != dst_af:
-            raise ValueError("Protocol AF mismatch!")
-        if src_af not in af_map:
+    def prologue(self, src, dst, family=None, unique_id=None):
+        family = _family(src, family)
+        if family not in af_map:
             return b"PROXY UNKNOWN\r\n"
-        else:
-            res= ("PROXY " + af_map[src_af] + " " + 
-                  src_ip + " " + dst_ip + " " +
-                  str(src_port) + " " + str(dst_port) + "\r\n").encode('ascii')
-            if len(res) >= 108:
-                raise RuntimeError("Produced string is too long for proxy-protocol")
-            return res
+        res = ("PROXY %s %s %s %d %d\r\n" % (af_map[family],
+                                              src[0], dst[0],
+                                              src[1], dst[1])).encode('ascii')
+        if len(res) >= 108:
+            raise RuntimeError("Produced string is too long for proxy-protocol")
+        return res
 
 
 PPV2SIG = b'\x0D\x0A\x0D\x0A\x00\x0D\x0A\x51\x55\x49\x54\x0A'
-PPV2StructIPv4 = struct.Struct("!12sBBH" "4s4sHH")
-PPV2StructIPv6 = struct.Struct("!12sBBH" "16s16sHH")
-PPV2StructUNKNOWN = struct.Struct("!12sBBH")
+PPV2Header = struct.Struct("!12sBBH")
+PPV2AddrIPv4 = struct.Struct("!4s4sHH")
+PPV2AddrIPv6 = struct.Struct("!16s16sHH")
+PPV2TLVHeader = struct.Struct("!BH")
 PPV2VER = 2
 PPV2PROXYCMD = 1
 PPV2VERCMD = ((PPV2VER << 4) | PPV2PROXYCMD)
 PPV2TCPOVERIPV4 = 0x11
 PPV2TCPOVERIPV6 = 0x21
 PPV2UNKNOWNAF = 0x0
-PPV2UNKNOWNAF_ADDRLEN = 0x0
-PPV2TCPOVERIPV4_ADDRLEN = 12
-PPV2TCPOVERIPV6_ADDRLEN = 36
+PPV2_TYPE_UNIQUE_ID = 0x05
+PPV2_UNIQUE_ID_MAXLEN = 128
+
+# family -> (address family and protocol byte, address block struct)
+PPV2_ADDR = {
+    socket.AF_INET: (PPV2TCPOVERIPV4, PPV2AddrIPv4),
+    socket.AF_INET6: (PPV2TCPOVERIPV6, PPV2AddrIPv6),
+}
+PPV2UNKNOWN = PPV2Header.pack(PPV2SIG, PPV2VERCMD, PPV2UNKNOWNAF, 0)
 
 
 class ProxyProtocolV2(BaseProxyProtocol):
-    def prologue(self, src, dst):
-        src_ip, src_port = src
-        dst_ip, dst_port = dst
-        src_af = detect_af(src_ip)
-        dst_af = detect_af(src_ip)
-        if src_af != dst_af:
-            raise ValueError("Protocol AF mismatch!")
-        src_addr_packed = socket.inet_pton(src_af, src_ip)
-        dst_addr_packed = socket.inet_pton(dst_af, dst_ip)
-        if src_af == socket.AF_INET:
-            # IPv4
-            res = PPV2StructIPv4.pack(PPV2SIG, PPV2VERCMD, PPV2TCPOVERIPV4,
-                                      PPV2TCPOVERIPV4_ADDRLEN,
-                                      src_addr_packed,
-                                      dst_addr_packed,
-                                      src_port,
-                                      dst_port)
-        elif src_af == socket.AF_INET6:
-            # IPv6
-            res = PPV2StructIPv6.pack(PPV2SIG, PPV2VERCMD, PPV2TCPOVERIPV6,
-                                      PPV2TCPOVERIPV6_ADDRLEN,
-                                      src_addr_packed,
-                                      dst_addr_packed,
-                                      src_port,
-                                      dst_port)
+    def __init__(self, unique_id=False):
+        self.unique_id = unique_id
+        # header is fixed for given family unless TLVs follow address block
+        self._headers = {
+            family: PPV2Header.pack(PPV2SIG, PPV2VERCMD, fam_proto,
+                                    addr.size)
+            for family, (fam_proto, addr) in PPV2_ADDR.items()
+        }
+
+    def prologue(self, src, dst, family=None, unique_id=None):
+        family = _family(src, family)
+        try:
+            fam_proto, addr = PPV2_ADDR[family]
+        except KeyError:
+            # unknown origin, like UNIX socket client: no address block
+            header, fam_proto, block = PPV2UNKNOWN, PPV2UNKNOWNAF, b''
         else:
-            res = PPV2StructUNKNOWN.pack(PPV2SIG, PPV2VERCMD, PPV2UNKNOWNAF,
-                                      PPV2UNKNOWNAF_ADDRLEN)
-        return res
+            header = self._headers[family]
+            block = addr.pack(socket.inet_pton(family, src[0]),
+                              socket.inet_pton(family, dst[0]),
+                              src[1], dst[1])
+        if unique_id is None:
+            return header + block
+        if len(unique_id) > PPV2_UNIQUE_ID_MAXLEN:
+            raise ValueError("Unique ID is too long for proxy-protocol")
+        tlv = PPV2TLVHeader.pack(PPV2_TYPE_UNIQUE_ID,
+                                 len(unique_id)) + unique_id
+        return (PPV2Header.pack(PPV2SIG, PPV2VERCMD, fam_proto,
+                                len(block) + len(tlv)) + block + tlv)
 
 
 class ProxyProtocol(enum.Enum):
@@ -0,0 +1,90 @@
+import asyncio
+
+
+async def wait_ready(pools, fill, timeout, *,
+                     abort=None,
+                     poll_interval=.1,
+                     loop=None):
+    """ Waits until reserve of pools reaches given share of their total
+    size, timeout expires or abort event is set. Returns True if pools got
+    filled. """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while (sum(pool.idle for pool in pools) <
+           fill * sum(pool.size for pool in pools)):
+        if loop.time() >= deadline or abort is not None and abort.is_set():
+            return False
+        await asyncio.sleep(poll_interval)
+    return True
+
+
+async def announce_ready(notifier, pools, fill, timeout, *,
+                         abort=None,
+                         poll_interval=.1,
+                         loop=None):
+    """ Sends READY=1 to service manager once pools are filled to given
+    share or timeout expires. Zero fill announces readiness at once.
+    Returns False if readiness was reported with pools not filled. """
+    filled = True
+    if fill:
+        filled = await wait_ready(pools, fill, timeout,
+                                  abort=abort,
+                                  poll_interval=poll_interval,
+                                  loop=loop)
+    await notifier.notify(b"READY=1")
+    return filled
+
+
+class StatusReporter:
+    """ Periodically reports fill of pools and throughput of listeners to
+    service manager as STATUS= notifications """
+
+    def __init__(self, notifier, listeners, pools, *,
+                 interval=10.,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._notifier = notifier
+        self._listeners = listeners
+        self._pools = pools
+        self._interval = interval
+        self._last = None
+        self._task = None
+
+    def status(self):
+        """ Returns status line with rates since previous call """
+        now = self._loop.time()
+        accepted = sum(listener.accepted for listener in self._listeners)
+        relayed = sum(listener.relayed for listener in self._listeners)
+        if self._last is None:
+            conn_rate = byte_rate = 0.
+        else:
+            when, prev_accepted, prev_relayed = self._last
+            elapsed = max(now - when, 1e-9)
+            conn_rate = (accepted - prev_accepted) / elapsed
+            byte_rate = (relayed - prev_relayed) / elapsed
+        self._last = now, accepted, relayed
+        return ("Pool %d/%d ready, %d clients, %.1f conn/s, %.2f MB/s" %
+                (sum(pool.idle for pool in self._pools),
+                 sum(pool.size for pool in self._pools),
+                 sum(listener.active for listener in self._listeners),
+                 conn_rate, byte_rate / 2**20))
+
+    async def notify(self, message=None):
+        status = self.status() if message is None else message
+        await self._notifier.notify(b"STATUS=" + status.encode())
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            await self.notify()
+
+    async def start(self):
+        self.status()
+        if self._interval:
+            self._task = self._loop.create_task(self._report())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
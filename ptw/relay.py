@@ -0,0 +1,558 @@
+import asyncio
+import logging
+import os
+import ssl
+
+from .constants import (BUFSIZE, SMALL_RECORD, RECORD_IDLE_RESET,
+                        HALF_CLOSE_FALLBACK_TIMEOUT)
+from . import ktls
+
+
+_logger = logging.getLogger('Relay')
+_unpropagated = set()
+
+
+def write_eof(transport):
+    """ Half-closes transport after data buffered in it, so peer gets EOF
+    but may keep sending. Socket gets FIN, TLS connection gets
+    close_notify, multiplexed stream gets EOF frame. Returns False if
+    transport can't be half-closed. """
+    if transport.is_closing():
+        return False
+    if transport.get_extra_info('sslcontext') is not None:
+        return _write_close_notify(transport)
+    sock = transport.get_extra_info('socket')
+    if sock is not None and ktls.is_active(sock):
+        # plain shutdown would end stream without close_notify
+        _not_propagated("kernel TLS connection can't send close_notify")
+        return False
+    if not transport.can_write_eof():
+        _not_propagated("%s can't write EOF" % (type(transport).__name__,))
+        return False
+    transport.write_eof()
+    return True
+
+
+def _not_propagated(reason):
+    # reasons are mostly properties of environment: warn once, then note
+    # every occurrence at lower level
+    if reason in _unpropagated:
+        level = logging.INFO
+    else:
+        _unpropagated.add(reason)
+        level = logging.WARNING
+    _logger.log(level, "Half-close is not propagated: %s. Relay is closed "
+                "after half-close timeout (%.0f seconds, if not set).",
+                reason, HALF_CLOSE_FALLBACK_TIMEOUT)
+
+
+def _write_close_notify(transport):
+    # asyncio TLS transport can only be closed and drops data which peer
+    # sends after that. OpenSSL allows reading after close_notify is sent,
+    # so shut down TLS object directly and let transport read on. This
+    # relies on internals of asyncio.sslproto, uvloop doesn't expose them.
+    protocol = getattr(transport, '_ssl_protocol', None)
+    sslobj = getattr(protocol, '_sslobj', None)
+    if sslobj is None or not hasattr(protocol, '_process_outgoing'):
+        _not_propagated("%s doesn't expose SSL object" %
+                        (type(transport).__name__,))
+        return False
+    if getattr(protocol, '_write_backlog', None):
+        _not_propagated("TLS transport has pending writes")
+        return False
+    try:
+        sslobj.unwrap()
+    except ssl.SSLWantReadError:
+        # peer's close_notify is not there yet
+        pass
+    except ssl.SSLError as exc:
+        _not_propagated("TLS shutdown failed: %s" % (str(exc),))
+        return False
+    sslobj.read = _read_until_close_notify(sslobj.read)
+    protocol._process_outgoing()  # pylint: disable=protected-access
+    return True
+
+
+def _read_until_close_notify(read):
+    # once own close_notify is sent, ssl module reports the one of peer as
+    # error instead of end of stream
+    def wrapper(length=1024, buffer=None):
+        try:
+            if buffer is None:
+                return read(length)
+            return read(length, buffer)
+        except ssl.SSLZeroReturnError:
+            return b'' if buffer is None else 0
+    return wrapper
+
+
+class IdleMonitor:
+    """ Reaps relay which moved no data for idle timeout or, once one of
+    directions has finished, for half-close timeout. If EOF couldn't be
+    passed to other side, half-closed relay is reaped after
+    HALF_CLOSE_FALLBACK_TIMEOUT even without half-close timeout set, as
+    peer never learns it should close connection. Byte counters are
+    compared when timer fires instead of rearming timer on every read, so
+    relay is reaped after one to two timeouts of inactivity. """
+
+    def __init__(self, *, idle_timeout=None, half_close_timeout=None,
+                 loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._idle_timeout = idle_timeout
+        self._half_close_timeout = half_close_timeout
+        self._progress = None
+        self._close = None
+        self._last = None
+        self._handle = None
+        self._propagated = True
+        self.half_closed = False
+        self.reaped = None
+
+    def start(self, progress, close):
+        """ Starts watching relay. progress returns number of bytes
+        relayed so far, close aborts relay. """
+        self._progress = progress
+        self._close = close
+        self._last = progress()
+        self._arm()
+
+    def _arm(self):
+        timeout = self._idle_timeout
+        half_close_timeout = self._half_close_timeout
+        if half_close_timeout is None and not self._propagated:
+            half_close_timeout = HALF_CLOSE_FALLBACK_TIMEOUT
+        if self.half_closed and half_close_timeout is not None:
+            timeout = (half_close_timeout if timeout is None
+                       else min(timeout, half_close_timeout))
+        if timeout is not None:
+            self._handle = self._loop.call_later(timeout, self._check)
+
+    def _check(self):
+        self._handle = None
+        current = self._progress()
+        if current != self._last:
+            self._last = current
+            self._arm()
+            return
+        self.reaped = "half_closed" if self.half_closed else "idle"
+        self._close()
+
+    def half_close(self, propagated=True):
+        """ Notes that one direction has reached EOF, which was passed
+        to other side of relay if propagated """
+        if (self.half_closed or self._progress is None or
+                self.reaped is not None):
+            return
+        self.half_closed = True
+        self._propagated = propagated
+        self.stop()
+        self._last = self._progress()
+        self._arm()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class RelayBuffer:
+    """ Receive buffer shared by all relay endpoints running in the same
+    event loop. Transports fill the buffer and report it back within single
+    callback, and endpoints copy received data out immediately, so one
+    buffer serves any number of connections. """
+
+    def __init__(self, size=BUFSIZE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+
+
+class RecordSizer:
+    """ Dynamic record sizing for one relay direction. Reads, and so TLS
+    records made of them, start small to let receiver decrypt first bytes
+    without waiting for full-size record. Size doubles every time read
+    fills it up to maximum for sustained transfers and drops back after
+    direction stays idle. """
+
+    __slots__ = ('size', '_min', '_max', '_idle_reset', '_last')
+
+    def __init__(self, min_size=SMALL_RECORD, max_size=BUFSIZE,
+                 idle_reset=RECORD_IDLE_RESET):
+        self._min = min(min_size, max_size)
+        self._max = max_size
+        self._idle_reset = idle_reset
+        self._last = float('-inf')
+        self.size = self._min
+
+    def get(self, now):
+        """ Returns size for data arriving at now """
+        if now - self._last > self._idle_reset:
+            self.size = self._min
+        self._last = now
+        return self.size
+
+    def grow(self, nbytes):
+        if nbytes >= self.size and self.size < self._max:
+            self.size = min(self.size * 2, self._max)
+
+
+class RelayEndpoint(asyncio.BufferedProtocol):
+    """ One side of protocol-level relay. Receives data into preallocated
+    buffer and forwards it straight into transport of paired endpoint.
+    With coalescing enabled, writes smaller than current record size are
+    held for up to coalesce_delay seconds to be sent together. """
+
+    def __init__(self, relay, buffer, counter, sizer, coalesce_delay=0.):
+        self._relay = relay
+        self._loop = relay._loop  # pylint: disable=protected-access
+        self._buf = buffer.buf
+        self._view = buffer.view
+        self._counter = counter
+        self._sizer = sizer
+        self._coalesce_delay = coalesce_delay
+        self._pending = bytearray()
+        self._flush_handle = None
+        self._prefix = None
+        self._prefix_handle = None
+        self.transport = None
+        self.peer = None
+        self.eof = False
+        self.closed = False
+        self.bytes_received = 0
+        self.on_first_byte = None
+        self._tls = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._tls = transport.get_extra_info('sslcontext') is not None
+
+    def set_prefix(self, prefix, delay):
+        """ Makes prefix go to peer together with first received data or
+        alone if nothing arrives within delay """
+        self._prefix = prefix
+        self._prefix_handle = self._loop.call_later(delay, self.send_prefix)
+
+    def send_prefix(self):
+        if self._prefix is None:
+            return
+        self._prefix_handle.cancel()
+        prefix, self._prefix = self._prefix, None
+        peer_transport = self.peer.transport
+        if not peer_transport.is_closing():
+            peer_transport.write(prefix)
+
+    def get_buffer(self, sizehint):
+        return self._view[:self._sizer.get(self._loop.time())]
+
+    def buffer_updated(self, nbytes):
+        if self.on_first_byte is not None:
+            callback, self.on_first_byte = self.on_first_byte, None
+            callback()
+        self.bytes_received += nbytes
+        self._counter.inc(nbytes)
+        size = self._sizer.size
+        self._sizer.grow(nbytes)
+        if self._prefix is not None:
+            # prefix shares TLS record with first data
+            self._prefix_handle.cancel()
+            data, self._prefix = self._prefix + self._view[:nbytes], None
+            peer_transport = self.peer.transport
+            if not peer_transport.is_closing():
+                peer_transport.write(data)
+            return
+        if self._coalesce_delay:
+            self._pending += self._view[:nbytes]
+            if len(self._pending) >= size:
+                self.flush()
+            elif self._flush_handle is None:
+                self._flush_handle = self._loop.call_later(
+                    self._coalesce_delay, self.flush)
+            return
+        peer_transport = self.peer.transport
+        if not peer_transport.is_closing():
+            # Transports are free to retain passed object until it is sent,
+            # so data leaves reusable buffer as a copy.
+            peer_transport.write(self._buf[:nbytes])
+
+    def flush(self):
+        """ Writes coalesced data to peer """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        data = bytes(self._pending)
+        self._pending.clear()
+        peer_transport = self.peer.transport
+        if not peer_transport.is_closing():
+            peer_transport.write(data)
+
+    def eof_received(self):
+        self.send_prefix()
+        self.flush()
+        self.eof = True
+        self._relay._endpoint_eof(self)
+        # keep transport open: opposite direction may still deliver data.
+        # asyncio closes TLS transport on EOF anyway.
+        return not self._tls
+
+    def connection_lost(self, exc):
+        self.send_prefix()
+        self.flush()
+        self.closed = True
+        self._relay._endpoint_lost(self, exc)
+
+    def pause_writing(self):
+        peer_transport = self.peer.transport
+        if not peer_transport.is_closing():
+            peer_transport.pause_reading()
+
+    def resume_writing(self):
+        peer_transport = self.peer.transport
+        if not peer_transport.is_closing():
+            peer_transport.resume_reading()
+
+
+class Relay:
+    """ Pairs two transports with each other without intermediate
+    StreamReader buffers and per-direction pump tasks. """
+
+    def __init__(self, *, counters, buffer=None, record_sizes=None,
+                 coalesce_delay=0., on_half_close=None, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._buffer = buffer if buffer is not None else RelayBuffer()
+        self._on_half_close = on_half_close
+        self._record_sizes = (record_sizes if record_sizes is not None
+                              else (len(self._buffer.buf),) * 2)
+        self._coalesce_delay = coalesce_delay
+        self._counters = counters
+        self._done = None
+        self.client = None
+        self.upstream = None
+
+    def attach(self, client_transport, upstream_transport, first_byte=None,
+               prefix=None, prefix_delay=0.):
+        """ Switches both transports to relay endpoints and returns future
+        which resolves when both sides are closed. Client transport is
+        expected to be paused for reading. Optional first_byte callback is
+        invoked when upstream sends data for the first time. Optional
+        prefix is sent to upstream ahead of client data. """
+        self._done = self._loop.create_future()
+        client_counter, upstream_counter = self._counters
+        self.client = RelayEndpoint(self, self._buffer, client_counter,
+                                    RecordSizer(*self._record_sizes),
+                                    self._coalesce_delay)
+        self.upstream = RelayEndpoint(self, self._buffer, upstream_counter,
+                                      RecordSizer(*self._record_sizes),
+                                      self._coalesce_delay)
+        self.upstream.on_first_byte = first_byte
+        if prefix is not None:
+            self.client.set_prefix(prefix, prefix_delay)
+        self.client.peer = self.upstream
+        self.upstream.peer = self.client
+        for endpoint, transport in ((self.client, client_transport),
+                                    (self.upstream, upstream_transport)):
+            transport.set_protocol(endpoint)
+            endpoint.connection_made(transport)
+        client_transport.resume_reading()
+        return self._done
+
+    @property
+    def bytes_received(self):
+        """ Bytes received from client and from upstream so far """
+        if self.client is None:
+            return 0, 0
+        return self.client.bytes_received, self.upstream.bytes_received
+
+    def abort(self):
+        for endpoint in (self.client, self.upstream):
+            if endpoint is not None and endpoint.transport is not None:
+                endpoint.transport.abort()
+
+    def _endpoint_eof(self, endpoint):
+        peer = endpoint.peer
+        if peer.eof:
+            endpoint.transport.close()
+            peer.transport.close()
+            return
+        propagated = write_eof(peer.transport)
+        if self._on_half_close is not None:
+            self._on_half_close(propagated)
+
+    def _endpoint_lost(self, endpoint, exc):
+        if exc is not None:
+            self._logger.debug("Relay endpoint lost connection: %s", str(exc))
+        peer = endpoint.peer
+        if peer.closed:
+            if not self._done.done():
+                self._done.set_result((self.client.bytes_received,
+                                       self.upstream.bytes_received))
+        elif not peer.transport.is_closing():
+            peer.transport.close()
+
+
+class SpliceDirection:
+    """ Moves data from one socket to another through kernel pipe without
+    copying it to user space """
+
+    def __init__(self, relay, src, dst, counter, *, chunk=4 * BUFSIZE,
+                 loop):
+        self._relay = relay
+        self._loop = loop
+        self._src = src
+        self._dst = dst
+        self._counter = counter
+        self._chunk = chunk
+        self._pipe_r, self._pipe_w = os.pipe()
+        for fd in (self._pipe_r, self._pipe_w):
+            os.set_blocking(fd, False)
+        self._pending = 0
+        self._reading = False
+        self._waiting_write = False
+        self.eof = False
+        self.done = False
+        self.bytes_received = 0
+        self.on_first_byte = None
+
+    def start(self):
+        self._reading = True
+        self._loop.add_reader(self._src, self._readable)
+
+    def _readable(self):
+        try:
+            size = os.splice(self._src, self._pipe_w, self._chunk,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            self._relay._direction_failed(exc)  # pylint: disable=protected-access
+            return
+        if not size:
+            self.eof = True
+            self._stop_reading()
+        else:
+            if self.on_first_byte is not None:
+                callback, self.on_first_byte = self.on_first_byte, None
+                callback()
+            self._pending += size
+            self.bytes_received += size
+            self._counter.inc(size)
+        self._flush()
+
+    def _writable(self):
+        self._flush()
+
+    def _flush(self):
+        while self._pending:
+            try:
+                size = os.splice(self._pipe_r, self._dst, self._pending,
+                                 flags=os.SPLICE_F_MOVE |
+                                 os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                # destination is full: hold source until it drains
+                self._stop_reading()
+                if not self._waiting_write:
+                    self._waiting_write = True
+                    self._loop.add_writer(self._dst, self._writable)
+                return
+            except OSError as exc:
+                self._relay._direction_failed(exc)  # pylint: disable=protected-access
+                return
+            self._pending -= size
+        if self._waiting_write:
+            self._waiting_write = False
+            self._loop.remove_writer(self._dst)
+        if self.eof:
+            if not self.done:
+                self.done = True
+                self._relay._direction_eof(self)  # pylint: disable=protected-access
+        elif not self._reading:
+            self.start()
+
+    def _stop_reading(self):
+        if self._reading:
+            self._reading = False
+            self._loop.remove_reader(self._src)
+
+    def close(self):
+        self._stop_reading()
+        if self._waiting_write:
+            self._waiting_write = False
+            self._loop.remove_writer(self._dst)
+        for fd in (self._pipe_r, self._pipe_w):
+            os.close(fd)
+
+
+class SpliceRelay:
+    """ Relays data between two plain socket transports with splice(2).
+    Upstream socket may still carry TLS when kernel does encryption.
+    Transports have to be paused and their write buffers empty. """
+
+    def __init__(self, *, counters, on_half_close=None, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._counters = counters
+        self._on_half_close = on_half_close
+        self._client_transport = None
+        self._fds = []
+        self._directions = ()
+        self._done = None
+
+    def attach(self, client_transport, upstream_transport, first_byte=None):
+        """ Starts relay and returns future which resolves with byte counts
+        when both directions reach EOF or any of them fails. Transports are
+        left intact: caller closes them. Optional first_byte callback is
+        invoked when upstream sends data for the first time. """
+        self._done = self._loop.create_future()
+        self._client_transport = client_transport
+        # private descriptors: transports keep ownership of their own ones
+        client, upstream = self._fds = [
+            os.dup(t.get_extra_info('socket').fileno())
+            for t in (client_transport, upstream_transport)]
+        client_counter, upstream_counter = self._counters
+        self._directions = (
+            SpliceDirection(self, client, upstream, client_counter,
+                            loop=self._loop),
+            SpliceDirection(self, upstream, client, upstream_counter,
+                            loop=self._loop),
+        )
+        self._directions[1].on_first_byte = first_byte
+        for direction in self._directions:
+            direction.start()
+        return self._done
+
+    @property
+    def bytes_received(self):
+        """ Bytes received from client and from upstream so far """
+        if not self._directions:
+            return 0, 0
+        return tuple(d.bytes_received for d in self._directions)
+
+    def _finish(self):
+        for direction in self._directions:
+            direction.close()
+        for fd in self._fds:
+            os.close(fd)
+        self._fds = []
+        if not self._done.done():
+            self._done.set_result(self.bytes_received)
+
+    def abort(self):
+        if self._fds:
+            self._finish()
+
+    def _direction_eof(self, direction):
+        if all(d.done for d in self._directions):
+            self._finish()
+            return
+        if direction is self._directions[1]:
+            propagated = write_eof(self._client_transport)
+        else:
+            _not_propagated("kernel TLS connection can't send close_notify")
+            propagated = False
+        if self._on_half_close is not None:
+            self._on_half_close(propagated)
+
+    def _direction_failed(self, exc):
+        self._logger.debug("Splice relay failed: %s", str(exc))
+        self._finish()
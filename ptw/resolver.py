@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import socket
+
+
+def interleave(infos):
+    """ Orders addresses alternating between address families, starting
+    with family of the first one (RFC 8305, section 4) """
+    groups = {}
+    for info in infos:
+        groups.setdefault(info[0], []).append(info)
+    if len(groups) < 2:
+        return list(infos)
+    res = []
+    queues = list(groups.values())
+    while queues:
+        for group in queues:
+            res.append(group.pop(0))
+        queues = [group for group in queues if group]
+    return res
+
+
+class Resolver:
+    """ Caches addresses of upstream host. Entry expired after ttl is still
+    served while it is being refreshed in background, so lookups stay out
+    of connection setup path. Addresses which failed recently are tried
+    last. """
+
+    def __init__(self, host, port, *, ttl=30., failure_ttl=60., loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._host = host
+        self._port = port
+        self.ttl = ttl
+        self._failure_ttl = failure_ttl
+        self._infos = None
+        self._expires = 0.
+        self._refreshing = None
+        self._failed = {}
+
+    async def _refresh(self):
+        try:
+            infos = await self._loop.getaddrinfo(self._host, self._port,
+                                                 type=socket.SOCK_STREAM)
+        except OSError as exc:
+            if self._infos is None:
+                raise
+            self._logger.warning("Unable to refresh addresses of %s, "
+                                 "keeping previous ones: %s",
+                                 self._host, str(exc))
+            # retry soon, but not on every connection attempt
+            self._expires = self._loop.time() + min(self.ttl, 5.)
+            return
+        if not infos:
+            raise OSError("No addresses found for %s" % (self._host,))
+        self._infos = interleave(infos)
+        self._expires = self._loop.time() + self.ttl
+
+    def _refresh_done(self, task):
+        self._refreshing = None
+        if not task.cancelled():
+            # failure is reported to callers awaiting first lookup
+            task.exception()
+
+    def _start_refresh(self):
+        if self._refreshing is None:
+            self._refreshing = self._loop.create_task(self._refresh())
+            self._refreshing.add_done_callback(self._refresh_done)
+        return self._refreshing
+
+    async def resolve(self):
+        """ Returns getaddrinfo() results in preferred connection order """
+        if self._infos is None:
+            await asyncio.shield(self._start_refresh())
+        now = self._loop.time()
+        if now >= self._expires:
+            self._start_refresh()
+        if not self._failed:
+            return self._infos
+        for addr, failed_at in list(self._failed.items()):
+            if now - failed_at > self._failure_ttl:
+                del self._failed[addr]
+        return sorted(self._infos, key=lambda info: info[4] in self._failed)
+
+    def failed(self, addr):
+        self._failed[addr] = self._loop.time()
+
+    def succeeded(self, addr):
+        self._failed.pop(addr, None)
+
+    async def close(self):
+        if self._refreshing is not None:
+            self._refreshing.cancel()
+            await asyncio.gather(self._refreshing, return_exceptions=True)
+
+
+async def _attempt(loop, info):
+    family, type_, proto, _, addr = info
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, addr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def _close_socket(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+
+async def staggered_connect(infos, delay, *, on_failure=None, loop=None):
+    """ Races TCP connection attempts to addresses in given order. Next
+    attempt starts after delay or as soon as previous one fails (RFC 8305,
+    section 5). Returns connected socket and its address. """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    remaining = iter(infos)
+    pending = {}
+    exc = None
+    try:
+        while True:
+            info = next(remaining, None)
+            if info is not None:
+                task = loop.create_task(_attempt(loop, info))
+                pending[task] = info[4]
+            if not pending:
+                if exc is None:
+                    raise OSError("No addresses to connect to")
+                raise exc
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=delay if info is not None else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                addr = pending.pop(task)
+                if task.exception() is not None:
+                    exc = task.exception()
+                    if on_failure is not None:
+                        on_failure(addr)
+                elif winner is None:
+                    winner = task.result(), addr
+                else:
+                    task.result().close()
+            if winner is not None:
+                return winner
+    finally:
+        for task in pending:
+            task.cancel()
+            # attempt may have connected before cancellation reached it
+            task.add_done_callback(_close_socket)
@@ -0,0 +1,116 @@
+import ssl
+import time
+import collections
+import contextvars
+
+
+_offered_session = contextvars.ContextVar('offered_session', default=None)
+
+
+class _ResumingMixin:
+    """ Makes SSLObject created by asyncio use session offered by
+    connection builder running in current context """
+
+    @classmethod
+    def _create(cls, *args, session=None, **kwargs):  # pylint: disable=arguments-differ
+        if session is None:
+            session = _offered_session.get()
+        try:
+            return super()._create(*args, session=session, **kwargs)
+        except ValueError:
+            # session belongs to other SSLContext
+            return super()._create(*args, **kwargs)
+
+
+def install_session_hook(context):
+    """ Enables session offering for connections made with context.
+    Returns False if context can't be instrumented. """
+    if not isinstance(context, ssl.SSLContext):
+        return False
+    base = context.sslobject_class
+    if not issubclass(base, _ResumingMixin):
+        context.sslobject_class = type('Resuming' + base.__name__,
+                                       (_ResumingMixin, base),
+                                       {})
+    return True
+
+
+class SessionCache:
+    """ Keeps recent TLS sessions of one upstream. TLS 1.3 tickets are
+    handed out once, earlier protocol sessions are shared until they expire
+    or get rejected by server. """
+
+    def __init__(self, maxsize=32):
+        self._maxsize = maxsize
+        self._sessions = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def _expired(session, now):
+        lifetime = session.timeout
+        if session.has_ticket and session.ticket_lifetime_hint:
+            lifetime = min(lifetime, session.ticket_lifetime_hint)
+        return session.time + lifetime <= now
+
+    def offer(self):
+        """ Picks freshest session and arranges its use for next connection
+        made from current task. Returns offered session or None. """
+        session = None
+        now = time.time()
+        while self._sessions:
+            key, (candidate, single_use) = self._sessions.popitem()
+            if self._expired(candidate, now):
+                continue
+            if not single_use:
+                self._sessions[key] = (candidate, single_use)
+            session = candidate
+            break
+        _offered_session.set(session)
+        return session
+
+    def _store(self, session, single_use):
+        if session is None or not session.id:
+            return
+        if session.id in self._sessions:
+            self._sessions.move_to_end(session.id)
+            return
+        self._sessions[session.id] = (session, single_use)
+        while len(self._sessions) > self._maxsize:
+            self._sessions.popitem(last=False)
+
+    def put(self, ssl_object):
+        """ Remembers TLS 1.3 ticket received by established connection.
+        Tickets arrive after handshake, so it's called when connection
+        leaves pool. Fetching session is costly: it's serialized and parsed
+        back to copy it. """
+        if ssl_object is not None and ssl_object.version() == 'TLSv1.3':
+            self._store(ssl_object.session, True)
+
+    def handshake_done(self, offered, ssl_object):
+        """ Accounts resumption result, remembers new TLS 1.2 session and
+        returns True if offered session was accepted by server. """
+        _offered_session.set(None)
+        if ssl_object is None:
+            return False
+        resumed = False
+        if offered is not None:
+            resumed = ssl_object.session_reused
+            if resumed:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._sessions.pop(offered.id, None)
+        if not resumed and ssl_object.version() != 'TLSv1.3':
+            self._store(ssl_object.session, False)
+        return resumed
+
+    def clear(self):
+        self._sessions.clear()
+
+    def discard(self, session):
+        if session is not None:
+            self._sessions.pop(session.id, None)
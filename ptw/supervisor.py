@@ -0,0 +1,90 @@
+import os
+import time
+import signal
+import logging
+
+
+class Supervisor:
+    """ Forks worker processes, restarts crashed ones and forwards
+    termination, reload and state dump signals to them. """
+
+    def __init__(self, workers, target, *, restart_delay=1.):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._workers = workers
+        self._target = target
+        self._restart_delay = restart_delay
+        self._children = {}
+        self._stopping = False
+
+    def _spawn(self, idx):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                # until worker installs its own handlers
+                signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                # Leave terminal process group: interactive signals are
+                # delivered to supervisor and forwarded to workers by it.
+                os.setpgid(0, 0)
+                code = self._target(idx) or 0
+            except SystemExit as exc:
+                code = exc.code if isinstance(exc.code, int) else 1
+            except BaseException:
+                self._logger.exception("Worker #%d crashed", idx)
+            finally:
+                logging.shutdown()
+                os._exit(code)  # pylint: disable=protected-access
+        self._children[pid] = (idx, time.monotonic())
+        self._logger.info("Started worker #%d with PID %d", idx, pid)
+
+    def _signal_handler(self, signum, frame):  # pylint: disable=unused-argument
+        if self._stopping:
+            self._logger.warning("Got second exit signal! Forwarding it to "
+                                 "workers.")
+        else:
+            self._logger.warning("Got exit signal! Stopping workers.")
+        self._stopping = True
+        self._forward(signum)
+
+    def _forward(self, signum, frame=None):  # pylint: disable=unused-argument
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._signal_handler)
+        signal.signal(signal.SIGINT, self._signal_handler)
+        signal.signal(signal.SIGUSR1, self._forward)
+        signal.signal(signal.SIGHUP, self._forward)
+        for idx in range(self._workers):
+            self._spawn(idx)
+        exit_code = 0
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:  # pragma: no cover
+                break
+            idx, started = self._children.pop(pid, (None, None))
+            if idx is None:
+                continue
+            code = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                    else -os.WTERMSIG(status))
+            if self._stopping:
+                self._logger.info("Worker #%d (PID %d) exited with code %d",
+                                  idx, pid, code)
+                if code:
+                    exit_code = 1
+                continue
+            self._logger.error("Worker #%d (PID %d) died unexpectedly with "
+                               "code %d. Restarting it.", idx, pid, code)
+            uptime = time.monotonic() - started
+            if uptime < self._restart_delay:
+                time.sleep(self._restart_delay - uptime)
+            if not self._stopping:
+                self._spawn(idx)
+        return exit_code
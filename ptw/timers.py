@@ -0,0 +1,256 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import itertools
+import logging
+import os
+import time
+import weakref
+
+from . import constants
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long),
+               ]
+
+
+class itimerspec(ctypes.Structure):
+    _fields_ = [('it_interval', timespec),
+                ('it_value', timespec),
+               ]
+
+
+def _load_timerfd():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        create, settime = libc.timerfd_create, libc.timerfd_settime
+    except (OSError, AttributeError, TypeError):
+        return None
+    create.argtypes = (ctypes.c_int, ctypes.c_int)
+    create.restype = ctypes.c_int
+    settime.argtypes = (ctypes.c_int, ctypes.c_int,
+                        ctypes.POINTER(itimerspec),
+                        ctypes.POINTER(itimerspec))
+    settime.restype = ctypes.c_int
+    return create, settime
+
+
+class TimerFD:
+    """ Linux timer which fires at absolute wall clock time, including time
+    passed in system suspend. It also fires early if system clock is set. """
+
+    _funcs = None
+
+    def __init__(self):
+        if TimerFD._funcs is None:
+            TimerFD._funcs = _load_timerfd() or ()
+        if not TimerFD._funcs:
+            raise OSError(errno.ENOSYS, "timerfd is not available")
+        create, self._settime = TimerFD._funcs
+        fd = create(constants.CLOCK_REALTIME,
+                    constants.TFD_NONBLOCK | constants.TFD_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+        self._spec = itimerspec()
+
+    def set(self, when):
+        """ Arms timer for wall clock time when """
+        sec = int(when)
+        nsec = int((when - sec) * 1e9)
+        if sec <= 0 and nsec <= 0:
+            # zero value disarms timer
+            nsec = 1
+        self._spec.it_value.tv_sec = sec
+        self._spec.it_value.tv_nsec = nsec
+        if self._settime(self.fd,
+                         constants.TFD_TIMER_ABSTIME |
+                         constants.TFD_TIMER_CANCEL_ON_SET,
+                         ctypes.byref(self._spec), None) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def consume(self):
+        """ Drains expiration counter. Returns False if timer was cancelled
+        by clock change. """
+        try:
+            os.read(self.fd, 8)
+        except BlockingIOError:
+            pass
+        except OSError as exc:
+            if exc.errno == errno.ECANCELED:
+                return False
+            raise
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WallClockTimer:
+    __slots__ = ('when', '_callback', '_args', '_cancelled', '_owner')
+
+    def __init__(self, when, callback, args, owner):
+        self.when = when
+        self._callback = callback
+        self._args = args
+        self._cancelled = False
+        self._owner = owner
+
+    def cancel(self):
+        if not self._cancelled:
+            self._cancelled = True
+            if self._owner is not None:
+                self._owner._timer_cancelled()  # pylint: disable=protected-access
+
+    def cancelled(self):
+        return self._cancelled
+
+    def _run(self):
+        if not self._cancelled:
+            self._cancelled = True
+            self._callback(*self._args)
+
+
+class WallClockTimers:
+    """ Schedules callbacks at wall clock time. All deadlines share one
+    heap and one wakeup source: timerfd where available, otherwise loop
+    timer which never sleeps longer than max_sleep, so time spent in system
+    suspend gets noticed. Cancelled entries are skipped lazily. """
+
+    def __init__(self, *, max_sleep=1., loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._max_sleep = max_sleep
+        self._heap = []
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self._armed_at = None
+        self._handle = None
+        self._timerfd = None
+        try:
+            timerfd = TimerFD()
+        except OSError as exc:
+            self._logger.debug("Using polling wall clock timer: %s", str(exc))
+        else:
+            try:
+                self._loop.add_reader(timerfd.fd, self._on_timerfd)
+            except NotImplementedError:
+                timerfd.close()
+            else:
+                self._timerfd = timerfd
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, when, callback, *args):
+        """ Calls callback(*args) at wall clock time when. Returns timer
+        with cancel() method. """
+        timer = WallClockTimer(when, callback, args, self)
+        heapq.heappush(self._heap, (when, next(self._seq), timer))
+        if self._armed_at is None or when < self._armed_at:
+            self._arm(time.time())
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    async def sleep(self, delay):
+        fut = self._loop.create_future()
+        timer = self.call_later(delay, _set_result, fut)
+        try:
+            await fut
+        finally:
+            timer.cancel()
+
+    def _timer_cancelled(self):
+        self._cancelled += 1
+        heap = self._heap
+        if self._cancelled > 64 and self._cancelled * 2 > len(heap):
+            heap[:] = [entry for entry in heap if not entry[2].cancelled()]
+            heapq.heapify(heap)
+            self._cancelled = 0
+
+    def _arm(self, now):
+        heap = self._heap
+        while heap and heap[0][2].cancelled():
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if not heap:
+            self._armed_at = None
+            if self._timerfd is not None:
+                self._timerfd.set(now + 365 * 86400)
+            return
+        when = heap[0][0]
+        self._armed_at = when
+        if self._timerfd is not None:
+            self._timerfd.set(when)
+        else:
+            self._handle = self._loop.call_later(
+                max(0, min(when - now, self._max_sleep)), self._fire)
+
+    def _on_timerfd(self):
+        if not self._timerfd.consume():
+            self._logger.debug("System clock was set. Rescheduling timers.")
+        self._fire()
+
+    def _fire(self):
+        self._handle = None
+        now = time.time()
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, timer = heapq.heappop(heap)
+            if timer.cancelled():
+                self._cancelled -= 1
+            else:
+                timer._owner = None  # pylint: disable=protected-access
+                self._loop.call_soon(timer._run)  # pylint: disable=protected-access
+        self._arm(now)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._timerfd is not None:
+            self._loop.remove_reader(self._timerfd.fd)
+            self._timerfd.close()
+            self._timerfd = None
+        self._heap.clear()
+        self._cancelled = 0
+        self._armed_at = None
+        _timers.pop(self._loop, None)
+
+
+def _set_result(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+_timers = weakref.WeakKeyDictionary()
+
+
+def get_timers(loop=None):
+    """ Returns wall clock timer service shared by everything running on
+    loop """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    timers = _timers.get(loop)
+    if timers is None:
+        timers = WallClockTimers(loop=loop)
+        _timers[loop] = timers
+    return timers
+
+
+def close_timers(loop=None):
+    """ Releases timer service of loop, if any, before loop is closed """
+    loop = loop if loop is not None else asyncio.get_event_loop()
+    timers = _timers.get(loop)
+    if timers is not None:
+        timers.close()
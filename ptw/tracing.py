@@ -0,0 +1,66 @@
+import asyncio
+import json
+import logging
+import random
+
+
+class Trace:
+    """ Phase timestamps of single client connection, relative to accept """
+
+    __slots__ = ('peer', 'start', 'phases', 'first_byte')
+
+    def __init__(self, peer, start, loop):
+        self.peer = peer
+        self.start = start
+        self.phases = []
+        self.first_byte = lambda: self.mark("first_byte", loop.time())
+
+    def mark(self, phase, now):
+        self.phases.append((phase, now - self.start))
+
+    @property
+    def phase(self):
+        """ Last phase connection reached """
+        return self.phases[-1][0] if self.phases else "accept"
+
+    @property
+    def latency(self):
+        """ Time from accept to last recorded phase """
+        return self.phases[-1][1] if self.phases else 0.
+
+
+class Tracer:
+    """ Samples client connections for phase tracing, reports slow ones as
+    JSON records and dumps runtime state on demand """
+
+    def __init__(self, *, sample_rate=0., slow_threshold=.5, loop=None):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._sample_rate = sample_rate
+        self._slow_threshold = slow_threshold
+
+    def begin(self, peer):
+        """ Returns Trace for sampled connection or None """
+        if not self._sample_rate or random.random() >= self._sample_rate:
+            return None
+        return Trace(peer, self._loop.time(), self._loop)
+
+    def finish(self, trace, listener):
+        if trace.latency < self._slow_threshold:
+            return
+        record = {
+            "listener": listener,
+            "peer": str(trace.peer),
+            "latency_ms": round(trace.latency * 1000, 3),
+            "phases": {phase: round(offset * 1000, 3)
+                       for phase, offset in trace.phases},
+        }
+        self._logger.warning("Slow connection: %s", json.dumps(record))
+
+    def dump(self, listener, pool):
+        """ Logs snapshot of listener and pool state """
+        state = {
+            "listener": listener.snapshot(),
+            "pool": pool.snapshot(),
+        }
+        self._logger.warning("State dump: %s", json.dumps(state))
@@ -5,11 +5,20 @@ import logging.handlers
 import ssl
 import os
 import queue
+import shlex
 import socket
 import ctypes
-import time
+import ipaddress
 
 from . import constants
+from . import metrics
+from .timers import get_timers
+
+
+LOG_DROPPED = metrics.REGISTRY.counter(
+    "ptw_log_dropped_total",
+    "Log records dropped because writer could not keep up",
+    ("log",))
 
 
 def ignore_ssl_error(loop):
@@ -49,30 +58,43 @@ def ignore_ssl_error(loop):
 
 
 class OverflowingQueue(queue.Queue):
+    """ Queue which drops items instead of blocking when full and counts
+    them """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.dropped = 0
+
     def put(self, item, block=True, timeout=None):
         try:
             return queue.Queue.put(self, item, block, timeout)
         except queue.Full:
-            pass
+            self.dropped += 1
 
     def put_nowait(self, item):
         return self.put(item, False)
 
 
+def sync_log_handler(logfile=None):
+    if logfile is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(logfile)
+    handler.setFormatter(logging.Formatter('%(asctime)s '
+                                           '%(levelname)-8s '
+                                           '%(name)s: %(message)s',
+                                           '%Y-%m-%d %H:%M:%S'))
+    return handler
+
+
 class AsyncLoggingHandler:
     def __init__(self, logfile=None, maxsize=1024):
-        _queue = OverflowingQueue(maxsize)
-        if logfile is None:
-            _handler = logging.StreamHandler()
-        else:
-            _handler = logging.FileHandler(logfile)
-        self._listener = logging.handlers.QueueListener(_queue, _handler)
-        self._async_handler = logging.handlers.QueueHandler(_queue)
-
-        _handler.setFormatter(logging.Formatter('%(asctime)s '
-                                                '%(levelname)-8s '
-                                                '%(name)s: %(message)s',
-                                                '%Y-%m-%d %H:%M:%S'))
+        self._queue = OverflowingQueue(maxsize)
+        self._handler = sync_log_handler(logfile)
+        self._listener = logging.handlers.QueueListener(self._queue,
+                                                        self._handler)
+        self._async_handler = logging.handlers.QueueHandler(self._queue)
+        LOG_DROPPED.labels("main").set_function(lambda: self._queue.dropped)
 
     def __enter__(self):
         self._listener.start()
@@ -80,6 +102,14 @@ class AsyncLoggingHandler:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self._listener.stop()
+        if self._queue.dropped:
+            self._handler.handle(logging.makeLogRecord({
+                'name': 'MAIN',
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': "%d log records were dropped.",
+                'args': (self._queue.dropped,),
+            }))
 
 
 def setup_logger(name, verbosity, handler):
@@ -102,6 +132,17 @@ def check_port(value):
     return ivalue
 
 
+def check_file_mode(value):
+    try:
+        ivalue = int(value, 8)
+    except ValueError:
+        ivalue = -1
+    if not 0 <= ivalue <= 0o777:
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid octal file mode" % value)
+    return ivalue
+
+
 def check_positive_float(value):
     def fail():
         raise argparse.ArgumentTypeError(
@@ -115,6 +156,19 @@ def check_positive_float(value):
     return fvalue
 
 
+def check_ratio(value):
+    def fail():
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid ratio" % value)
+    try:
+        fvalue = float(value)
+    except ValueError:
+        fail()
+    if not 0 <= fvalue <= 1:
+        fail()
+    return fvalue
+
+
 def check_positive_int(value):
     def fail():
         raise argparse.ArgumentTypeError(
@@ -135,12 +189,116 @@ def check_loglevel(arg):
         raise argparse.ArgumentTypeError("%s is not valid loglevel" % (repr(arg),))
 
 
+def check_relay_engine(arg):
+    try:
+        return constants.RelayEngine[arg]
+    except (IndexError, KeyError):
+        raise argparse.ArgumentTypeError("%s is not valid relay engine" % (repr(arg),))
+
+
+def check_balance_policy(arg):
+    try:
+        return constants.BalancePolicy[arg]
+    except (IndexError, KeyError):
+        raise argparse.ArgumentTypeError("%s is not valid balancing policy" % (repr(arg),))
+
+
+def check_reserve_policy(arg):
+    try:
+        return constants.ReservePolicy[arg]
+    except (IndexError, KeyError):
+        raise argparse.ArgumentTypeError("%s is not valid reserve policy" % (repr(arg),))
+
+
+def check_endpoint(value):
+    """ Parses HOST:PORT[@WEIGHT]. IPv6 host has to be enclosed in square
+    brackets. """
+    def fail():
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid endpoint" % value)
+    endpoint, _, weight = value.partition('@')
+    host, sep, port = endpoint.rpartition(':')
+    if not sep or not host:
+        fail()
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+    port = check_port(port)
+    if weight:
+        weight = check_positive_int(weight)
+    else:
+        weight = 1
+    return host, port, weight
+
+
+def check_priority_network(value):
+    """ Parses NETWORK=CLASS, where CLASS is integer priority of clients
+    from NETWORK """
+    network, sep, priority = value.rpartition('=')
+    try:
+        if not sep:
+            raise ValueError
+        return ipaddress.ip_network(network, strict=False), int(priority)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%s is not a valid NETWORK=CLASS pair" % value)
+
+
 def check_ssl_hostname(arg):
     if not arg:
         raise argparse.ArgumentTypeError("%s is not valid server name" % (repr(arg),))
     return arg
 
 
+def config_line_args(line):
+    """ Splits line of argument file into arguments like shell does.
+    Comments and empty lines are skipped. """
+    return shlex.split(line, comments=True)
+
+
+def is_unix_path(address):
+    """ Tells UNIX socket path from hostname or IP address """
+    return '/' in address
+
+
+def endpoint(host, port):
+    """ Printable address of TCP or UNIX socket endpoint """
+    if is_unix_path(host):
+        return host
+    return "%s:%d" % (host, port)
+
+
+def share(total, parts, idx):
+    """ Size of idx-th part when total is split into parts as evenly as
+    possible """
+    return total // parts + (1 if idx < total % parts else 0)
+
+
+def reuse_port_supported():
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+SD_LISTEN_FDS_START = 3
+
+
+def systemd_sockets():
+    """ Returns sockets passed by systemd socket activation and unsets its
+    environment variables, like sd_listen_fds(3) """
+    try:
+        pid = int(os.environ.get('LISTEN_PID', ''))
+        count = int(os.environ.get('LISTEN_FDS', ''))
+    except ValueError:
+        return []
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    if pid != os.getpid():
+        return []
+    socks = []
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count):
+        os.set_inheritable(fd, False)
+        socks.append(socket.socket(fileno=fd))
+    return socks
+
+
 def enable_uvloop():  # pragma: no cover
     try:
         import uvloop
@@ -224,8 +382,7 @@ class sockaddr_in6(ctypes.Structure):
 sockaddr6_size = ctypes.sizeof(sockaddr_in6)
 
 def get_orig_dst(sock):
-    own_addr = sock.getsockname()[0]
-    own_af = detect_af(own_addr)
+    own_af = sock.family
     if own_af == socket.AF_INET:
         buf = sock.getsockopt(socket.SOL_IP, constants.SO_ORIGINAL_DST, sockaddr_size)
         sa = sockaddr_in.from_buffer_copy(buf)
@@ -237,18 +394,12 @@ def get_orig_dst(sock):
         buf = sock.getsockopt(constants.SOL_IPV6, constants.SO_ORIGINAL_DST, sockaddr6_size)
         sa = sockaddr_in6.from_buffer_copy(buf)
         addr = socket.inet_ntop(socket.AF_INET6, sa.sin6_addr)
-        port = socket.ntohs(sa.sin_port)
+        port = socket.ntohs(sa.sin6_port)
         return addr, port
     else:
         raise RuntimeError("Unknown address family!")
 
-async def wall_clock_sleep(duration, precision=.2):
-    async def _wall_clock_sleep():
-        end_time = time.time() + duration
-        while time.time() < end_time:
-            await asyncio.sleep(precision)
-
-    try:
-        await asyncio.wait_for(_wall_clock_sleep(), duration)
-    except asyncio.TimeoutError:
-        pass
+async def wall_clock_sleep(duration):
+    """ Sleeps until wall clock advances by duration, counting time spent
+    in system suspend """
+    await get_timers().sleep(duration)
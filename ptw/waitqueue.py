@@ -0,0 +1,73 @@
+import bisect
+import collections
+
+
+class WaitQueue:
+    """ Futures of clients waiting for connection from exhausted pool.
+
+    Waiters of higher priority class are served first. Within class,
+    client sources take turns, so single busy source can't starve others,
+    and waiters of same source are served in arrival order. Waiter leaves
+    queue as soon as its future is cancelled. """
+
+    def __init__(self):
+        # priority -> source -> waiters of source in arrival order
+        self._classes = {}
+        # negated priorities in ascending order
+        self._order = []
+        # waiter -> (priority, source)
+        self._index = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def sources(self):
+        """ Number of distinct sources having waiters """
+        return sum(len(sources) for sources in self._classes.values())
+
+    def push(self, fut, source=None, priority=0):
+        sources = self._classes.get(priority)
+        if sources is None:
+            sources = self._classes[priority] = collections.OrderedDict()
+            bisect.insort(self._order, -priority)
+        waiters = sources.get(source)
+        if waiters is None:
+            waiters = sources[source] = collections.OrderedDict()
+        waiters[fut] = None
+        self._index[fut] = priority, source
+        fut.add_done_callback(self._discard)
+
+    def _drop_empty(self, priority, source):
+        sources = self._classes[priority]
+        if not sources[source]:
+            del sources[source]
+            if not sources:
+                del self._classes[priority]
+                self._order.remove(-priority)
+
+    def _discard(self, fut):
+        # waiters handed out by pop() are not indexed anymore
+        key = self._index.pop(fut, None)
+        if key is None:
+            return
+        priority, source = key
+        del self._classes[priority][source][fut]
+        self._drop_empty(priority, source)
+
+    def pop(self):
+        """ Removes and returns next waiter to serve or None if there are
+        no waiters """
+        while self._order:
+            priority = -self._order[0]
+            sources = self._classes[priority]
+            source, waiters = next(iter(sources.items()))
+            fut, _ = waiters.popitem(last=False)
+            del self._index[fut]
+            # source goes to the back of line
+            sources.move_to_end(source)
+            self._drop_empty(priority, source)
+            # cancellation callback may be not run yet
+            if not fut.done():
+                return fut
+        return None
@@ -13,7 +13,7 @@ setup(name='ptw',
       author_email='vladislav-ex-src@vm-0.com',
       license='MIT',
       packages=['ptw'],
-      python_requires='>=3.5.3',
+      python_requires='>=3.7',
       setup_requires=[
           'wheel',
       ],
@@ -23,10 +23,11 @@ setup(name='ptw',
       entry_points={
           'console_scripts': [
               'ptw=ptw.__main__:main',
+              'ptw-demux=ptw.demux:main',
           ],
       },
       classifiers=[
-          "Programming Language :: Python :: 3.5",
+          "Programming Language :: Python :: 3.7",
           "License :: OSI Approved :: MIT License",
           "Operating System :: OS Independent",
           "Development Status :: 5 - Production/Stable",
@@ -0,0 +1,46 @@
+import asyncio
+import unittest
+
+from ptw.metrics import MetricsServer, Registry
+
+
+class MetricsServerTest(unittest.TestCase):
+    def _request(self, request):
+        async def scenario():
+            registry = Registry()
+            registry.counter("test_total", "Test counter").labels().inc()
+            metrics = MetricsServer(address="127.0.0.1", port=0,
+                                    registry=registry)
+            server = await asyncio.start_server(metrics.handler,
+                                                "127.0.0.1", 0)
+            try:
+                reader, writer = await asyncio.open_connection(
+                    *server.sockets[0].getsockname())
+                writer.write(request)
+                response = await asyncio.wait_for(reader.read(), 5.)
+                writer.close()
+                return response
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        return asyncio.run(scenario())
+
+    def test_get(self):
+        response = self._request(b"GET /metrics HTTP/1.0\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+        self.assertIn(b"\ntest_total 1", response)
+
+    def test_oversized_request_line(self):
+        response = self._request(b"GET /" + b"x" * 2**17 + b" HTTP/1.0\r\n"
+                                 b"\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.0 400 Bad Request\r\n"))
+
+    def test_oversized_header(self):
+        response = self._request(b"GET /metrics HTTP/1.0\r\n"
+                                 b"X-Pad: " + b"x" * 2**17 + b"\r\n\r\n")
+        self.assertTrue(response.startswith(b"HTTP/1.0 400 Bad Request\r\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
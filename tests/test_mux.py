@@ -0,0 +1,53 @@
+import asyncio
+import unittest
+
+from ptw.mux import (MuxSession, HEADER, FRAME_OPEN, FRAME_RESET,
+                     MAX_STREAM_ID, PREFACE)
+
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+
+class StreamIDTest(unittest.TestCase):
+    def test_drain_when_ids_run_out(self):
+        async def scenario():
+            transport = FakeTransport()
+            session = MuxSession(client=True, label="test")
+            session.connection_made(transport)
+            session._next_id = MAX_STREAM_ID  # pylint: disable=protected-access
+            stream = session.open_stream()
+            self.assertEqual(stream.id, MAX_STREAM_ID)
+            self.assertTrue(session.draining)
+            self.assertFalse(session.available)
+            with self.assertRaises(ConnectionResetError):
+                session.open_stream()
+            self.assertEqual(len(session), 1)
+            await asyncio.sleep(0)
+            self.assertFalse(transport.closed)
+            stream.abort()
+            await asyncio.sleep(0)
+            self.assertTrue(transport.closed)
+            self.assertEqual(
+                bytes(transport.data),
+                PREFACE +
+                HEADER.pack(FRAME_OPEN, MAX_STREAM_ID, 0) +
+                HEADER.pack(FRAME_RESET, MAX_STREAM_ID, 0))
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from ptw.asdnotify import AsyncSystemdNotifier
+from ptw.readiness import announce_ready
+
+
+class FakePool:
+    def __init__(self, size):
+        self.size = size
+        self.idle = 0
+
+
+class AnnounceReadyTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmpdir.name, "notify")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+
+    def tearDown(self):
+        self.sock.close()
+        self._tmpdir.cleanup()
+
+    def received(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self.sock.recv(4096))
+            except BlockingIOError:
+                return messages
+
+    def test_ready_after_fill(self):
+        pool = FakePool(4)
+
+        async def scenario():
+            async with AsyncSystemdNotifier() as notifier:
+                task = asyncio.ensure_future(
+                    announce_ready(notifier, [pool], .5, 10.,
+                                   poll_interval=.01))
+                await asyncio.sleep(.1)
+                self.assertEqual(self.received(), [])
+                pool.idle = 1
+                await asyncio.sleep(.1)
+                self.assertEqual(self.received(), [])
+                pool.idle = 2
+                self.assertTrue(await asyncio.wait_for(task, 1.))
+            self.assertEqual(self.received(), [b"READY=1"])
+
+        with mock.patch.dict(os.environ, {"NOTIFY_SOCKET": self.path}):
+            asyncio.run(scenario())
+
+    def test_ready_on_timeout(self):
+        async def scenario():
+            async with AsyncSystemdNotifier() as notifier:
+                self.assertFalse(await announce_ready(
+                    notifier, [FakePool(4)], .5, .1, poll_interval=.01))
+            self.assertEqual(self.received(), [b"READY=1"])
+
+        with mock.patch.dict(os.environ, {"NOTIFY_SOCKET": self.path}):
+            asyncio.run(scenario())
+
+    def test_no_notify_socket(self):
+        pool = FakePool(4)
+        pool.idle = 4
+
+        async def scenario():
+            async with AsyncSystemdNotifier() as notifier:
+                self.assertFalse(notifier.started)
+                self.assertTrue(await announce_ready(
+                    notifier, [pool], .5, 1., poll_interval=.01))
+            self.assertEqual(self.received(), [])
+
+        with mock.patch.dict(os.environ):
+            os.environ.pop("NOTIFY_SOCKET", None)
+            asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import asyncio
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from ptw.relay import IdleMonitor, write_eof
+
+
+HOST = '127.0.0.1'
+
+
+@unittest.skipIf(shutil.which('openssl') is None, "openssl CLI is required")
+class TLSWriteEOFTest(unittest.TestCase):
+    """ write_eof() of asyncio TLS transport relies on internals of
+    asyncio.sslproto. These tests break once they change. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._tmpdir = tempfile.TemporaryDirectory()
+        certfile = os.path.join(cls._tmpdir.name, 'cert.pem')
+        keyfile = os.path.join(cls._tmpdir.name, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                        '-nodes', '-days', '1',
+                        '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=IP:%s' % (HOST,),
+                        '-keyout', keyfile, '-out', certfile],
+                       check=True,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        cls.server_context = ssl.create_default_context(
+            ssl.Purpose.CLIENT_AUTH)
+        cls.server_context.load_cert_chain(certfile=certfile,
+                                           keyfile=keyfile)
+        cls.client_context = ssl.create_default_context(
+            ssl.Purpose.SERVER_AUTH)
+        cls.client_context.load_verify_locations(cafile=certfile)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmpdir.cleanup()
+
+    def _serve(self, listener):
+        # blocking server: asyncio TLS transport closes on close_notify,
+        # so it can't reply after end of request
+        conn, _ = listener.accept()
+        with self.server_context.wrap_socket(conn, server_side=True) as tls:
+            total = 0
+            while True:
+                data = tls.recv(65536)
+                if not data:
+                    break
+                total += len(data)
+            tls.sendall(b"got %d" % (total,))
+            tls.unwrap()
+
+    async def _with_connection(self, client):
+        listener = socket.create_server((HOST, 0))
+        server = threading.Thread(target=self._serve, args=(listener,),
+                                  daemon=True)
+        server.start()
+        try:
+            reader, writer = await asyncio.open_connection(
+                *listener.getsockname(), ssl=self.client_context)
+            try:
+                return await asyncio.wait_for(client(reader, writer), 5.)
+            finally:
+                writer.close()
+        finally:
+            listener.close()
+
+    def test_sslproto_internals(self):
+        async def client(reader, writer):  # pylint: disable=unused-argument
+            protocol = getattr(writer.transport, '_ssl_protocol', None)
+            self.assertIsNotNone(protocol)
+            self.assertIsInstance(getattr(protocol, '_sslobj', None),
+                                  ssl.SSLObject)
+            self.assertTrue(hasattr(protocol, '_write_backlog'))
+            self.assertTrue(callable(getattr(protocol, '_process_outgoing',
+                                             None)))
+
+        asyncio.run(self._with_connection(client))
+
+    def test_half_close(self):
+        async def client(reader, writer):
+            writer.write(b"x" * 100000)
+            await writer.drain()
+            self.assertTrue(write_eof(writer.transport))
+            return await reader.read()
+
+        self.assertEqual(asyncio.run(self._with_connection(client)),
+                         b"got 100000")
+
+
+class IdleMonitorTest(unittest.TestCase):
+    def _reaped(self, propagated, **kwargs):
+        async def scenario():
+            closed = asyncio.Event()
+            monitor = IdleMonitor(**kwargs)
+            monitor.start(lambda: 0, closed.set)
+            monitor.half_close(propagated)
+            try:
+                await asyncio.wait_for(closed.wait(), .5)
+            except asyncio.TimeoutError:
+                pass
+            monitor.stop()
+            return monitor.reaped
+
+        with mock.patch('ptw.relay.HALF_CLOSE_FALLBACK_TIMEOUT', .05):
+            return asyncio.run(scenario())
+
+    def test_propagated_half_close_kept(self):
+        self.assertIsNone(self._reaped(True))
+
+    def test_unpropagated_half_close_reaped(self):
+        self.assertEqual(self._reaped(False), "half_closed")
+
+    def test_half_close_timeout(self):
+        self.assertEqual(self._reaped(True, half_close_timeout=.05),
+                         "half_closed")
+
+
+if __name__ == '__main__':
+    unittest.main()